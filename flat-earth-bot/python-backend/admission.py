@@ -0,0 +1,268 @@
+"""
+Admission control for LLM generations. At most max_streams turns run at once and every
+session has at most one running turn. Further turns wait in a bounded FIFO queue; a turn
+only leaves the queue when its session has no running turn, so a single session can not
+hold back the others. If the queue is full, or a turn waited longer than queue_timeout,
+the request is answered right away with 503 and a Retry-After estimate.
+
+A second request of a session that already has a running turn either supersedes it (the
+running stream is stopped and a waiting one is rejected with 409) or queues behind it
+(with 429 if the session already has a waiting request), see session_policy.
+"""
+
+import asyncio
+import math
+from abc import ABC, abstractmethod
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Callable, Dict, Iterator, Optional
+
+import metrics
+
+SESSION_POLICIES = ("supersede", "queue")
+
+
+class AdmissionRejected(Exception):
+
+    def __init__(self, status: int, reason: str, retry_after: Optional[int] = None):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def headers(self) -> Dict[str, str]:
+        return {"Retry-After": str(self.retry_after)} if self.retry_after is not None else {}
+
+    def body(self) -> Dict:
+        return {"error": self.reason}
+
+
+class Ticket:
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+        self.rejection = None
+        # set when a newer request of the same session replaces this one
+        self.superseded = False
+        self.released = False
+
+
+class AdmissionController(ABC):
+    """The queue and the running turns. Not synchronized, see ThreadAdmissionController and AsyncAdmissionController."""
+
+    def __init__(self, max_streams: int, max_queue: int = 64, queue_timeout: float = 30.0,
+                 session_policy: str = "supersede"):
+        if session_policy not in SESSION_POLICIES:
+            raise ValueError(f"Unknown session policy {session_policy}, use one of {SESSION_POLICIES}")
+        self.max_streams = max_streams
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.session_policy = session_policy
+        self.running: Dict[str, Ticket] = {}
+        self.waiting = deque()
+        # moving average of the time a turn holds its slot, for Retry-After
+        self.average_hold = 5.0
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.average_hold * (len(self.waiting) + 1) / self.max_streams))
+
+    def reject(self, status: int, reason: str, retry_after: bool = True) -> AdmissionRejected:
+        metrics.ADMISSION_REJECTED.labels(reason).inc()
+        return AdmissionRejected(status, reason, self.retry_after() if retry_after else None)
+
+    def _admit(self, session_id: str) -> Ticket:
+        for waiting in self.waiting:
+            if waiting.session_id == session_id:
+                if self.session_policy == "queue":
+                    raise self.reject(429, "session_busy")
+                waiting.rejection = self.reject(409, "superseded", retry_after=False)
+                self._remove(waiting)
+                break
+        running = self.running.get(session_id)
+        if running is not None and self.session_policy == "supersede":
+            running.superseded = True
+        if len(self.waiting) >= self.max_queue:
+            raise self.reject(503, "queue_full")
+        ticket = Ticket(session_id)
+        self.waiting.append(ticket)
+        self._grant()
+        return ticket
+
+    def _grant(self):
+        for ticket in list(self.waiting):
+            if len(self.running) >= self.max_streams:
+                break
+            if ticket.session_id in self.running:
+                continue
+            self.waiting.remove(ticket)
+            ticket.granted_at = time.monotonic()
+            self.running[ticket.session_id] = ticket
+            metrics.observe_stage("admission_wait", ticket.granted_at - ticket.enqueued_at)
+            self._wake(ticket)
+        metrics.ADMISSION_WAITING.set(len(self.waiting))
+
+    def _remove(self, ticket: Ticket):
+        if ticket not in self.waiting:
+            return
+        self.waiting.remove(ticket)
+        self._wake(ticket)
+        metrics.ADMISSION_WAITING.set(len(self.waiting))
+
+    def _timeout(self, ticket: Ticket) -> AdmissionRejected:
+        self._remove(ticket)
+        return self.reject(503, "queue_timeout")
+
+    def _release(self, ticket: Ticket):
+        if ticket.released or ticket.granted_at is None:
+            return
+        ticket.released = True
+        if self.running.get(ticket.session_id) is ticket:
+            del self.running[ticket.session_id]
+        self.average_hold = 0.9 * self.average_hold + 0.1 * (time.monotonic() - ticket.granted_at)
+        self._grant()
+
+    @abstractmethod
+    def _wake(self, ticket: Ticket):
+        """Lets the waiting acquire of the ticket check again whether it was granted or rejected."""
+
+    def stats(self) -> Dict:
+        return {"running": len(self.running), "waiting": len(self.waiting), "average_hold": self.average_hold}
+
+
+class ThreadAdmissionController(AdmissionController):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._condition = threading.Condition()
+
+    def acquire(self, session_id: str) -> Ticket:
+        with self._condition:
+            ticket = self._admit(session_id)
+            deadline = ticket.enqueued_at + self.queue_timeout
+            while ticket.granted_at is None:
+                if ticket.rejection is not None:
+                    raise ticket.rejection
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._timeout(ticket)
+                self._condition.wait(remaining)
+            return ticket
+
+    def release(self, ticket: Ticket):
+        with self._condition:
+            self._release(ticket)
+
+    def _wake(self, ticket: Ticket):
+        self._condition.notify_all()
+
+
+class AsyncAdmissionController(AdmissionController):
+    """Same as ThreadAdmissionController for the event loop of the ASGI server."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._waiters: Dict[Ticket, asyncio.Future] = {}
+
+    async def acquire(self, session_id: str) -> Ticket:
+        ticket = self._admit(session_id)
+        if ticket.granted_at is not None:
+            return ticket
+        waiter = self._waiters[ticket] = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if ticket.granted_at is None and ticket.rejection is None:
+                raise self._timeout(ticket)
+        except asyncio.CancelledError:
+            # the client went away while waiting
+            if ticket.granted_at is None:
+                self._remove(ticket)
+            else:
+                self._release(ticket)
+            raise
+        finally:
+            self._waiters.pop(ticket, None)
+        if ticket.rejection is not None:
+            raise ticket.rejection
+        return ticket
+
+    def release(self, ticket: Ticket):
+        self._release(ticket)
+
+    def _wake(self, ticket: Ticket):
+        waiter = self._waiters.get(ticket)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+
+class AdmittedStream:
+    """The answer of an admitted turn. Gives the slot back when the answer ends or the response is closed."""
+
+    def __init__(self, answer: Iterator[bytes], ticket: Ticket, release: Callable[[Ticket], None],
+                 supersede: Callable[[], bool]):
+        self.answer = answer
+        self.ticket = ticket
+        self._release = release
+        # called once a newer request of the session arrived, False if the turn has to finish anyway
+        self.supersede = supersede
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        if self.ticket.superseded and self.supersede():
+            self.close()
+            raise StopIteration
+        try:
+            return next(self.answer)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.answer.close()
+        finally:
+            self._release(self.ticket)
+
+
+class AsyncAdmittedStream:
+
+    def __init__(self, answer: AsyncIterator[bytes], ticket: Ticket, release: Callable[[Ticket], None],
+                 supersede: Callable[[], bool]):
+        self.answer = answer
+        self.ticket = ticket
+        self._release = release
+        # called once a newer request of the session arrived, False if the turn has to finish anyway
+        self.supersede = supersede
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self.ticket.superseded and self.supersede():
+            await self.aclose()
+            raise StopAsyncIteration
+        try:
+            return await self.answer.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            await self.answer.aclose()
+        finally:
+            self._release(self.ticket)
+
@@ -0,0 +1,98 @@
+"""
+ASGI entry point serving the same /api/chat and /api/chat_no_stream contract as
+chat_server.py, but on asyncio so that a single process can hold hundreds of
+concurrent SSE streams.
+
+Run it with:
+
+    uvicorn async_chat_server:app --host 0.0.0.0 --port 5000
+"""
+
+import contextlib
+import os
+
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+import metrics
+from admission import AdmissionRejected
+from async_chatbot import AsyncChatbot, allm_stream_to_str
+from compact_stream import FORMAT_HEADER, AsyncCompactStream, requested_flush_seconds
+from log_config import init_logging
+from chatbot_implementation import ChatbotImplementation
+
+init_logging()
+
+chatbot = AsyncChatbot(ChatbotImplementation())
+
+
+async def get_generator(request):
+    request_data = await request.json()
+    generator = await chatbot.get_answer(
+        request_data["messages"],
+        request_data["session_id"],
+        request_data["llm_parameters"],
+        request_data["chatbot"],
+        request.query_params.get('uid')
+    )
+    return generator
+
+
+async def chat(request):
+    flush_seconds = requested_flush_seconds(request.query_params, request.headers)
+    generator = await get_generator(request)
+    headers = None
+    if flush_seconds is not None:
+        generator = AsyncCompactStream(generator, flush_seconds)
+        headers = {FORMAT_HEADER: "compact"}
+    # closes the answer (and gives its LLM slot back) even if the client left before the first chunk
+    return StreamingResponse(generator, media_type='application/json', headers=headers,
+                             background=BackgroundTask(generator.aclose))
+
+
+async def chat_no_stream(request):
+    generator = await get_generator(request)
+    response = await allm_stream_to_str(generator)
+    return PlainTextResponse(response, media_type='text/html')
+
+
+async def admission_rejected(request, exc: AdmissionRejected):
+    return JSONResponse(exc.body(), status_code=exc.status, headers=exc.headers())
+
+
+async def prometheus_metrics(request):
+    return PlainTextResponse(metrics.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+async def ready(request):
+    return JSONResponse({"ready": chatbot.ready}, status_code=200 if chatbot.ready else 503)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await chatbot.warm_up()
+    yield
+    await chatbot.aclose()
+
+
+app = Starlette(
+    routes=[
+        Route("/api/chat", chat, methods=["POST"]),
+        Route("/api/chat_no_stream", chat_no_stream, methods=["POST"]),
+        Route("/metrics", prometheus_metrics, methods=["GET"]),
+        Route("/ready", ready, methods=["GET"]),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])],
+    exception_handlers={AdmissionRejected: admission_rejected},
+    lifespan=lifespan
+)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    port = int(os.environ.get('PORT', 5000))
+    uvicorn.run(app, host='0.0.0.0', port=port)
@@ -0,0 +1,329 @@
+"""
+Asyncio version of the answer pipeline. It reuses the dialog logic of a Chatbot
+(plan_turn, hints, quiz, logging) but talks to RASA and the LLM through long lived
+pooled httpx clients and streams the answer with an async generator, so one
+process can serve many concurrent SSE streams.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import AsyncIterator, Dict, List
+
+import httpx
+
+import metrics
+from admission import AsyncAdmissionController, AsyncAdmittedStream
+from chatbot import LLM_UNAVAILABLE_MESSAGE, Chatbot, latency_ms, llm_stream_to_str
+from hint_classifier import AsyncSpeculativeHintClassifier
+from llm_pool import LlmBackend, LlmBackendError, LlmUnavailable
+from nlu_batcher import AsyncNluBatcher
+from sse import SSEParser, token_text
+from turn_pipeline import summarize_timings
+
+# httpx logs every request on INFO, which would flood the technical log
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+class AsyncChatbot:
+    def __init__(self, chatbot: Chatbot):
+        self.chatbot = chatbot
+        pool_size = int(os.getenv("HTTP_POOL_SIZE", 32))
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        # generation can take a while, only the connect phase gets a short timeout
+        llm_timeout = httpx.Timeout(None, connect=float(os.getenv("LLM_CONNECT_TIMEOUT", 10)))
+        nlu_timeout = httpx.Timeout(float(os.getenv("NLU_TIMEOUT", 10)))
+        self.llm_client = httpx.AsyncClient(limits=limits, timeout=llm_timeout)
+        self.nlu_client = httpx.AsyncClient(limits=limits, timeout=nlu_timeout)
+        self.nlu_batcher = AsyncNluBatcher(self.rasa_parse_batch, window=chatbot.nlu_batcher.window,
+                                           max_batch=chatbot.nlu_batcher.max_batch) \
+            if chatbot.nlu_batcher is not None else None
+        admission = chatbot.admission
+        self.admission = AsyncAdmissionController(admission.max_streams, max_queue=admission.max_queue,
+                                                  queue_timeout=admission.queue_timeout,
+                                                  session_policy=admission.session_policy) \
+            if admission is not None else None
+
+    async def aclose(self):
+        await self.llm_client.aclose()
+        await self.nlu_client.aclose()
+
+    async def nlu(self, user_message: str):
+        nlu_response = self.chatbot.embedded_parse(user_message)
+        if nlu_response is not None:
+            return nlu_response["intent"], nlu_response
+        parse = self.nlu_batcher.parse if self.nlu_batcher is not None else self.rasa_parse
+        nlu_cache = self.chatbot.nlu_cache
+        if nlu_cache is not None:
+            nlu_response = await nlu_cache.aparse(user_message, parse)
+        else:
+            nlu_response = await parse(user_message)
+        if nlu_response is not None:
+            return nlu_response["intent"], nlu_response
+
+    async def rasa_parse(self, user_message: str):
+        try:
+            response = await self.nlu_client.post(self.chatbot.rasa_nlu_url, json={"text": user_message})
+            nlu_response = response.json()
+            if "intent" not in nlu_response:
+                raise ValueError(f"Unexpected NLU response: {nlu_response}")
+            return nlu_response
+        except Exception as e:
+            metrics.ERRORS.labels("nlu").inc()
+            logging.error("There was a problem connecting to RASA NLU server")
+            logging.exception(e)
+
+    async def rasa_parse_batch(self, user_messages: List[str]) -> List:
+        try:
+            response = await self.nlu_client.post(self.chatbot.rasa_nlu_batch_url, json={"texts": user_messages})
+            nlu_responses = response.json()["results"]
+            if len(nlu_responses) != len(user_messages) or any("intent" not in r for r in nlu_responses):
+                raise ValueError(f"Unexpected batch parse response for {len(user_messages)} texts")
+            return nlu_responses
+        except Exception as e:
+            metrics.ERRORS.labels("nlu_batch").inc()
+            logging.error("There was a problem with the batch parse of the RASA NLU server")
+            logging.exception(e)
+            return await asyncio.gather(*(self.rasa_parse(user_message) for user_message in user_messages))
+
+    async def get_answer(self, messages: List[Dict], session_id: str, llm_parameter: Dict, chatbot_id: str,
+                         uid: str = None) -> AsyncIterator[bytes]:
+        # NLU and planning happen before the response starts, like in Chatbot.get_answer
+        ticket = await self.admission.acquire(session_id) if self.admission is not None else None
+        try:
+            turn = await self.plan_turn(messages, session_id, llm_parameter, chatbot_id, uid)
+        except BaseException:
+            if ticket is not None:
+                self.admission.release(ticket)
+            raise
+        answer = self.stream_turn(turn, llm_parameter, chatbot_id)
+        if ticket is None:
+            return answer
+        return AsyncAdmittedStream(answer, ticket, self.admission.release,
+                                   supersede=lambda: self.chatbot.supersede_turn(turn))
+
+    async def plan_turn(self, messages: List[Dict], session_id: str, llm_parameter: Dict, chatbot_id: str,
+                        uid: str = None) -> Dict:
+        loop = asyncio.get_running_loop()
+        # the session store may read from SQLite, so the planning runs on the thread pool
+        if self.chatbot.turn_pipeline is not None:
+            (intent, nlu_response), prefetched, timings = await self.run_turn_pipeline(messages)
+            turn = await loop.run_in_executor(None, self.chatbot.plan_turn, messages, session_id, llm_parameter,
+                                              chatbot_id, uid, intent, nlu_response, prefetched)
+            turn["logging_info"]["pipeline"] = timings
+        else:
+            with metrics.stage("nlu"):
+                intent, nlu_response = await self.nlu(messages[-1]["message"])
+            turn = await loop.run_in_executor(None, self.chatbot.plan_turn, messages, session_id, llm_parameter,
+                                              chatbot_id, uid, intent, nlu_response)
+        return turn
+
+    async def log_response(self, logging_info: Dict, running_text: str, chatbot_id: str, state: Dict,
+                           intent: Dict = None):
+        # saving the session and queueing the log record can block, keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.chatbot.log_response, logging_info, running_text,
+                                                         chatbot_id, state, intent)
+
+    def log_aborted_response(self, logging_info: Dict, running_text: List[str], llm_parameter: Dict, chatbot_id: str,
+                             state: Dict, hint_classifier=None):
+        # called while the stream is closed, where nothing can be awaited, so the logging is not waited for
+        if hint_classifier is not None:
+            hint_classifier.cancel()
+        asyncio.get_running_loop().run_in_executor(None, self.chatbot.log_aborted_response, logging_info,
+                                                   list(running_text), llm_parameter, chatbot_id, state)
+
+    async def stream_turn(self, turn: Dict, llm_parameter: Dict, chatbot_id: str) -> AsyncIterator[bytes]:
+        yield self.chatbot.create_header(turn["header_success"])
+        answer = self._call_llm_generic(turn, llm_parameter, chatbot_id)
+        try:
+            async for chunk in answer:
+                yield chunk
+        finally:
+            # closes the LLM stream right away when the client disconnects
+            await answer.aclose()
+
+    async def run_turn_pipeline(self, messages: List[Dict]):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        (nlu_result, nlu_seconds), (prefetched, prefetch_seconds), (_, connect_seconds) = await asyncio.gather(
+            atimed(self.nlu(messages[-1]["message"])),
+            # sentiment analysis is CPU bound, keep it off the event loop
+            atimed(loop.run_in_executor(None, self.chatbot.prefetch_prompt_inputs, messages)),
+            atimed(self.warm_llm_connection())
+        )
+        timings = summarize_timings({
+            "nlu": nlu_seconds,
+            "prompt_inputs": prefetch_seconds,
+            "llm_connect": connect_seconds
+        }, time.perf_counter() - start)
+        metrics.observe_stage("nlu", nlu_seconds)
+        metrics.observe_stage("prompt_inputs", prefetch_seconds)
+        # the warm-up connect, the generation request itself is observed as llm_connect
+        metrics.observe_stage("llm_warmup", connect_seconds)
+        logging.info(f"Turn pipeline saved {timings['saved_ms']} ms before the LLM call: {timings['stages_ms']}")
+        return nlu_result, prefetched, timings
+
+    @property
+    def ready(self) -> bool:
+        return self.chatbot.ready
+
+    async def warm_up(self):
+        start = time.perf_counter()
+        self.chatbot.dialog_policy.current()
+        await self.warm_llm_connection()
+        self.chatbot.ready = True
+        logging.info(f"Chatbot ready, warm up took {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    async def warm_llm_connection(self):
+        backend = self.chatbot.llm_pool.peek()
+        if backend is None or time.monotonic() - backend.last_used < self.chatbot.llm_keepalive:
+            return
+        try:
+            await self.llm_client.get(backend.health_url, timeout=2)
+            backend.last_used = time.monotonic()
+        except Exception as e:
+            logging.warning(f"Could not warm up the LLM connection: {e}")
+
+    async def _call_llm_generic(self, turn: Dict, llm_parameter: Dict, chatbot_id: str) -> AsyncIterator[bytes]:
+        metrics.STREAMS_IN_FLIGHT.inc()
+        answer = self._stream_answer(turn, llm_parameter, chatbot_id)
+        try:
+            async for chunk in answer:
+                yield chunk
+        finally:
+            await answer.aclose()
+            metrics.STREAMS_IN_FLIGHT.dec()
+
+    async def _stream_answer(self, turn: Dict, llm_parameter: Dict, chatbot_id: str) -> AsyncIterator[bytes]:
+        response_cache = self.chatbot.response_cache
+        cache_key = response_cache.key(turn["prompt"], llm_parameter) \
+            if turn["cacheable"] and response_cache is not None else None
+        cached = response_cache.get(cache_key, llm_parameter) if cache_key is not None else None
+        if cached is not None:
+            chunks, running_text = cached
+            turn["logging_info"]["response_cache"] = "replay"
+            metrics.RESPONSE_CACHE_REPLAYS.inc()
+            try:
+                for chunk in chunks:
+                    yield chunk
+            except (asyncio.CancelledError, GeneratorExit):
+                self.log_aborted_response(turn["logging_info"], [running_text], None, chatbot_id, turn["state"])
+                raise
+            intent = await self.classify_answer(running_text, turn["is_quiz"])
+            trailer_events = self.chatbot.create_trailer_events(intent, turn["is_quiz"], turn["user_intent"], turn["state"])
+            await self.log_response(turn["logging_info"], running_text, chatbot_id, turn["state"], intent)
+            for event in trailer_events:
+                yield event.encode()
+            return
+
+        data = self.chatbot.create_llm_request(turn["prompt"], llm_parameter, turn["logging_info"]["session_id"])
+        running_text = []
+        chunks = [] if cache_key is not None else None
+        hint_classifier = None
+        if self.chatbot.speculative_hints and not turn["is_quiz"]:
+            hint_classifier = AsyncSpeculativeHintClassifier(self.nlu, self.chatbot.hint_deadline)
+
+        llm_pool = self.chatbot.llm_pool
+        start = time.perf_counter()
+        try:
+            backend, (response, llm_chunks) = await llm_pool.aopen_stream(
+                lambda backend: self.connect_llm(backend, data))
+            metrics.observe_stage("llm_connect", time.perf_counter() - start)
+        except LlmUnavailable as e:
+            metrics.ERRORS.labels("llm").inc()
+            logging.error(f"There was a problem connecting to the LLM server. {e}")
+            turn["logging_info"]["llm_error"] = str(e)
+            yield self.chatbot.create_error_event(LLM_UNAVAILABLE_MESSAGE)
+            await self.log_response(turn["logging_info"], "", chatbot_id, turn["state"])
+            return
+
+        backend_ok = True
+        first_token = None
+        try:
+            parser = SSEParser()
+            async for chunk in llm_chunks:
+                for event in parser.feed(chunk):
+                    next_str = token_text(event)
+                    if next_str is None:
+                        continue
+                    if not running_text:
+                        first_token = time.perf_counter() - start
+                        metrics.observe_stage("llm_first_token", first_token)
+                    running_text.append(next_str)
+                    if hint_classifier is not None:
+                        hint_classifier.feed(next_str, running_text)
+                if chunks is not None:
+                    chunks.append(chunk)
+                yield chunk
+        except httpx.HTTPError as e:
+            # the backend broke off the stream, the turn ends with the partial answer
+            backend_ok = False
+            metrics.ERRORS.labels("llm").inc()
+            logging.error(f"The LLM stream of {backend.url} broke off")
+            logging.exception(e)
+        except (asyncio.CancelledError, GeneratorExit):
+            # the client disconnected, closing the response stops the generation on the LLM server
+            self.log_aborted_response(turn["logging_info"], running_text, llm_parameter, chatbot_id, turn["state"],
+                                      hint_classifier)
+            raise
+        finally:
+            await response.aclose()
+            llm_pool.release(backend, backend_ok)
+
+        stream_seconds = time.perf_counter() - start
+        metrics.observe_stage("llm_stream", stream_seconds)
+        metrics.TOKENS_STREAMED.inc(len(running_text))
+        turn["logging_info"]["latency_ms"] = latency_ms(first_token, stream_seconds)
+        running_text = "".join(running_text)
+        if chunks is not None and backend_ok and response.status_code == 200 and running_text:
+            response_cache.add(cache_key, llm_parameter, chunks, running_text)
+        with metrics.stage("answer_nlu"):
+            intent = await self.classify_answer(running_text, turn["is_quiz"], hint_classifier)
+        trailer_events = self.chatbot.create_trailer_events(intent, turn["is_quiz"], turn["user_intent"], turn["state"])
+        await self.log_response(turn["logging_info"], running_text, chatbot_id, turn["state"], intent)
+        for event in trailer_events:
+            yield event.encode()
+
+    async def connect_llm(self, backend: LlmBackend, data: Dict):
+        """Sends the generation request to the backend and waits for the first chunk of the stream."""
+        response = None
+        try:
+            request = self.llm_client.build_request("POST", backend.url, json=data)
+            response = await self.llm_client.send(request, stream=True)
+            if response.status_code >= 500:
+                raise LlmBackendError(f"{backend.url} answered with status {response.status_code}")
+            llm_chunks = response.aiter_raw()
+            first_chunk = await llm_chunks.__anext__()
+        except StopAsyncIteration:
+            return response, llm_chunks
+        except BaseException:
+            # also when the hedge lost and this attempt is cancelled
+            if response is not None:
+                await response.aclose()
+            raise
+        return response, aprepend(first_chunk, llm_chunks)
+
+    async def classify_answer(self, running_text: str, is_quiz: bool, hint_classifier=None):
+        if is_quiz:
+            return None
+        if hint_classifier is not None:
+            return await hint_classifier.result(running_text)
+        intent, _ = await self.nlu(running_text)
+        return intent
+
+
+async def aprepend(first_chunk: bytes, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    yield first_chunk
+    async for chunk in chunks:
+        yield chunk
+
+
+async def atimed(awaitable):
+    start = time.perf_counter()
+    result = await awaitable
+    return result, time.perf_counter() - start
+
+
+async def allm_stream_to_str(generator: AsyncIterator[bytes]) -> str:
+    return llm_stream_to_str([chunk async for chunk in generator])
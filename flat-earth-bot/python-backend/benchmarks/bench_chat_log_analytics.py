@@ -0,0 +1,174 @@
+"""
+chat_log_analytics.py against the usual ad-hoc script that loads the whole chat log with
+json.loads and computes the reports in Python. The same synthetic conversations are logged
+by ChatLogWriter in the full and in the delta mode; the reports of both stores have to match
+the ones of the naive script, and the histories of the store have to match the log.
+
+    python benchmarks/bench_chat_log_analytics.py [--sessions 2000] [--turns 12] [--path-length 3]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import prompts  # noqa: E402
+from chat_log_analytics import DIALOG_KINDS, ChatLogStore, build_store  # noqa: E402
+from chat_logger import ChatLogWriter  # noqa: E402
+
+INTENTS = ["greet", "nefarious_intent", "curiosity_about_flat_earth", "disagree_flat_earth",
+           "provided_evidence_against_flat_earth", "user_identified_argumentation_strategy", "termination"]
+
+
+def synthetic_records(sessions: int, turns: int, seed: int = 1):
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    for s in range(sessions):
+        session_id = f"session-{s}"
+        messages = [{"sender": "Chatbot", "message": "Hi, I am convinced that the earth is flat. What do you think?"}]
+        quiz_at = rng.randint(2, turns - 2)
+        for t in range(turns):
+            if t == quiz_at + 1:
+                user_message = rng.choice("abc")
+                kind = "quiz_answer"
+            else:
+                user_message = " ".join(rng.choice(["the", "horizon", "NASA", "ships", "curve", "photos", "why"])
+                                        for _ in range(rng.randint(3, 20)))
+                kind = "quiz" if t == quiz_at else ("closure" if t == turns - 1 and rng.random() < 0.3 else "dialog")
+            messages = messages + [{"sender": "User", "message": user_message}]
+            record = {
+                "messages": messages,
+                "session_id": session_id,
+                "llm_parameters": {"max_new_tokens": 100},
+                "nlu_response": {"text": user_message, "intent": {"name": rng.choice(INTENTS), "confidence": 0.9}},
+                "prompt": prompts.prompt_template_persona + "".join(f"{m['sender']}: {m['message']}\n" for m in messages),
+                "success": kind != "dialog" or rng.random() < 0.05,
+                "time": (start + timedelta(seconds=s * 60 + t * 5)).isoformat(),
+                "uid": None,
+                "kind": kind,
+                "pipeline": {"wall_ms": rng.uniform(5, 50), "stages_ms": {"nlu": rng.uniform(5, 40)}},
+                "latency_ms": {"first_token": round(rng.uniform(100, 900), 1), "stream": round(rng.uniform(1000, 5000), 1)},
+                "llm_response": "The earth is flat, " * rng.randint(5, 30)
+            }
+            if kind == "quiz_answer":
+                record["quiz_correct"] = rng.random() < 0.6
+            yield record
+            messages = messages + [{"sender": "Chatbot", "message": record["llm_response"]}]
+
+
+def write_log(path: str, mode: str, sessions: int, turns: int):
+    writer = ChatLogWriter(path, mode=mode, queue_size=100000, put_timeout=60)
+    for record in synthetic_records(sessions, turns):
+        writer.write(record)
+    writer.close()
+
+
+def naive_report(path: str, path_length: int):
+    """What the ad-hoc scripts do: load every record, then loop over them."""
+    with open(path) as f:
+        records = [json.loads(line) for line in f.readlines()]
+    sessions = {}
+    for record in records:
+        sessions.setdefault(record["session_id"], []).append(record)
+    totals, successes = Counter(), Counter()
+    for session_records in sessions.values():
+        dialog = [r for r in session_records if r["kind"] in DIALOG_KINDS]
+        path = []
+        for r in dialog:
+            intent = r["nlu_response"]["intent"]["name"]
+            if len(path) < path_length and (not path or path[-1] != intent):
+                path.append(intent)
+        if not path:
+            continue
+        totals[tuple(path)] += 1
+        successes[tuple(path)] += any(r["success"] for r in dialog)
+    answers = [r["quiz_correct"] for r in records if r["kind"] == "quiz_answer"]
+    first_tokens = [r["latency_ms"]["first_token"] for r in records]
+    return {
+        "success_by_intent_path": {path: round(successes[path] / n, 4) for path, n in totals.items()},
+        "quiz_accuracy": round(sum(answers) / len(answers), 4),
+        "first_token_p50": round(float(np.percentile(first_tokens, 50)), 1)
+    }, records
+
+
+def store_report(store: ChatLogStore, path_length: int):
+    return {
+        "success_by_intent_path": {tuple(p["path"]): p["success_rate"] for p in store.success_by_intent_path(path_length)},
+        "quiz_accuracy": store.quiz_accuracy()["accuracy"],
+        "first_token_p50": store.latency()["first_token_ms"]["p50"]
+    }
+
+
+def measured(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {"seconds": round(seconds, 3), "peak_mb": round(peak / 2 ** 20, 1)}
+
+
+def directory_mb(directory: str) -> float:
+    return round(sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(directory) for f in files) / 2 ** 20, 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--turns", type=int, default=12)
+    parser.add_argument("--path-length", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    report = {}
+    stores = {}
+    for mode in ("full", "delta"):
+        log_path = os.path.join(directory, mode, "chat_log.text")
+        store_path = os.path.join(directory, mode, "analytics")
+        write_log(log_path, mode, args.sessions, args.turns)
+        meta, build = measured(build_store, log_path, store_path)
+        store, load = measured(ChatLogStore, store_path)
+        reports, query = measured(store_report, store, args.path_length)
+        stores[mode] = (store, reports)
+        report[mode] = {"log_mb": round(os.path.getsize(log_path) / 2 ** 20, 1), "store_mb": directory_mb(store_path),
+                        "build": build, "load": load, "queries": query, "records": meta["turns"],
+                        "messages_stored": meta["messages"]}
+
+    (naive, records), naive_cost = measured(naive_report, os.path.join(directory, "full", "chat_log.text"),
+                                            args.path_length)
+    report["naive_full_log"] = naive_cost
+    full_store, full_reports = stores["full"]
+    parity = full_reports == naive and stores["delta"][1] == naive
+    # the history of every 97th turn, rebuilt from the deduplicated messages
+    turn_in_session = Counter()
+    checked = 0
+    for i, record in enumerate(records):
+        n = turn_in_session[record["session_id"]]
+        turn_in_session[record["session_id"]] += 1
+        if i % 97:
+            continue
+        row = full_store.session_rows(record["session_id"])[n]
+        parity &= full_store.history(row) == record["messages"] and stores["delta"][0].history(row) == record["messages"]
+        parity &= full_store.response(row) == record["llm_response"]
+        checked += 1
+    report["parity"] = {"reports_match": full_reports == naive and stores["delta"][1] == naive,
+                        "histories_checked": checked, "ok": bool(parity)}
+    print(json.dumps(report, indent=4))
+    return report
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    main()
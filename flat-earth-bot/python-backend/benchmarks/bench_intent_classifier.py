@@ -0,0 +1,120 @@
+"""
+Accuracy and latency of the embedded intent classifier (intent_classifier.py).
+
+* Held-out accuracy: the classifier is trained on k-1 folds of rasa-nlu/data/nlu.yml and
+  evaluated on the remaining fold, overall and for the answers above the confidence threshold
+  (coverage is the share of texts that would skip the RASA call).
+* Parity with RASA: the model trained on all examples is compared with the answers of a
+  running RASA server, for the nlu.yml examples and the user messages in examples/*.json.
+* Latency of one parse, embedded versus the HTTP call to RASA.
+
+    python benchmarks/bench_intent_classifier.py [--rasa-url http://localhost:5005/model/parse] [--threshold 0.7]
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from intent_classifier import IntentClassifier  # noqa: E402
+from load_test import distribution_ms  # noqa: E402
+from nlu_data import load_nlu_examples  # noqa: E402
+
+EXAMPLES_GLOB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "examples", "*.json")
+
+
+def split_folds(examples: dict, folds: int):
+    for fold in range(folds):
+        train, test = {}, []
+        for intent, texts in examples.items():
+            train[intent] = [text for i, text in enumerate(texts) if i % folds != fold]
+            test.extend((text, intent) for i, text in enumerate(texts) if i % folds == fold)
+        yield train, test
+
+
+def agreement(pairs, threshold: float) -> dict:
+    """pairs are (embedded parse, expected intent name)"""
+    confident = [(parsed, expected) for parsed, expected in pairs if parsed["intent"]["confidence"] >= threshold]
+    return {
+        "texts": len(pairs),
+        "accuracy": round(sum(p["intent"]["name"] == e for p, e in pairs) / len(pairs), 4),
+        "coverage": round(len(confident) / len(pairs), 4),
+        "accuracy_above_threshold": round(sum(p["intent"]["name"] == e for p, e in confident) / len(confident), 4)
+        if confident else None
+    }
+
+
+def held_out(examples: dict, args) -> dict:
+    pairs = []
+    for train, test in split_folds(examples, args.folds):
+        classifier = IntentClassifier.train(train, iterations=args.iterations)
+        pairs.extend((classifier.parse(text), intent) for text, intent in test)
+    return agreement(pairs, args.threshold)
+
+
+def session_messages(pattern: str):
+    texts = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path) as f:
+            example = json.load(f)
+        texts.extend(m["message"] for m in example.get("messages", []) if m["sender"] == "User")
+    return texts
+
+
+def timed_ms(function, texts):
+    durations = []
+    results = []
+    for text in texts:
+        start = time.perf_counter()
+        results.append(function(text))
+        durations.append(time.perf_counter() - start)
+    return results, distribution_ms(durations)
+
+
+def rasa_parity(classifier: IntentClassifier, texts, args) -> dict:
+    session = requests.Session()
+    try:
+        session.post(args.rasa_url, json={"text": "hello"}, timeout=5).json()["intent"]
+    except Exception as e:
+        return {"skipped": f"RASA is not reachable at {args.rasa_url}: {type(e).__name__}"}
+    rasa, rasa_latency = timed_ms(lambda text: session.post(args.rasa_url, json={"text": text}).json(), texts)
+    embedded, embedded_latency = timed_ms(classifier.parse, texts)
+    report = agreement([(e, r["intent"]["name"]) for e, r in zip(embedded, rasa)], args.threshold)
+    report["rasa_latency_ms"] = rasa_latency
+    report["embedded_latency_ms"] = embedded_latency
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rasa-url", default=os.getenv("RASA_NLU_URL", "http://localhost:5005/model/parse"))
+    parser.add_argument("--threshold", type=float, default=float(os.getenv("EMBEDDED_NLU_THRESHOLD", 0.7)))
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=300)
+    parser.add_argument("--examples", default=EXAMPLES_GLOB, help="glob of the session files with user messages")
+    args = parser.parse_args(argv)
+
+    examples = load_nlu_examples()
+    classifier = IntentClassifier.train(examples, iterations=args.iterations)
+    texts = [text for texts in examples.values() for text in texts] + session_messages(args.examples)
+    _, embedded_latency = timed_ms(classifier.parse, texts)
+    report = {
+        "threshold": args.threshold,
+        "held_out": held_out(examples, args),
+        "embedded_latency_ms": embedded_latency,
+        "rasa_parity": rasa_parity(classifier, texts, args)
+    }
+    print(json.dumps(report, indent=4))
+    return report
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    main()
@@ -0,0 +1,98 @@
+"""
+Throughput of concurrent NLU parses with and without micro-batching (NLU_BATCH=1), against
+mock_rasa.py. The mock does its work one request at a time, like the single event loop of
+RASA: --request-ms per HTTP request and --parse-ms per text. The batch endpoint of RASA
+(rasa-nlu/addons/batch_parse.py) still classifies every text on its own, so batching only
+saves the per request part; the gain depends on its share, which has to be measured on the
+real RASA server. With --parse-ms 0 the result is an upper bound.
+
+    python benchmarks/bench_nlu_batching.py [--users 1,8,32,64] [--parses 50] [--request-ms 1] [--parse-ms 1]
+        [--latency-ms 5]
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mock_rasa  # noqa: E402
+from load_test import distribution_ms  # noqa: E402
+from nlu_data import load_nlu_examples  # noqa: E402
+
+
+def run(chatbot, server, texts, users: int, parses: int) -> dict:
+    durations = []
+    lock = threading.Lock()
+
+    def user(offset: int):
+        for i in range(parses):
+            start = time.perf_counter()
+            chatbot.nlu(texts[(offset * parses + i) % len(texts)])
+            with lock:
+                durations.append(time.perf_counter() - start)
+
+    requests_before, texts_before = server.requests, server.texts
+    start = time.perf_counter()
+    threads = [threading.Thread(target=user, args=(u,)) for u in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    return {
+        "parses_per_s": round(len(durations) / wall, 1),
+        "latency_ms": distribution_ms(durations),
+        "rasa_requests": server.requests - requests_before,
+        "rasa_texts": server.texts - texts_before
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", default="1,8,32,64", help="comma separated numbers of concurrent callers")
+    parser.add_argument("--parses", type=int, default=50, help="parses per caller")
+    parser.add_argument("--request-ms", type=float, default=1, help="work of the NLU server per request")
+    parser.add_argument("--parse-ms", type=float, default=1, help="work of the NLU server per text")
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--window-ms", type=float, default=5)
+    parser.add_argument("--max-batch", type=int, default=32)
+    args = parser.parse_args(argv)
+
+    server = mock_rasa.start_in_thread(latency_ms=args.latency_ms, request_ms=args.request_ms, parse_ms=args.parse_ms)
+    os.environ.update({
+        "RASA_NLU_URL": f"http://127.0.0.1:{server.server_address[1]}/model/parse",
+        "LOG_DIR": tempfile.mkdtemp(),
+        "NLU_CACHE_SIZE": "0",
+        "NLU_BATCH": "1",
+        "NLU_BATCH_WINDOW_MS": str(args.window_ms),
+        "NLU_BATCH_MAX": str(args.max_batch),
+        "HTTP_POOL_SIZE": "128"
+    })
+    from chatbot_implementation import ChatbotImplementation
+
+    chatbot = ChatbotImplementation()
+    batcher = chatbot.nlu_batcher
+    texts = [text for texts in load_nlu_examples().values() for text in texts]
+    report = {"request_ms": args.request_ms, "parse_ms": args.parse_ms}
+    for users in (int(u) for u in args.users.split(",")):
+        chatbot.nlu_batcher = None
+        single = run(chatbot, server, texts, users, args.parses)
+        chatbot.nlu_batcher = batcher
+        batched = run(chatbot, server, texts, users, args.parses)
+        report[f"{users}_users"] = {"single": single, "batched": batched,
+                                    "speedup": round(batched["parses_per_s"] / single["parses_per_s"], 2)}
+    report["batcher"] = batcher.stats()
+    print(json.dumps(report, indent=4))
+    server.shutdown()
+    return report
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    main()
@@ -0,0 +1,78 @@
+"""
+Measures how much of each prompt an LLM server with a prefix (KV) cache could reuse from
+the previous turn of the same session, for the default and the prefix_cache prompt layout.
+
+It plays several sessions of scripted user messages against mock_llm.py. The NLU is
+replaced by a fixed sequence of intents, so RASA is not needed.
+
+    python benchmarks/bench_prefix_cache.py [--turns 30] [--sessions 5] [--max-prompt-length 15000]
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mock_llm  # noqa: E402
+
+USER_MESSAGES = [
+    "Hi there!",
+    "The Earth is not flat.",
+    "Tell me more about that!",
+    "Ships disappear hull first over the horizon, that shows the curvature.",
+    "Why would NASA lie about that?",
+    "Photos from the ISS clearly show a round earth.",
+    "I don't believe you, that is ridiculous.",
+    "What about the time zones?",
+]
+INTENTS = ["greeting", "disagree_flat_earth", "curiosity_about_flat_earth", "provided_evidence_against_flat_earth",
+           "curiosity_about_flat_earth", "provided_evidence_for_spherical_earth", "insult_and_abuse_bot",
+           "user_asks_for_clearer_explanation"]
+
+
+def run_layout(layout: str, server: mock_llm.MockLLMServer, args) -> dict:
+    os.environ["PROMPT_LAYOUT"] = layout
+    os.environ["MAX_PROMPT_LENGTH"] = str(args.max_prompt_length)
+    from chatbot import llm_stream_to_str
+    from chatbot_implementation import ChatbotImplementation
+
+    chatbot = ChatbotImplementation()
+    intents = itertools.cycle(INTENTS)
+    chatbot.nlu = lambda text: (lambda name: ({"name": name, "confidence": 0.9}, {"intent": {"name": name}}))(
+        next(intents))
+
+    for session in range(args.sessions):
+        messages = [{"sender": "Chatbot", "message": "I believe the Earth is flat!"}]
+        for turn in range(args.turns):
+            messages.append({"sender": "User", "message": USER_MESSAGES[(session + turn) % len(USER_MESSAGES)]})
+            answer = llm_stream_to_str(chatbot.get_answer(messages, f"{layout}-{session}",
+                                                          {"max_new_tokens": 40, "cache_key": f"{layout}-{session}"},
+                                                          "flat-earth-bot"))
+            messages.append({"sender": "Chatbot", "message": answer.split("<br/>")[0]})
+
+    with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/stats") as response:
+        return json.loads(response.read())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--sessions", type=int, default=5)
+    parser.add_argument("--max-prompt-length", type=int, default=15000)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    os.environ["TURN_PIPELINE"] = "0"
+    os.environ["LOG_DIR"] = os.getenv("BENCH_LOG_DIR", "/tmp/flat-earth-bot-bench")
+    results = {}
+    for layout in ["default", "prefix_cache"]:
+        server = mock_llm.start_in_thread(cache_key_param="cache_key")
+        os.environ["LLM_URL"] = f"http://127.0.0.1:{server.server_address[1]}/generate_stream"
+        results[layout] = run_layout(layout, server, args)
+        server.shutdown()
+    print(json.dumps(results, indent=4))
@@ -0,0 +1,96 @@
+"""
+Parity and speed of the sentiment scorer in sentiment.py against TextBlob, on the examples
+of rasa-nlu/data/nlu.yml and the messages in examples/*.json.
+
+Every polarity has to equal TextBlob(text).sentiment.polarity, and with it the positive,
+neutral and negative bucket of get_sentiment_analysis_prompt. The script exits with 1 if a
+text differs, so it can be used as a parity test after rebuilding the lexicon.
+
+    python benchmarks/bench_sentiment.py [--repeat 5]
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from nlu_data import load_nlu_examples  # noqa: E402
+
+EXAMPLES_GLOB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "examples", "*.json")
+
+
+def bucket(polarity: float) -> str:
+    # the thresholds of ChatbotImplementation.get_sentiment_analysis_prompt
+    if polarity > 0.2:
+        return "positive"
+    elif polarity < 0:
+        return "negative"
+    return "neutral"
+
+
+def load_texts(pattern: str):
+    texts = [text for texts in load_nlu_examples().values() for text in texts]
+    for path in sorted(glob.glob(pattern)):
+        with open(path) as f:
+            texts.extend(m["message"] for m in json.load(f).get("messages", []))
+    return texts
+
+
+def per_call_us(function, texts, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            function(text)
+    return round((time.perf_counter() - start) / (repeat * len(texts)) * 1e6, 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--examples", default=EXAMPLES_GLOB, help="glob of the session files with messages")
+    args = parser.parse_args(argv)
+    texts = load_texts(args.examples)
+
+    start = time.perf_counter()
+    from textblob import TextBlob
+    TextBlob("warm up").sentiment.polarity
+    textblob_cold_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    from sentiment import SentimentAnalyzer, load_sentiment_analyzer
+    analyzer = load_sentiment_analyzer()
+    fast_cold_ms = (time.perf_counter() - start) * 1000
+
+    mismatches = []
+    for text in texts:
+        expected = TextBlob(text).sentiment.polarity
+        actual = analyzer.lexicon.polarity(text)
+        if abs(expected - actual) > 1e-9:
+            mismatches.append({"text": text, "textblob": expected, "fast": actual,
+                               "same_bucket": bucket(expected) == bucket(actual)})
+
+    uncached = SentimentAnalyzer(analyzer.lexicon, cache_size=0)
+    report = {
+        "texts": len(texts),
+        "polarity_mismatches": len(mismatches),
+        "bucket_mismatches": sum(not m["same_bucket"] for m in mismatches),
+        "cold_start_ms": {"textblob": round(textblob_cold_ms, 1), "fast": round(fast_cold_ms, 1)},
+        "per_call_us": {
+            "textblob": per_call_us(lambda text: TextBlob(text).sentiment.polarity, texts, args.repeat),
+            "fast": per_call_us(uncached.polarity, texts, args.repeat),
+            "fast_cached": per_call_us(analyzer.polarity, texts, args.repeat)
+        },
+        "mismatches": mismatches[:20]
+    }
+    print(json.dumps(report, indent=4))
+    return report
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    sys.exit(1 if main()["polarity_mismatches"] else 0)
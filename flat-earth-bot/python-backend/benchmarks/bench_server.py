@@ -0,0 +1,143 @@
+"""
+Throughput of the single process development server (`python chat_server.py`) against the
+gunicorn production profile (gunicorn.conf.py) under the same load. The mock LLM, the mock
+RASA and both servers run as separate processes on free ports, the load comes from
+load_test.py. Besides the load test report, the memory of the server processes is reported
+(proportional set size, i.e. pages shared copy-on-write by the workers count once), on Linux.
+
+    python benchmarks/bench_server.py [--workers 4] [--threads 32] [--users 32] [--duration 20]
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from types import SimpleNamespace
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BACKEND_DIR)
+
+from load_test import EXAMPLES_GLOB, LoadTest  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start(command, env=None) -> subprocess.Popen:
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_until_up(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout} s")
+
+
+def children(pid: int):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def memory_mb(pid: int) -> dict:
+    """Resident and proportional set size of the process and its children, empty where /proc is missing."""
+    totals = {}
+    for process in [pid] + children(pid):
+        try:
+            with open(f"/proc/{process}/smaps_rollup") as f:
+                for line in f:
+                    key, value = line.split(":", 1)
+                    if key in ("Rss", "Pss"):
+                        totals[key] = totals.get(key, 0) + int(value.split()[0])
+        except OSError:
+            return {}
+    return {f"{key.lower()}_mb": round(kb / 1024, 1) for key, kb in totals.items()}
+
+
+def run_server(name: str, command, env, args) -> dict:
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    server = start(command, dict(env, PORT=str(port)))
+    try:
+        wait_until_up(url + "/metrics")
+        startup_s = time.perf_counter() - started
+        load_args = SimpleNamespace(url=url, users=args.users, duration=args.duration, examples=EXAMPLES_GLOB,
+                                    repeat_session=1, timeout=120)
+        report = LoadTest(load_args).run()
+        report.update(server=name, startup_s=round(startup_s, 2), **memory_mb(server.pid))
+        return report
+    finally:
+        server.terminate()
+        server.wait(timeout=60)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=32, help="threads per gunicorn worker")
+    parser.add_argument("--users", type=int, default=32, help="concurrent users")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load per server")
+    parser.add_argument("--first-token-ms", type=float, default=50)
+    parser.add_argument("--tokens-per-s", type=float, default=200)
+    parser.add_argument("--tokens", type=int, default=40)
+    parser.add_argument("--output", default=None, help="also write the report to this JSON file")
+    args = parser.parse_args(argv)
+
+    llm_port, rasa_port = free_port(), free_port()
+    mocks = [
+        start([sys.executable, "benchmarks/mock_llm.py", "--port", str(llm_port),
+               "--first-token-ms", str(args.first_token_ms), "--tokens-per-s", str(args.tokens_per_s),
+               "--tokens", str(args.tokens)]),
+        start([sys.executable, "benchmarks/mock_rasa.py", "--port", str(rasa_port)])
+    ]
+    env = dict(
+        os.environ,
+        LLM_URL=f"http://127.0.0.1:{llm_port}/generate_stream",
+        RASA_NLU_URL=f"http://127.0.0.1:{rasa_port}/model/parse",
+        LOG_DIR=tempfile.mkdtemp(),
+        SESSION_STORE="sqlite",
+        PRODUCTION="1",
+        WEB_WORKERS=str(args.workers),
+        WEB_THREADS=str(args.threads)
+    )
+    try:
+        wait_until_up(f"http://127.0.0.1:{llm_port}/health")
+        report = {
+            "dev_server": run_server("dev", [sys.executable, "chat_server.py"], env, args),
+            "gunicorn": run_server(f"gunicorn {args.workers}x{args.threads}",
+                                   [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py"], env, args),
+            "cpus": os.cpu_count()
+        }
+    finally:
+        for mock in mocks:
+            mock.terminate()
+            mock.wait(timeout=10)
+    dev, production = report["dev_server"]["turns_per_s"], report["gunicorn"]["turns_per_s"]
+    report["speedup"] = round(production / dev, 2) if dev else None
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    return report
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    main()
@@ -0,0 +1,118 @@
+"""
+Memory the backend keeps per session, measured with tracemalloc over synthetic sessions.
+Every turn goes through plan_turn, the trailer events and log_response of the chatbot with
+a freshly parsed request (as the server gets it), only the NLU and the LLM are left out.
+The sessions are run once with the last turn kept completely (SESSION_LAST_TURN=full) and
+once as a delta (the default). Separately, the session states alone are compared with the
+dicts they replaced.
+
+    python benchmarks/bench_session_memory.py [--sessions 10000] [--turns 12]
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from chatbot_implementation import ChatbotImplementation  # noqa: E402
+from session_store import IntentFlags, SessionState  # noqa: E402
+
+INTENTS = ["greet", "nefarious_intent", "curiosity_about_flat_earth", "disagree_flat_earth",
+           "provided_evidence_against_flat_earth", "user_identified_argumentation_strategy"]
+WORDS = ["the", "horizon", "NASA", "ships", "curve", "photos", "why", "gravity", "water", "pilots"]
+
+
+def run_sessions(bot: ChatbotImplementation, sessions: int, turns: int, seed: int = 1):
+    rng = random.Random(seed)
+    for s in range(sessions):
+        session_id = f"session-{s}"
+        history = [{"sender": "Chatbot", "message": "Hi, I am convinced that the earth is flat. What do you think?"}]
+        for _ in range(turns):
+            user_message = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 25)))
+            history.append({"sender": "User", "message": user_message})
+            # every request brings its own copy of the history
+            messages = json.loads(json.dumps(history))
+            intent = {"name": rng.choice(INTENTS), "confidence": 0.9}
+            nlu_response = {"text": user_message, "intent": intent, "entities": []}
+            turn = bot.plan_turn(messages, session_id, {"max_new_tokens": 100}, "bench", None, intent, nlu_response)
+            answer = " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 60)))
+            bot.create_trailer_events(intent, turn["is_quiz"], turn["user_intent"], turn["state"])
+            bot.log_response(turn["logging_info"], answer, "bench", turn["state"], intent)
+            history.append({"sender": "Chatbot", "message": answer})
+
+
+def retained(fn, *args) -> dict:
+    """Bytes still allocated after fn returned, by the allocating file."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    fn(*args)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    by_file = sorted(after.compare_to(before, "filename"), key=lambda stat: -stat.size_diff)
+    return {"total": sum(stat.size_diff for stat in by_file),
+            "by_file": {os.path.basename(stat.traceback[0].filename): stat.size_diff for stat in by_file[:6]}}
+
+
+def chatbot_memory(mode: str, sessions: int, turns: int) -> dict:
+    os.environ["SESSION_LAST_TURN"] = mode
+    bot = ChatbotImplementation()
+    memory = retained(run_sessions, bot, sessions, turns)
+    bot.chat_log.close()
+    return {
+        "bytes_per_session": round(memory["total"] / sessions),
+        "total_mb": round(memory["total"] / 2 ** 20, 1),
+        "top_files_mb": {name: round(size / 2 ** 20, 1) for name, size in memory["by_file"].items()},
+        "sessions_kept": len(bot.sessions.cache)
+    }
+
+
+def state_memory(sessions: int) -> dict:
+    """The states without the last turn: the former dicts against SessionState with IntentFlags."""
+    flags = tuple(f"flag_{i}" for i in range(7))
+    quiz_answers = ["c) Cherry Picking", "b) Contradictory Evidence"]
+    states = []
+
+    def dicts():
+        states.extend({"hinting": 1, "hint_count": 2, "correct_answer": list(quiz_answers),
+                       "last_logging_info": None, "intent_flags": {flag: i % 2 == 0 for i, flag in enumerate(flags)}}
+                      for _ in range(sessions))
+
+    def slots():
+        states.extend(SessionState(1, 2, list(quiz_answers), IntentFlags(flags, 0b1010101)) for _ in range(sessions))
+
+    report = {}
+    for name, build in (("dict", dicts), ("slots", slots)):
+        states.clear()
+        report[f"{name}_bytes_per_session"] = round(retained(build)["total"] / sessions)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--turns", type=int, default=12)
+    args = parser.parse_args(argv)
+    os.environ["LOG_DIR"] = tempfile.mkdtemp()
+    os.environ.setdefault("SESSION_MAX_ENTRIES", str(2 * args.sessions))
+
+    report = {"sessions": args.sessions, "turns": args.turns, "state_only": state_memory(args.sessions)}
+    for mode in ("full", "delta"):
+        report[f"last_turn_{mode}"] = chatbot_memory(mode, args.sessions, args.turns)
+    full, delta = report["last_turn_full"]["total_mb"], report["last_turn_delta"]["total_mb"]
+    report["saved"] = round(1 - delta / full, 3) if full else None
+    print(json.dumps(report, indent=4))
+    return report
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    main()
@@ -0,0 +1,100 @@
+"""
+Microbenchmark of the SSE parsing of LLM streams.
+
+It replays the streams in data/tgi_streams.sse (generate_stream output in the TGI
+format) cut into network chunks in three ways: one event per chunk, several events
+per chunk and random chunk boundaries that split events. For each way it compares the
+old line splitting loop of _call_llm_generic with the incremental SSEParser. It reports
+the throughput and how many tokens each of them recovered.
+
+    python benchmarks/bench_sse.py [--repeat 200]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sse import stream_texts  # noqa: E402
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "tgi_streams.sse")
+
+
+def legacy_stream_texts(chunks):
+    # the parsing loop _call_llm_generic used before the SSEParser
+    texts = []
+    for chunk in chunks:
+        try:
+            chunk_utf8 = chunk.decode("utf-8")[5:]
+        except UnicodeDecodeError:
+            continue
+        for line in chunk_utf8.split("\n"):
+            if len(line.strip()) == 0:
+                continue
+            try:
+                texts.append(json.loads(line)["token"]["text"])
+            except Exception:
+                pass
+    return texts
+
+
+def event_chunks(stream: bytes):
+    return [event + b"\n\n" for event in stream.split(b"\n\n") if event]
+
+
+def grouped_chunks(stream: bytes, group: int = 4):
+    events = event_chunks(stream)
+    return [b"".join(events[i:i + group]) for i in range(0, len(events), group)]
+
+
+def random_chunks(stream: bytes, seed: int = 42, min_size: int = 16, max_size: int = 512):
+    rnd = random.Random(seed)
+    chunks = []
+    position = 0
+    while position < len(stream):
+        size = rnd.randint(min_size, max_size)
+        chunks.append(stream[position:position + size])
+        position += size
+    return chunks
+
+
+def measure(fn, chunks, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        texts = fn(chunks)
+    elapsed = time.perf_counter() - start
+    return texts, elapsed
+
+
+def run(repeat: int):
+    with open(DATA_FILE, "rb") as f:
+        stream = f.read()
+    expected = stream_texts(event_chunks(stream))
+    results = {}
+    for name, chunks in [("one_event_per_chunk", event_chunks(stream)),
+                         ("grouped_events", grouped_chunks(stream)),
+                         ("split_events", random_chunks(stream))]:
+        for parser_name, fn in [("legacy", legacy_stream_texts), ("sse_parser", stream_texts)]:
+            texts, elapsed = measure(fn, chunks, repeat)
+            results[f"{name}/{parser_name}"] = {
+                "chunks": len(chunks),
+                "tokens_recovered": len(texts),
+                "tokens_expected": len(expected),
+                "correct": texts == expected,
+                "mb_per_s": round(len(stream) * repeat / elapsed / 1e6, 2),
+                "us_per_token": round(elapsed / repeat / len(expected) * 1e6, 3)
+            }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    print(json.dumps(run(args.repeat), indent=4))
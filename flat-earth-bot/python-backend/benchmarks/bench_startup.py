@@ -0,0 +1,140 @@
+"""
+Cold start of the backend: the import time of the entry points from `python -X importtime`
+and the time from spawning a server until its /ready endpoint answers 200. Both are measured
+with the warm state (warm_state.py, built into a temporary file here) and without it, where
+the lexicon and the policy are read from their sources. Every import is measured --repeat
+times in a fresh interpreter, the report has the medians, the slowest imports of each entry
+point and whether the heavy optional modules were imported at all.
+
+    python benchmarks/bench_startup.py [--repeat 7] [--top 12] [--output benchmarks/data/startup_report.json]
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BACKEND_DIR)
+
+import warm_state  # noqa: E402
+from bench_server import free_port, start, wait_until_up  # noqa: E402
+
+ENTRY_POINTS = {
+    "chat_server": [sys.executable, "chat_server.py"],
+    "async_chat_server": [sys.executable, "-m", "uvicorn", "async_chat_server:app", "--port", "{port}"]
+}
+HEAVY_MODULES = ("flask", "numpy", "textblob", "requests", "httpx")
+
+
+def import_times(module: str, env) -> dict:
+    """The direct imports of the module -> cumulative µs, and the module itself, of one `python -X importtime`."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=BACKEND_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        # a module is listed after everything it imports, so a top level line closes its subtree
+        if depth == 0:
+            if name.strip() == module:
+                times[module] = int(cumulative)
+                return times
+            times = {}
+        elif depth == 1:
+            times[name.strip()] = int(cumulative)
+    raise RuntimeError(f"No import time of {module} in the output")
+
+
+def imported_modules(module: str, env) -> dict:
+    check = f"import sys, json, {module}; print(json.dumps({{m: m in sys.modules for m in {HEAVY_MODULES!r}}}))"
+    result = subprocess.run([sys.executable, "-c", check], cwd=BACKEND_DIR, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def import_report(module: str, env, repeat: int, top: int) -> dict:
+    runs = [import_times(module, env) for _ in range(repeat)]
+    medians = {name: statistics.median(run.get(name, 0) for run in runs) for name in runs[0] if name != module}
+    slowest = sorted(medians.items(), key=lambda item: -item[1])[:top]
+    return {
+        "import_ms": round(statistics.median(run[module] for run in runs) / 1000, 1),
+        "slowest_imports_ms": {name: round(us / 1000, 1) for name, us in slowest},
+        "imported": imported_modules(module, env)
+    }
+
+
+def time_to_ready(command, env, repeat: int) -> float:
+    """Median seconds from spawning the server until /ready answers 200."""
+    seconds = []
+    for _ in range(repeat):
+        port = free_port()
+        started = time.perf_counter()
+        server = start([part.format(port=port) for part in command], dict(env, PORT=str(port)))
+        try:
+            deadline = started + 60
+            while time.perf_counter() < deadline:
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=1) as response:
+                        if response.status == 200:
+                            break
+                except (urllib.error.URLError, ConnectionError):
+                    pass
+                time.sleep(0.01)
+            else:
+                raise RuntimeError(f"{command} did not get ready within 60 s")
+            seconds.append(time.perf_counter() - started)
+        finally:
+            server.terminate()
+            server.wait(timeout=60)
+    return round(statistics.median(seconds), 3)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--top", type=int, default=12, help="slowest direct imports per entry point")
+    parser.add_argument("--output", default=None, help="also write the report to this JSON file")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    warm_state_path = os.path.join(directory, "warm_state.pickle")
+    warm_state.build_warm_state(warm_state_path)
+    llm_port = free_port()
+    mock_llm = start([sys.executable, "benchmarks/mock_llm.py", "--port", str(llm_port)])
+    base_env = dict(os.environ, LLM_URL=f"http://127.0.0.1:{llm_port}/generate_stream", LOG_DIR=directory,
+                    PRODUCTION="1")
+    report = {"python": platform.python_version(), "cpus": os.cpu_count(), "repeat": args.repeat}
+    try:
+        wait_until_up(f"http://127.0.0.1:{llm_port}/health")
+        for mode, path in (("warm_state", warm_state_path), ("sources", os.path.join(directory, "missing.pickle"))):
+            env = dict(base_env, WARM_STATE_PATH=path)
+            report[mode] = {
+                name: dict(import_report(name, env, args.repeat, args.top),
+                           time_to_ready_s=time_to_ready(command, env, args.repeat))
+                for name, command in ENTRY_POINTS.items()
+            }
+    finally:
+        mock_llm.terminate()
+        mock_llm.wait(timeout=10)
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+            f.write("\n")
+    return report
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    main()
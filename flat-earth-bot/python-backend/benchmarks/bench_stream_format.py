@@ -0,0 +1,109 @@
+"""
+Bytes the browser receives per answer in the default and in the compact stream format
+(compact_stream.py). The answers are the streams in data/tgi_streams.sse with the header and
+the hint events of the backend, one LLM event per network chunk, arriving at --tokens-per-s.
+The compact format is measured with several flush intervals; the clock is simulated, so the
+numbers do not depend on the machine. Reported are the bytes (also gzipped, as nginx would
+send them), the number of events, the cost of the conversion and whether the text is the same.
+
+    python benchmarks/bench_stream_format.py [--tokens-per-s 30] [--flush-ms 0,50,100,250] [--repeat 200]
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from chatbot import NEWLINE_EVENT  # noqa: E402
+from compact_stream import CompactEncoder  # noqa: E402
+from sse import stream_texts  # noqa: E402
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "tgi_streams.sse")
+HINT = ("<br/> <span style=\"color:blue;\"><b><i> Hint: </i></b></span> <span style=\"color:green;\"><i>You can "
+        "observe cherry picking in my current response.</i></span>")
+
+
+def answers():
+    """The chunks of every answer in the default format, as create_generator_chain sends them."""
+    with open(DATA_FILE, "rb") as f:
+        events = [event + b"\n\n" for event in f.read().split(b"\n\n") if event]
+    streams = []
+    for event in events:
+        if b'"index":0,' in event:
+            streams.append([])
+        streams[-1].append(event)
+    hint_event = "data:" + json.dumps({"index": -1, "token": {"id": -1, "text": HINT, "logprob": 0.0, "special": False},
+                                       "generated_text": None, "details": None}) + "\n\n"
+    return [[b'header: {"dialog_success": false}\n\n'] + stream + [NEWLINE_EVENT, hint_event] for stream in streams]
+
+
+def answer_text(chunks) -> str:
+    # the text the browser shows; the newline event has a raw line break, so it is taken as it is
+    texts = []
+    for chunk in chunks:
+        if chunk == NEWLINE_EVENT:
+            texts.append("\n")
+        else:
+            texts.extend(stream_texts([chunk]))
+    return "".join(texts)
+
+
+def compact_text(chunks) -> str:
+    return "".join(json.loads(block[5:])["text"] for chunk in chunks for block in chunk.split(b"\n\n")
+                   if block.startswith(b'data:{"text"'))
+
+
+def encode(chunks, flush_seconds: float, tokens_per_s: float):
+    now = [0.0]
+    encoder = CompactEncoder(flush_seconds, clock=lambda: now[0])
+    output = []
+    for chunk in chunks:
+        output.extend(encoder.feed(chunk))
+        now[0] += 1 / tokens_per_s
+    output.extend(encoder.finish())
+    return output
+
+
+def sizes(chunks) -> dict:
+    data = b"".join(c.encode() if isinstance(c, str) else c for c in chunks)
+    return {"bytes": len(data), "gzip_bytes": len(gzip.compress(data)), "events": data.count(b"\n\n")}
+
+
+def run(tokens_per_s: float, flush_ms, repeat: int) -> dict:
+    streams = answers()
+    tokens = sum(len(stream) - 3 for stream in streams)
+    default = [sizes(stream) for stream in streams]
+    report = {"answers": len(streams), "tokens": tokens,
+              "default": {key: sum(s[key] for s in default) for key in default[0]}}
+    for ms in flush_ms:
+        encoded = [encode(stream, ms / 1000, tokens_per_s) for stream in streams]
+        compact = [sizes(chunks) for chunks in encoded]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for stream in streams:
+                encode(stream, ms / 1000, tokens_per_s)
+        elapsed = time.perf_counter() - start
+        totals = {key: sum(s[key] for s in compact) for key in compact[0]}
+        totals.update({
+            "bytes_saved": round(1 - totals["bytes"] / report["default"]["bytes"], 3),
+            "gzip_bytes_saved": round(1 - totals["gzip_bytes"] / report["default"]["gzip_bytes"], 3),
+            "us_per_token": round(elapsed / repeat / tokens * 1e6, 2),
+            "same_text": all(answer_text(stream) == compact_text(chunks) for stream, chunks in zip(streams, encoded))
+        })
+        report[f"compact_flush_{ms:g}ms"] = totals
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens-per-s", type=float, default=30, help="token rate of the simulated LLM")
+    parser.add_argument("--flush-ms", default="0,50,100,250", help="comma separated flush intervals")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    print(json.dumps(run(args.tokens_per_s, [float(ms) for ms in args.flush_ms.split(",")], args.repeat), indent=4))
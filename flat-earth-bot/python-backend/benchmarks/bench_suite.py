@@ -0,0 +1,374 @@
+"""
+Benchmark suite of the turn pipeline, without RASA and without an LLM server. The chatbot
+runs in process; its HTTP session gets a transport adapter that answers the RASA and LLM
+requests with the keyword rules of mock_rasa.py and the token events of mock_llm.py, so
+the requests, SSE and logging code paths are the real ones.
+
+    micro: build_dialog, get_prompt, get_sentiment_analysis_prompt, the SSE parsing of
+           _call_llm_generic and llm_stream_to_str, create_generator_chain (µs per call)
+    macro: whole get_answer turns of synthetic sessions with NLU example texts (ms per turn)
+
+The NLU and response caches are switched off, so every repeat does the same work. Every
+benchmark is warmed up first and reports the median over its repeats and their spread
+((max - min) / median), its noise. The garbage collector is off while a repeat is timed (as
+in timeit), and during the macro runs the chat log records are only collected; the writer
+thread gets them between the runs. Results are saved as JSON; compare flags every metric
+that got worse by more than the threshold or, if larger, the noise of the two runs, and
+exits with 1 if there is one.
+
+    python benchmarks/bench_suite.py run [--repeat 5] [--warmup 2] [--only micro|macro] [--sessions 20] [--turns 12]
+                                         [--cpu N] [--output results.json]
+    python benchmarks/bench_suite.py compare baseline.json results.json [--threshold 0.1]
+"""
+
+import argparse
+import gc
+import io
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from datetime import datetime
+from urllib.parse import urlparse
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BACKEND_DIR)
+
+# fixed before the chatbot modules read them
+os.environ.update({
+    "LOG_DIR": tempfile.mkdtemp(),
+    "LLM_URL": "http://llm.stub/generate_stream",
+    "RASA_NLU_URL": "http://rasa.stub/model/parse",
+    "NLU_CACHE_SIZE": "0",
+    "RESPONSE_CACHE_SIZE": "0",
+    "SESSION_STORE": "memory",
+    "SPECULATIVE_HINTS": "0"
+})
+
+import requests  # noqa: E402
+from requests.adapters import BaseAdapter  # noqa: E402
+from requests.structures import CaseInsensitiveDict  # noqa: E402
+
+from chatbot import llm_stream_to_str  # noqa: E402
+from chatbot_implementation import ChatbotImplementation  # noqa: E402
+from load_test import EXAMPLES_GLOB, load_sessions, percentile  # noqa: E402
+from mock_llm import answer_tokens, token_event  # noqa: E402
+from mock_rasa import KeywordIntentRules  # noqa: E402
+from nlu_data import load_nlu_examples  # noqa: E402
+from session_store import new_session_state  # noqa: E402
+
+SSE_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "tgi_streams.sse")
+LLM_PARAMETERS = {"max_new_tokens": 60}
+
+
+class StubBody:
+    """The raw body of a stub response, read chunk by chunk like a streamed urllib3 response."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def stream(self, chunk_size=None, decode_content=None):
+        yield from self.chunks
+
+    def read(self, amount=None, decode_content=None):
+        return b"".join(self.chunks)
+
+    def close(self):
+        pass
+
+
+class StubTransport(BaseAdapter):
+    """Answers /model/parse, the batch parse, /generate_stream and /health in process."""
+
+    def __init__(self, rules: KeywordIntentRules):
+        super().__init__()
+        self.rules = rules
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        path = urlparse(request.url).path
+        body = json.loads(request.body) if request.body else {}
+        if path == "/generate_stream":
+            tokens = answer_tokens(body["inputs"], body.get("parameters") or {})
+            chunks = [token_event(tokens, i) for i in range(len(tokens))]
+            content_type = "text/event-stream"
+        elif path == "/model/parse":
+            chunks, content_type = [json.dumps(self.rules.parse(body["text"])).encode()], "application/json"
+        elif path == "/webhooks/batch_parse/parse":
+            results = {"results": [self.rules.parse(text) for text in body["texts"]]}
+            chunks, content_type = [json.dumps(results).encode()], "application/json"
+        else:
+            chunks, content_type = [b"{}"], "application/json"
+        response = requests.Response()
+        response.status_code = 200
+        response.headers = CaseInsensitiveDict({"Content-Type": content_type})
+        response.encoding = "utf-8"
+        response.raw = StubBody(chunks)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+class DeferredChatLog:
+    """Collects the chat log records of a macro run, so that the writer thread does not run during it."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.records = []
+
+    def write(self, record):
+        self.records.append(dict(record))
+
+    def drain(self):
+        for record in self.records:
+            self.writer.write(record)
+        self.records.clear()
+        while not self.writer.queue.empty():
+            time.sleep(0.01)
+
+    def close(self):
+        self.drain()
+        self.writer.close()
+
+
+def create_chatbot() -> ChatbotImplementation:
+    chatbot = ChatbotImplementation()
+    transport = StubTransport(KeywordIntentRules(load_nlu_examples()))
+    chatbot.http.mount("http://llm.stub/", transport)
+    chatbot.http.mount("http://rasa.stub/", transport)
+    chatbot.chat_log = DeferredChatLog(chatbot.chat_log)
+    return chatbot
+
+
+def spread(values) -> float:
+    """(max - min) / median of the repeats, the noise of a metric."""
+    median = statistics.median(values)
+    return round((max(values) - min(values)) / median, 4) if median else 0.0
+
+
+def example_dialog(length: int = 20):
+    sessions = load_sessions(EXAMPLES_GLOB)
+    messages = [dict(message) for session in sessions for message in session["messages"]]
+    while len(messages) < length:
+        messages = messages + messages
+    return messages[:length - 1] + [{"sender": "User", "message": "Why do ships disappear behind the horizon?"}]
+
+
+def sse_streams():
+    with open(SSE_DATA, "rb") as f:
+        events = [event + b"\n\n" for event in f.read().split(b"\n\n") if event]
+    streams = []
+    for event in events:
+        if b'"index":0,' in event:
+            streams.append([])
+        streams[-1].append(event)
+    return streams
+
+
+def timed(functions: dict, repeat: int) -> dict:
+    """
+    Median and best µs per call of every function over the repeats, timeit style (autorange is the warm-up).
+    The repeats take turns, so that a slower phase of the machine affects every function and shows in the
+    noise, instead of making one function slower.
+    """
+    timers = {name: timeit.Timer(fn) for name, fn in functions.items()}
+    numbers = {name: timer.autorange()[0] for name, timer in timers.items()}
+    runs = {name: [] for name in functions}
+    for _ in range(repeat):
+        for name, timer in timers.items():
+            runs[name].append(timer.timeit(numbers[name]) / numbers[name] * 1e6)
+    return {name: {"median_us": round(statistics.median(runs[name]), 2), "best_us": round(min(runs[name]), 2),
+                   "calls": numbers[name], "noise": {"median_us": spread(runs[name])}}
+            for name in functions}
+
+
+def micro_benchmarks(chatbot: ChatbotImplementation, repeat: int) -> dict:
+    messages = example_dialog()
+    intent = {"name": "disagree_flat_earth", "confidence": 0.9}
+    state = new_session_state()
+    texts = [text for examples in load_nlu_examples().values() for text in examples][:200]
+    streams = sse_streams()
+    chunks = [chunk for stream in streams for chunk in stream]
+
+    def sentiment():
+        for text in texts:
+            chatbot.get_sentiment_analysis_prompt(text)
+
+    def call_llm_generic():
+        logging_info = chatbot.create_logging_info(messages, "bench-micro", LLM_PARAMETERS, None, "prompt", False, None)
+        answer = chatbot._call_llm_generic("The earth is flat.", LLM_PARAMETERS, logging_info, "bench", intent,
+                                           is_quiz=False, state=new_session_state())
+        return llm_stream_to_str(answer)
+
+    report = timed({
+        "build_dialog": lambda: chatbot.build_dialog(messages),
+        "get_prompt": lambda: chatbot.get_prompt(messages, intent, "bench-micro", state),
+        "get_sentiment_analysis_prompt": sentiment,
+        "sse_llm_stream_to_str": lambda: [llm_stream_to_str(iter(stream)) for stream in streams],
+        "sse_call_llm_generic": call_llm_generic,
+        "create_generator_chain": lambda: list(chatbot.create_generator_chain(False, iter(chunks)))
+    }, repeat)
+    report["get_sentiment_analysis_prompt"]["texts"] = len(texts)
+    report["sse_llm_stream_to_str"]["streams"] = len(streams)
+    report["create_generator_chain"]["chunks"] = len(chunks)
+    chatbot.chat_log.drain()
+    return report
+
+
+def replay(chatbot: ChatbotImplementation, sessions: int, turns: int, run: int):
+    """
+    Seconds of every get_answer turn of the sessions. The user messages are NLU examples, picked
+    the same way in every run, and a quiz question is answered with a, b or c.
+    """
+    rng = random.Random(1)
+    texts = [text for examples in load_nlu_examples().values() for text in examples]
+    seconds = []
+    for n in range(sessions):
+        session_id = f"bench-{run}-{n}"
+        messages = [{"sender": "Flat Earth Believer", "message": "I believe in flat earth"}]
+        for _ in range(turns):
+            quiz = "Provide answer to the quiz" in messages[-1]["message"]
+            messages.append({"sender": "User", "message": rng.choice("abc") if quiz else rng.choice(texts)})
+            start = time.perf_counter()
+            answer = llm_stream_to_str(chatbot.get_answer(list(messages), session_id, LLM_PARAMETERS, "bench"))
+            seconds.append(time.perf_counter() - start)
+            messages.append({"sender": "Flat Earth Believer", "message": answer})
+    return seconds
+
+
+def macro_run(chatbot: ChatbotImplementation, sessions: int, turns: int, run: int) -> dict:
+    """The metrics of one replay, without the garbage collector and the chat log writer."""
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        seconds = replay(chatbot, sessions, turns, run)
+        wall = time.perf_counter() - start
+    finally:
+        gc.enable()
+        chatbot.chat_log.drain()
+    return {"turn_ms_p50": percentile(seconds, 50) * 1000, "turn_ms_p95": percentile(seconds, 95) * 1000,
+            "turns_per_s": len(seconds) / wall}
+
+
+def macro_benchmarks(chatbot: ChatbotImplementation, repeat: int, warmup: int, sessions: int, turns: int) -> dict:
+    for run in range(warmup):
+        macro_run(chatbot, sessions, turns, -1 - run)
+    runs = [macro_run(chatbot, sessions, turns, run) for run in range(repeat)]
+    result = {"turns": sessions * turns * repeat}
+    for metric, digits in (("turn_ms_p50", 3), ("turn_ms_p95", 3), ("turns_per_s", 1)):
+        result[metric] = round(statistics.median(run[metric] for run in runs), digits)
+    result["noise"] = {metric: spread([run[metric] for run in runs]) for metric in runs[0]}
+    return {"get_answer": result}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    if args.cpu is not None:
+        # one core for the turns and their threads, the other processes of the machine run elsewhere
+        os.sched_setaffinity(0, {args.cpu})
+    chatbot = create_chatbot()
+    results = {
+        "meta": {"time": datetime.now().isoformat(timespec="seconds"), "commit": git_commit(),
+                 "python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+                 "cpu": args.cpu, "repeat": args.repeat, "warmup": args.warmup, "sessions": args.sessions,
+                 "turns": args.turns},
+        "benchmarks": {}
+    }
+    if args.only in (None, "micro"):
+        results["benchmarks"].update({f"micro.{name}": result
+                                      for name, result in micro_benchmarks(chatbot, args.repeat).items()})
+    if args.only in (None, "macro"):
+        results["benchmarks"].update({f"macro.{name}": result
+                                      for name, result in macro_benchmarks(chatbot, args.repeat, args.warmup,
+                                                                           args.sessions, args.turns).items()})
+    chatbot.chat_log.close()
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+            f.write("\n")
+    return results
+
+
+# metric -> True if a higher value is better; the other fields of a result are not compared.
+# All of them are medians over the repeats
+METRICS = {"median_us": False, "turn_ms_p50": False, "turn_ms_p95": False, "turns_per_s": True}
+
+
+def compare(baseline: dict, results: dict, threshold: float):
+    """
+    One row per metric of the benchmarks in both files: (benchmark, metric, baseline, new, change, band,
+    regressed). A change is a regression if it is worse than the band, the threshold or the larger noise
+    of the two runs, so a metric that varies by 30% between repeats does not fail at 10%.
+    """
+    rows = []
+    for name, result in results["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            if metric not in result or not base.get(metric):
+                continue
+            change = result[metric] / base[metric] - 1
+            band = max(threshold, base.get("noise", {}).get(metric, 0), result.get("noise", {}).get(metric, 0))
+            regressed = -change > band if higher_is_better else change > band
+            rows.append((name, metric, base[metric], result[metric], change, band, regressed))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--warmup", type=int, default=2, help="macro runs before the timed ones")
+    run_parser.add_argument("--only", choices=("micro", "macro"), default=None)
+    run_parser.add_argument("--sessions", type=int, default=20, help="sessions per macro run")
+    run_parser.add_argument("--turns", type=int, default=12, help="turns per macro session")
+    run_parser.add_argument("--cpu", type=int, default=None, help="pin the process to this CPU (Linux)")
+    run_parser.add_argument("--output", default=None, help="also write the results to this JSON file")
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="relative change that is a regression")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        run(args)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.results) as f:
+        results = json.load(f)
+    rows = compare(baseline, results, args.threshold)
+    output = io.StringIO()
+    for name, metric, base, new, change, band, regressed in rows:
+        output.write(f"{name:42} {metric:12} {base:>12} {new:>12} {change:+8.1%} ±{band:<6.1%}"
+                     f"{'  REGRESSION' if regressed else ''}\n")
+    print(output.getvalue(), end="")
+    regressions = sum(row[-1] for row in rows)
+    print(f"{regressions} of {len(rows)} metrics regressed by more than {args.threshold:.0%} or their noise")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""
+Load generator for the chat API. N concurrent users replay the sessions in examples/*.json
+against /api/chat. Every user message of an example is sent as one turn, with the earlier
+bot messages replaced by the answers the server actually gave. The report contains p50,
+p95 and p99 of the time to first token and of the whole response, the token rate and the
+error rate.
+
+Start the mock services and the backend, then run the load test:
+
+    python benchmarks/mock_llm.py --port 9000 --first-token-ms 200 --tokens-per-s 30 --tokens 60 &
+    python benchmarks/mock_rasa.py --port 5005 &
+    LLM_URL=http://localhost:9000/generate_stream PRODUCTION=1 python chat_server.py &
+    python benchmarks/load_test.py --url http://localhost:5000 --users 20 --duration 60
+"""
+
+import argparse
+import glob
+import http.client
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sse import SSEParser, token_text  # noqa: E402
+
+EXAMPLES_GLOB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "examples", "*.json")
+
+
+def load_sessions(pattern: str):
+    sessions = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path) as f:
+            example = json.load(f)
+        if "messages" in example:
+            sessions.append(example)
+    return sessions
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def distribution_ms(values):
+    return {f"p{p}": round(percentile(values, p) * 1000, 1) if values else None for p in (50, 95, 99)}
+
+
+class TurnResult:
+    def __init__(self):
+        self.status = None
+        self.error = None
+        self.ttft = None
+        self.duration = None
+        self.tokens = 0
+        self.text = []
+
+
+def run_turn(url, payload, timeout) -> TurnResult:
+    result = TurnResult()
+    parsed = urlparse(url)
+    connection_class = http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+    connection = connection_class(parsed.hostname, parsed.port, timeout=timeout)
+    start = time.perf_counter()
+    try:
+        connection.request("POST", parsed.path.rstrip("/") + "/api/chat", body=json.dumps(payload),
+                           headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        result.status = response.status
+        if response.status != 200:
+            result.error = f"HTTP {response.status}"
+            response.read()
+            return result
+        parser = SSEParser()
+        while True:
+            chunk = response.read1(65536)
+            if not chunk:
+                break
+            for event in parser.feed(chunk):
+                text = token_text(event)
+                if text is None:
+                    continue
+                result.text.append(text)
+                # the synthetic newline and hint events at the end are no LLM tokens
+                if b'"index":-1' in event.data or b'"index": -1' in event.data:
+                    continue
+                if result.ttft is None:
+                    result.ttft = time.perf_counter() - start
+                result.tokens += 1
+        result.duration = time.perf_counter() - start
+    except Exception as e:
+        result.error = type(e).__name__
+    finally:
+        connection.close()
+    return result
+
+
+class LoadTest:
+
+    def __init__(self, args):
+        self.args = args
+        self.sessions = load_sessions(args.examples)
+        self.results = []
+        self.lock = threading.Lock()
+        self.deadline = None
+        self.session_counter = itertools.count()
+
+    def user(self, user_id: int):
+        while time.monotonic() < self.deadline:
+            example = self.sessions[next(self.session_counter) % len(self.sessions)]
+            session_id = f"loadtest-{uuid.uuid4()}"
+            messages = []
+            recorded = example["messages"] * self.args.repeat_session
+            for message in recorded:
+                if time.monotonic() >= self.deadline:
+                    return
+                if message["sender"] != "User":
+                    if not messages or messages[-1]["sender"] == "User":
+                        messages.append(dict(message))
+                    continue
+                messages.append(dict(message))
+                payload = {
+                    "messages": messages,
+                    "session_id": session_id,
+                    "llm_parameters": example.get("llm_parameters", {"max_new_tokens": 100}),
+                    "chatbot": example.get("chatbot", "flat-earth-bot")
+                }
+                result = run_turn(self.args.url, payload, self.args.timeout)
+                with self.lock:
+                    self.results.append(result)
+                answer = "".join(result.text).split("<br/>")[0].strip()
+                messages.append({"sender": recorded[0]["sender"], "message": answer or "..."})
+
+    def run(self) -> dict:
+        self.deadline = time.monotonic() + self.args.duration
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self.user, args=(i,), daemon=True) for i in range(self.args.users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report(time.perf_counter() - start)
+
+    def report(self, wall_seconds: float) -> dict:
+        ok = [r for r in self.results if r.error is None]
+        errors = {}
+        for r in self.results:
+            if r.error is not None:
+                errors[r.error] = errors.get(r.error, 0) + 1
+        tokens = sum(r.tokens for r in ok)
+        stream_rates = [r.tokens / (r.duration - r.ttft) for r in ok
+                        if r.ttft is not None and r.tokens > 1 and r.duration > r.ttft]
+        return {
+            "url": self.args.url,
+            "users": self.args.users,
+            "duration_s": round(wall_seconds, 2),
+            "turns": len(self.results),
+            "turns_per_s": round(len(self.results) / wall_seconds, 2),
+            "error_rate": round(1 - len(ok) / len(self.results), 4) if self.results else None,
+            "errors": errors,
+            "ttft_ms": distribution_ms([r.ttft for r in ok if r.ttft is not None]),
+            "response_ms": distribution_ms([r.duration for r in ok]),
+            "tokens_per_s": round(tokens / wall_seconds, 1),
+            "stream_tokens_per_s_p50": round(percentile(stream_rates, 50), 1) if stream_rates else None
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:5000", help="base URL of the chat backend")
+    parser.add_argument("--users", type=int, default=10, help="concurrent users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run")
+    parser.add_argument("--examples", default=EXAMPLES_GLOB, help="glob of the session files to replay")
+    parser.add_argument("--repeat-session", type=int, default=1, help="replay the messages of a session this often")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", default=None, help="also write the report to this JSON file")
+    args = parser.parse_args(argv)
+
+    report = LoadTest(args).run()
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    return report
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    main()
@@ -0,0 +1,171 @@
+"""
+Stand-in for the TGI generate_stream endpoint of the LLM server, for benchmarks and load
+tests without a GPU. It streams a canned answer as SSE token events in the TGI format,
+with a configurable time to first token and token rate.
+
+It also measures how much of each prompt repeats the beginning of the previous prompt of
+the same session (the part a server-side prefix cache could reuse). Sessions are told
+apart by the llm_parameters field given with --cache-key-param, otherwise all prompts
+count as one session. GET /stats returns the numbers.
+
+    python benchmarks/mock_llm.py --port 9000 [--first-token-ms 200] [--tokens-per-s 30] [--tokens 60]
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWERS = [
+    "Look at the horizon, my friend! 🌊 It is always flat, no matter how high you fly.",
+    "NASA and the other agencies fake their pictures of the globe to hide the truth. 🤔",
+    "The sun is small and close, it circles above the flat earth like a spotlight. ☀️",
+]
+
+
+def common_prefix_length(a: str, b: str) -> int:
+    n = min(len(a), len(b))
+    if a[:n] == b[:n]:
+        return n
+    low, high = 0, n
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+class PrefixReuseTracker:
+
+    def __init__(self):
+        self.last_prompts = {}
+        self.requests = 0
+        self.prompt_chars = 0
+        self.reused_chars = 0
+        self._lock = threading.Lock()
+
+    def record(self, key: str, prompt: str) -> int:
+        with self._lock:
+            previous = self.last_prompts.get(key)
+            reused = common_prefix_length(previous, prompt) if previous is not None else 0
+            self.last_prompts[key] = prompt
+            self.requests += 1
+            self.prompt_chars += len(prompt)
+            self.reused_chars += reused
+            return reused
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "prompt_chars": self.prompt_chars,
+                "reused_chars": self.reused_chars,
+                "prefix_reuse_ratio": round(self.reused_chars / self.prompt_chars, 4) if self.prompt_chars else 0.0
+            }
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(self.server.tracker.stats())
+        elif self.path == "/health":
+            self.send_json({})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.path != "/generate_stream":
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        parameters = request.get("parameters") or {}
+        key = str(parameters.get(self.server.cache_key_param, "default")) if self.server.cache_key_param else "default"
+        self.server.tracker.record(key, request["inputs"])
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for event in self.server.token_events(request["inputs"], parameters):
+            self.write_chunk(event)
+        self.write_chunk(b"")
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def send_json(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cache_key_param: str = None, first_token_ms: float = 0, tokens_per_s: float = 0,
+                 tokens: int = None):
+        super().__init__(address, MockLLMHandler)
+        self.cache_key_param = cache_key_param
+        self.first_token_delay = first_token_ms / 1000
+        self.token_delay = 1 / tokens_per_s if tokens_per_s else 0
+        self.tokens = tokens
+        self.tracker = PrefixReuseTracker()
+
+    def token_events(self, prompt: str, parameters: dict):
+        tokens = answer_tokens(prompt, parameters, self.tokens)
+        if self.first_token_delay:
+            time.sleep(self.first_token_delay)
+        for i in range(len(tokens)):
+            if i and self.token_delay:
+                time.sleep(self.token_delay)
+            yield token_event(tokens, i)
+
+
+def answer_tokens(prompt: str, parameters: dict, tokens: int = None):
+    words = ANSWERS[len(prompt) % len(ANSWERS)].split(" ")
+    count = tokens or len(words)
+    if parameters.get("max_new_tokens"):
+        count = min(count, parameters["max_new_tokens"])
+    return [(" " if i else "") + words[i % len(words)] for i in range(count)]
+
+
+def token_event(tokens, i: int) -> bytes:
+    """The generate_stream event of the i-th token, the last one carries the generated text."""
+    event = {
+        "index": i,
+        "token": {"id": i, "text": tokens[i], "logprob": -0.1, "special": False},
+        "generated_text": "".join(tokens) if i == len(tokens) - 1 else None,
+        "details": None
+    }
+    return ("data:" + json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n\n").encode()
+
+
+def start_in_thread(port: int = 0, **kwargs) -> MockLLMServer:
+    server = MockLLMServer(("127.0.0.1", port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", 9000)))
+    parser.add_argument("--cache-key-param", default=None)
+    parser.add_argument("--first-token-ms", type=float, default=0, help="delay before the first token")
+    parser.add_argument("--tokens-per-s", type=float, default=0, help="token rate after the first token, 0 is unlimited")
+    parser.add_argument("--tokens", type=int, default=None, help="tokens per answer, capped by max_new_tokens")
+    args = parser.parse_args()
+    MockLLMServer(("0.0.0.0", args.port), cache_key_param=args.cache_key_param, first_token_ms=args.first_token_ms,
+                  tokens_per_s=args.tokens_per_s, tokens=args.tokens).serve_forever()
@@ -0,0 +1,142 @@
+"""
+Stand-in for the RASA NLU /model/parse endpoint, for benchmarks and load tests without a
+trained RASA model. Intents are chosen by keyword rules derived from rasa-nlu/data/nlu.yml:
+every word of the examples is weighted by how specific it is to an intent, and the intent
+with the highest summed weight wins. Texts that equal a training example get that intent
+with confidence 1. It also serves the batch endpoint of rasa-nlu/addons/batch_parse.py.
+
+The simulated RASA work runs one request at a time, like on the single event loop of RASA:
+--request-ms per HTTP request (parsing, routing, serializing) and --parse-ms per text. The
+batch endpoint of the addon parses every text on its own, so a batch costs one request
+plus --parse-ms for each of its texts.
+
+    python benchmarks/mock_rasa.py --port 5005 [--latency-ms 20] [--request-ms 1] [--parse-ms 1]
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from nlu_data import load_nlu_examples  # noqa: E402
+
+WORD = re.compile(r"[a-z']+")
+
+
+def words(text: str):
+    return WORD.findall(text.lower())
+
+
+class KeywordIntentRules:
+
+    def __init__(self, examples: dict, fallback_intent: str = "out_of_scope"):
+        self.fallback_intent = fallback_intent
+        self.exact = {}
+        counts = defaultdict(Counter)
+        for intent, texts in examples.items():
+            for text in texts:
+                self.exact[" ".join(words(text))] = intent
+                counts[intent].update(set(words(text)))
+        intents_per_word = Counter(word for counter in counts.values() for word in counter)
+        self.weights = defaultdict(dict)
+        for intent, counter in counts.items():
+            total = len(examples[intent])
+            for word, count in counter.items():
+                # frequent in this intent and rare in the others
+                self.weights[word][intent] = count / total * math.log(1 + len(counts) / intents_per_word[word])
+
+    def parse(self, text: str) -> dict:
+        normalized = " ".join(words(text))
+        if normalized in self.exact:
+            ranking = [(self.exact[normalized], 1.0)]
+        else:
+            scores = Counter()
+            for word in set(words(text)):
+                for intent, weight in self.weights.get(word, {}).items():
+                    scores[intent] += weight
+            total = sum(scores.values())
+            ranking = [(intent, score / total) for intent, score in scores.most_common(10)] if total else []
+        if not ranking:
+            ranking = [(self.fallback_intent, 1.0)]
+        return {
+            "text": text,
+            "intent": {"name": ranking[0][0], "confidence": round(ranking[0][1], 4)},
+            "entities": [],
+            "intent_ranking": [{"name": name, "confidence": round(confidence, 4)} for name, confidence in ranking]
+        }
+
+
+class MockRasaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, without this every keep-alive response waits for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if self.path not in ("/model/parse", "/webhooks/batch_parse/parse"):
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests += 1
+        texts = 1 if self.path == "/model/parse" else len(request["texts"])
+        self.server.texts += texts
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        work = self.server.request_seconds + texts * self.server.parse_seconds
+        if work:
+            # RASA handles requests on one event loop, this part of a request does not run in parallel
+            with self.server.serial_lock:
+                time.sleep(work)
+        if self.path == "/model/parse":
+            body = json.dumps(self.server.rules.parse(request["text"])).encode()
+        else:
+            body = json.dumps({"results": [self.server.rules.parse(text) for text in request["texts"]]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockRasaServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, nlu_data_path: str = None, latency_ms: float = 0, request_ms: float = 0,
+                 parse_ms: float = 0):
+        super().__init__(address, MockRasaHandler)
+        self.rules = KeywordIntentRules(load_nlu_examples(nlu_data_path))
+        self.latency = latency_ms / 1000
+        self.request_seconds = request_ms / 1000
+        self.parse_seconds = parse_ms / 1000
+        self.serial_lock = threading.Lock()
+        self.requests = 0
+        self.texts = 0
+
+
+def start_in_thread(port: int = 0, **kwargs) -> MockRasaServer:
+    server = MockRasaServer(("127.0.0.1", port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", 5005)))
+    parser.add_argument("--nlu-data", default=None, help="path of nlu.yml, defaults to rasa-nlu/data/nlu.yml")
+    parser.add_argument("--latency-ms", type=float, default=0, help="delay of every request")
+    parser.add_argument("--request-ms", type=float, default=0, help="work per request, done one request at a time")
+    parser.add_argument("--parse-ms", type=float, default=0, help="work per parsed text, done one request at a time")
+    args = parser.parse_args()
+    MockRasaServer(("0.0.0.0", args.port), nlu_data_path=args.nlu_data, latency_ms=args.latency_ms,
+                   request_ms=args.request_ms, parse_ms=args.parse_ms).serve_forever()
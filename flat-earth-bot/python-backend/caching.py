@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class TTLCache:
+    """
+    Thread safe LRU cache whose entries also expire after ttl seconds. It is bounded by
+    the number of entries and optionally by the summed size of the values (sizeof).
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None, max_bytes: Optional[int] = None,
+                 sizeof: Callable[[Any], int] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at, size = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        size = self.sizeof(value) if self.sizeof is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires_at, size)
+            self.size_bytes += size
+            self._evict()
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value = self._entries[key][0]
+            self._remove(key)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and (entry[1] is None or entry[1] > time.monotonic())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+    def _remove(self, key: Hashable):
+        _, _, size = self._entries.pop(key)
+        self.size_bytes -= size
+
+    def _evict(self):
+        now = time.monotonic()
+        # expired entries are dropped first, then the least recently used ones
+        while self._entries:
+            key, (_, expires_at, _) = next(iter(self._entries.items()))
+            over_limit = len(self._entries) > self.max_entries or \
+                (self.max_bytes is not None and self.size_bytes > self.max_bytes)
+            expired = expires_at is not None and expires_at <= now
+            if not over_limit and not expired:
+                break
+            self._remove(key)
+            self.evictions += 1
@@ -0,0 +1,516 @@
+"""
+Offline analytics over the chat log (logs/chat_log.text and its rotated files), for logs in
+both the "full" and the "delta" mode of chat_logger.py. The logs of gunicorn workers
+(logs/chat_log.<pid>.text) are read as well and merged by the time of their records.
+
+`build` reads the log in one streaming pass (memory-mapped, one line at a time) and writes a
+columnar store: one .npy file per column of the turns and of the messages, which numpy maps
+into memory instead of reading. The history a record repeats from earlier turns of its
+session is stored only once. The turns of a session are stored next to each other and
+sessions/turn_start.npy holds the row of its first turn. `query` answers the usual questions from the store.
+
+    python chat_log_analytics.py build logs/chat_log.text logs/analytics
+    python chat_log_analytics.py query logs/analytics [--path-length 3]
+"""
+
+import argparse
+import glob
+import gzip
+import heapq
+import itertools
+import json
+import logging
+import math
+import mmap
+import os
+import time
+from array import array
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+STORE_VERSION = 1
+
+# array typecodes, numpy reads them as the same dtypes
+TURN_COLUMNS = {
+    "session": "i",
+    "time": "d",
+    "kind": "b",
+    "user_intent": "h",
+    "intent_confidence": "f",
+    "answer_intent": "h",
+    "success": "b",
+    # -1 for turns that are no quiz answer or whose result is not in the log
+    "quiz_correct": "b",
+    "aborted": "b",
+    "superseded": "b",
+    "llm_error": "b",
+    "replay": "b",
+    "first_token_ms": "d",
+    "stream_ms": "d",
+    "pipeline_ms": "d",
+    "nlu_ms": "d",
+    "messages_offset": "i",
+    "messages_end": "i",
+    "response_start": "q",
+    "response_length": "i",
+    "source": "h",
+    "source_offset": "q"
+}
+MESSAGE_COLUMNS = {
+    "session": "i",
+    "turn": "i",
+    "position": "i",
+    "sender": "b",
+    "start": "q",
+    "length": "i"
+}
+DICTIONARIES = ("session", "kind", "intent", "sender")
+LATENCY_COLUMNS = ("first_token_ms", "stream_ms", "pipeline_ms", "nlu_ms")
+# the turns that are part of the dialog, quiz turns are logged with success True
+DIALOG_KINDS = ("dialog", "closure")
+
+
+def log_files(path: str) -> List[str]:
+    """The log and its rotated (and maybe compressed) files, oldest first."""
+    rotated = sorted(glob.glob(glob.escape(path) + ".*"))
+    # a rotated file is removed once its .gz is complete
+    rotated = [f for f in rotated if not (f.endswith(".gz") and f[:-3] in rotated)]
+    return rotated + ([path] if os.path.exists(path) else [])
+
+
+def log_streams(path: str) -> List[List[str]]:
+    """The files of every process that wrote the log (see chat_logger.chat_log_path), each oldest first."""
+    root, extension = os.path.splitext(path)
+    process_logs = sorted(glob.glob(glob.escape(root) + ".*" + glob.escape(extension)))
+    return [files for files in (log_files(p) for p in [path] + process_logs) if files]
+
+
+def read_lines(path: str) -> Iterator[Tuple[int, bytes]]:
+    """The lines of a log file with their offsets. Plain files are memory-mapped, not read into memory."""
+    if path.endswith(".gz"):
+        offset = 0
+        with gzip.open(path, "rb") as f:
+            for line in f:
+                yield offset, line
+                offset += len(line)
+        return
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            size = len(mm)
+            while start < size:
+                end = mm.find(b"\n", start)
+                if end == -1:
+                    end = size
+                yield start, mm[start:end]
+                start = end + 1
+
+
+def parse_time(value: Optional[str]) -> float:
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def record_time(item: Tuple[Dict, int, int]) -> float:
+    timestamp = parse_time(item[0].get("time"))
+    return 0.0 if math.isnan(timestamp) else timestamp
+
+
+def number(value) -> float:
+    return float(value) if value is not None else math.nan
+
+
+def infer_kind(record: Dict, last_user_message: Optional[str]) -> Optional[str]:
+    """The turn kind of records that were logged before it was part of the log."""
+    # see Chatbot.is_quiz_answer
+    if last_user_message in ("a", "b", "c"):
+        return "quiz_answer"
+    prompt = record.get("prompt")
+    if prompt is None:
+        return None
+    if "quick quiz to test your skills" in prompt:
+        return "quiz"
+    if prompt.lstrip().startswith("The conversation has come to an end."):
+        return "closure"
+    return "dialog"
+
+
+def infer_quiz_correct(record: Dict) -> Optional[bool]:
+    prompt = record.get("prompt")
+    if prompt is None:
+        return None
+    if "Hurray thats right" in prompt:
+        return True
+    if "Sorry Your answer is wrong" in prompt:
+        return False
+    return None
+
+
+class Dictionary:
+    """Codes of the string values of a column, -1 is None."""
+
+    def __init__(self):
+        self.codes: Dict[str, int] = {}
+        self.values: List[str] = []
+
+    def code(self, value: Optional[str]) -> int:
+        if value is None:
+            return -1
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class StoreBuilder:
+    """Collects the columns in typed arrays during the pass, the texts go straight to texts.bin."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.dictionaries = {name: Dictionary() for name in DICTIONARIES}
+        self.turns = {name: array(typecode) for name, typecode in TURN_COLUMNS.items()}
+        self.messages = {name: array(typecode) for name, typecode in MESSAGE_COLUMNS.items()}
+        # number of messages stored per session, to skip the history a record repeats
+        self.stored_messages: List[int] = []
+        self.texts = open(os.path.join(directory, "texts.bin"), "wb")
+        self.text_bytes = 0
+        self.sources: List[Dict] = []
+        self.stats = Counter()
+
+    def add_file(self, path: str):
+        for record, source, offset in self.read_records(path):
+            self.add(record, source, offset)
+
+    def add_streams(self, streams: List[List[str]]):
+        """Adds the files of several processes, merged by the time of the records."""
+        if len(streams) == 1:
+            for path in streams[0]:
+                self.add_file(path)
+            return
+        records = (itertools.chain.from_iterable(self.read_records(path) for path in files) for files in streams)
+        for record, source, offset in heapq.merge(*records, key=record_time):
+            self.add(record, source, offset)
+
+    def read_records(self, path: str) -> Iterator[Tuple[Dict, int, int]]:
+        source = len(self.sources)
+        self.sources.append({"path": path, "bytes": os.path.getsize(path)})
+        for offset, line in read_lines(path):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # e.g. the last line of a file that was cut off by a crash
+                self.stats["invalid_lines"] += 1
+                continue
+            yield record, source, offset
+
+    def add_text(self, text: str) -> Tuple[int, int]:
+        data = text.encode("utf-8")
+        start = self.text_bytes
+        self.texts.write(data)
+        self.text_bytes += len(data)
+        return start, len(data)
+
+    def add(self, record: Dict, source: int = -1, offset: int = -1):
+        session = self.dictionaries["session"].code(record.get("session_id") or "")
+        if session == len(self.stored_messages):
+            self.stored_messages.append(0)
+        row = len(self.turns["session"])
+        messages = record.get("messages") or []
+        stored = self.stored_messages[session]
+        if "messages_offset" in record:
+            # delta mode: the record holds the messages from messages_offset on
+            messages_offset = record["messages_offset"]
+        else:
+            # full mode: the same rule the delta mode of the writer uses
+            messages_offset = stored if stored <= len(messages) else 0
+            messages = messages[messages_offset:]
+            self.stats["history_messages_skipped"] += messages_offset
+        messages_end = messages_offset + len(messages)
+        # after a shorter history (a new conversation with the same session id) the messages of a position
+        # are stored again, history() takes the latest ones
+        for position, message in enumerate(messages, messages_offset):
+            start, length = self.add_text(message.get("message") or "")
+            self._append(self.messages, session=session, turn=row, position=position,
+                         sender=self.dictionaries["sender"].code(message.get("sender")), start=start, length=length)
+        self.stored_messages[session] = messages_end
+        self.stats["messages_stored"] += len(messages)
+
+        last_user_message = None
+        if messages and messages[-1].get("sender") == "User":
+            last_user_message = messages[-1].get("message")
+        kind = record.get("kind") or infer_kind(record, last_user_message)
+        quiz_correct = record.get("quiz_correct")
+        if quiz_correct is None and kind == "quiz_answer":
+            quiz_correct = infer_quiz_correct(record)
+        nlu_intent = (record.get("nlu_response") or {}).get("intent") or {}
+        latency = record.get("latency_ms") or {}
+        pipeline = record.get("pipeline") or {}
+        response_start, response_length = self.add_text(record.get("llm_response") or "")
+        self._append(
+            self.turns,
+            session=session,
+            time=parse_time(record.get("time")),
+            kind=self.dictionaries["kind"].code(kind),
+            user_intent=self.dictionaries["intent"].code(nlu_intent.get("name")),
+            intent_confidence=number(nlu_intent.get("confidence")),
+            answer_intent=self.dictionaries["intent"].code(record.get("answer_intent")),
+            success=1 if record.get("success") else 0,
+            quiz_correct=-1 if quiz_correct is None else int(quiz_correct),
+            aborted=int(bool(record.get("aborted"))),
+            superseded=int(bool(record.get("superseded"))),
+            llm_error=int("llm_error" in record),
+            replay=int(record.get("response_cache") == "replay"),
+            first_token_ms=number(latency.get("first_token")),
+            stream_ms=number(latency.get("stream")),
+            pipeline_ms=number(pipeline.get("wall_ms")),
+            nlu_ms=number((pipeline.get("stages_ms") or {}).get("nlu")),
+            messages_offset=messages_offset,
+            messages_end=messages_end,
+            response_start=response_start,
+            response_length=response_length,
+            source=source,
+            source_offset=offset
+        )
+        self.stats["records"] += 1
+
+    @staticmethod
+    def _append(columns: Dict[str, array], **values):
+        for name, value in values.items():
+            columns[name].append(value)
+
+    def finish(self) -> Dict:
+        self.texts.close()
+        turns = {name: np.frombuffer(column, dtype=column.typecode) for name, column in self.turns.items()}
+        messages = {name: np.frombuffer(column, dtype=column.typecode) for name, column in self.messages.items()}
+        # the turns of a session next to each other, in the order they were logged
+        order = np.argsort(turns["session"], kind="stable")
+        new_row = np.empty_like(order, dtype=np.int32)
+        new_row[order] = np.arange(len(order), dtype=np.int32)
+        self._save("turns", {name: column[order] for name, column in turns.items()})
+        message_order = np.argsort(messages["session"], kind="stable")
+        messages = {name: column[message_order] for name, column in messages.items()}
+        messages["turn"] = new_row[messages["turn"]]
+        self._save("messages", messages)
+        session_count = len(self.dictionaries["session"].values)
+        session_turns = np.bincount(turns["session"][turns["session"] >= 0], minlength=session_count)
+        session_start = np.concatenate(([0], np.cumsum(session_turns)[:-1])) if session_count else session_turns
+        message_counts = np.bincount(messages["session"][messages["session"] >= 0], minlength=session_count)
+        self._save("sessions", {
+            "turn_start": session_start.astype(np.int64),
+            "turns": session_turns.astype(np.int32),
+            "message_start": (np.concatenate(([0], np.cumsum(message_counts)[:-1])) if session_count
+                              else message_counts).astype(np.int64),
+            "messages": message_counts.astype(np.int32)
+        })
+        meta = {
+            "version": STORE_VERSION,
+            "created": datetime.now().isoformat(),
+            "sources": self.sources,
+            "turns": len(order),
+            "messages": len(message_order),
+            "text_bytes": self.text_bytes,
+            "dictionaries": {name: dictionary.values for name, dictionary in self.dictionaries.items()},
+            "stats": dict(self.stats)
+        }
+        with open(os.path.join(self.directory, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        return meta
+
+    def _save(self, table: str, columns: Dict[str, np.ndarray]):
+        os.makedirs(os.path.join(self.directory, table), exist_ok=True)
+        for name, column in columns.items():
+            np.save(os.path.join(self.directory, table, f"{name}.npy"), column)
+
+
+def build_store(log_path: str, directory: str) -> Dict:
+    builder = StoreBuilder(directory)
+    builder.add_streams(log_streams(log_path))
+    return builder.finish()
+
+
+def distribution(values: np.ndarray) -> Dict:
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"count": int(len(values)), "mean": round(float(values.mean()), 1), "p50": round(float(p50), 1),
+            "p95": round(float(p95), 1), "p99": round(float(p99), 1)}
+
+
+class ChatLogStore:
+    """A store written by build_store. The columns are memory-mapped, loading it is cheap."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != STORE_VERSION:
+            raise ValueError(f"{directory} is a store of version {self.meta['version']}, rebuild it")
+        self.turns = self._load("turns", TURN_COLUMNS)
+        self.messages = self._load("messages", MESSAGE_COLUMNS)
+        self.sessions = self._load("sessions", ("turn_start", "turns", "message_start", "messages"))
+        self.dictionaries = self.meta["dictionaries"]
+        self.session_codes = {session_id: code for code, session_id in enumerate(self.dictionaries["session"])}
+        texts_path = os.path.join(directory, "texts.bin")
+        self.texts = np.memmap(texts_path, dtype=np.uint8, mode="r") if os.path.getsize(texts_path) else b""
+
+    def _load(self, table: str, columns) -> Dict[str, np.ndarray]:
+        return {name: np.load(os.path.join(self.directory, table, f"{name}.npy"), mmap_mode="r") for name in columns}
+
+    def code(self, dictionary: str, value: str) -> int:
+        values = self.dictionaries[dictionary]
+        return values.index(value) if value in values else -2
+
+    def text(self, start: int, length: int) -> str:
+        return bytes(self.texts[start:start + length]).decode("utf-8")
+
+    def session_rows(self, session_id: str) -> range:
+        """The rows of the turns of a session."""
+        code = self.session_codes.get(session_id)
+        if code is None:
+            return range(0)
+        start = int(self.sessions["turn_start"][code])
+        return range(start, start + int(self.sessions["turns"][code]))
+
+    def history(self, row: int) -> List[Dict]:
+        """The messages of the turn in the given row, as they were sent to the backend."""
+        session = int(self.turns["session"][row])
+        start = int(self.sessions["message_start"][session])
+        end = start + int(self.sessions["messages"][session])
+        messages = {}
+        senders = self.dictionaries["sender"]
+        for i in range(start, end):
+            if self.messages["turn"][i] > row:
+                break
+            sender = int(self.messages["sender"][i])
+            messages[int(self.messages["position"][i])] = {
+                "sender": senders[sender] if sender >= 0 else None,
+                "message": self.text(int(self.messages["start"][i]), int(self.messages["length"][i]))
+            }
+        return [messages[p] for p in range(int(self.turns["messages_end"][row])) if p in messages]
+
+    def response(self, row: int) -> str:
+        return self.text(int(self.turns["response_start"][row]), int(self.turns["response_length"][row]))
+
+    def record(self, row: int) -> Dict:
+        """The original log record of a turn, read from the log file at its offset."""
+        source = self.meta["sources"][int(self.turns["source"][row])]["path"]
+        opener = gzip.open if source.endswith(".gz") else open
+        with opener(source, "rb") as f:
+            f.seek(int(self.turns["source_offset"][row]))
+            return json.loads(f.readline())
+
+    def _kind_mask(self, kinds) -> np.ndarray:
+        codes = [self.code("kind", kind) for kind in kinds]
+        return np.isin(self.turns["kind"], codes)
+
+    def success_by_intent_path(self, length: int = 3, min_sessions: int = 1) -> List[Dict]:
+        """
+        Success rate of the sessions by the first `length` user intents of their dialog (repeated intents count once).
+        A session is successful if one of its dialog turns was.
+        """
+        dialog = self._kind_mask(DIALOG_KINDS) | (self.turns["kind"] == -1)
+        session_success = np.zeros(len(self.dictionaries["session"]), dtype=bool)
+        successful = self.turns["session"][dialog & (self.turns["success"] == 1)]
+        session_success[successful[successful >= 0]] = True
+        intents = self.dictionaries["intent"]
+        paths = {}
+        rows = np.flatnonzero(dialog & (self.turns["user_intent"] >= 0))
+        for session, intent in zip(self.turns["session"][rows].tolist(), self.turns["user_intent"][rows].tolist()):
+            path = paths.setdefault(session, [])
+            if len(path) < length and (not path or path[-1] != intent):
+                path.append(intent)
+        totals = Counter()
+        successes = Counter()
+        for session, path in paths.items():
+            path = tuple(path)
+            totals[path] += 1
+            successes[path] += int(session_success[session])
+        return [{"path": [intents[i] for i in path], "sessions": sessions,
+                 "success_rate": round(successes[path] / sessions, 4)}
+                for path, sessions in totals.most_common() if sessions >= min_sessions]
+
+    def quiz_accuracy(self) -> Dict:
+        """Share of correct quiz answers, overall and by question (the first, second, ... answer of a session)."""
+        answers = self._kind_mask(["quiz_answer"])
+        known = answers & (self.turns["quiz_correct"] >= 0)
+        rows = np.flatnonzero(known)
+        by_question = {}
+        question = 0
+        previous = None
+        for session, correct in zip(self.turns["session"][rows].tolist(), self.turns["quiz_correct"][rows].tolist()):
+            question = question + 1 if session == previous else 1
+            previous = session
+            counts = by_question.setdefault(question, [0, 0])
+            counts[0] += correct
+            counts[1] += 1
+        total = int(known.sum())
+        return {
+            "answers": total,
+            "unknown": int(answers.sum()) - total,
+            "accuracy": round(float(self.turns["quiz_correct"][rows].mean()), 4) if total else None,
+            "by_question": {str(q): {"answers": n, "accuracy": round(c / n, 4)} for q, (c, n) in sorted(by_question.items())}
+        }
+
+    def latency(self) -> Dict:
+        """Latency distributions in ms, overall and the time to first token by turn kind."""
+        report = {column: distribution(np.asarray(self.turns[column], dtype=np.float64)) for column in LATENCY_COLUMNS}
+        first_token = np.asarray(self.turns["first_token_ms"], dtype=np.float64)
+        report["first_token_ms_by_kind"] = {kind: distribution(first_token[self.turns["kind"] == code])
+                                            for code, kind in enumerate(self.dictionaries["kind"])}
+        return report
+
+    def summary(self) -> Dict:
+        return {
+            "turns": self.meta["turns"],
+            "sessions": len(self.dictionaries["session"]),
+            "aborted": int(self.turns["aborted"].sum()),
+            "superseded": int(self.turns["superseded"].sum()),
+            "llm_errors": int(self.turns["llm_error"].sum()),
+            "replayed": int(self.turns["replay"].sum())
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline analytics over the chat log")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="build the store from the log and its rotated files")
+    build.add_argument("log", nargs="?", default=os.path.join(os.getenv("LOG_DIR", "logs"), "chat_log.text"))
+    build.add_argument("store", nargs="?", default=os.path.join(os.getenv("LOG_DIR", "logs"), "analytics"))
+    query = commands.add_parser("query", help="success by intent path, quiz accuracy and latencies")
+    query.add_argument("store", nargs="?", default=os.path.join(os.getenv("LOG_DIR", "logs"), "analytics"))
+    query.add_argument("--path-length", type=int, default=3, help="number of user intents of a path")
+    query.add_argument("--min-sessions", type=int, default=1, help="leave out paths with fewer sessions")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        start = time.perf_counter()
+        meta = build_store(args.log, args.store)
+        logging.info(f"Built {args.store} from {len(meta['sources'])} files in {time.perf_counter() - start:.1f} s")
+        print(json.dumps({"turns": meta["turns"], "messages": meta["messages"], "stats": meta["stats"]}, indent=4))
+        return meta
+    store = ChatLogStore(args.store)
+    report = {
+        "summary": store.summary(),
+        "success_by_intent_path": store.success_by_intent_path(args.path_length, args.min_sessions),
+        "quiz_accuracy": store.quiz_accuracy(),
+        "latency_ms": store.latency()
+    }
+    print(json.dumps(report, indent=4))
+    return report
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    main()
@@ -0,0 +1,201 @@
+"""
+Background writer for the conversation log (one JSON line per turn).
+
+Request threads only put the record into a bounded queue. A writer thread serializes the
+records, writes them in batches, fsyncs periodically and rotates the file by size and/or
+age, optionally compressing rotated files with gzip.
+
+In "delta" mode a record only holds the messages that were not logged before for its
+session (messages_offset tells how many came before them) and a hash of the prompt instead
+of the prompt itself, so the log grows linearly with the conversation.
+"""
+
+import atexit
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+import metrics
+from caching import TTLCache
+
+_STOP = object()
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+def delta_record(record: Dict, offset: int) -> Dict:
+    """The record with only the messages after the first offset ones and a hash instead of the prompt."""
+    record = dict(record)
+    messages = record.get("messages") or []
+    if offset > len(messages):
+        # the history changed (e.g. a new conversation with the same session id), keep it completely
+        offset = 0
+    record["messages_offset"] = offset
+    record["messages"] = messages[offset:]
+    if record.get("prompt") is not None:
+        record["prompt_sha256"] = prompt_hash(record.pop("prompt"))
+    return record
+
+
+class ChatLogWriter:
+
+    def __init__(self, path: str, mode: str = "full", queue_size: int = 10000, batch_size: int = 256,
+                 flush_interval: float = 0.5, fsync_interval: float = 5.0, max_bytes: Optional[int] = None,
+                 rotate_interval: Optional[float] = None, compress: bool = False, put_timeout: float = 0.5):
+        if mode not in ("full", "delta"):
+            raise ValueError(f"Unknown chat log mode {mode}, use full or delta")
+        self.path = path
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+        self.put_timeout = put_timeout
+        self.dropped = 0
+        self.written = 0
+        # number of messages already logged per session, for the delta mode
+        self.logged_messages = TTLCache(max_entries=100000, ttl=24 * 3600)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.file = None
+        self.opened_at = None
+        self.last_fsync = time.monotonic()
+        self.thread = threading.Thread(target=self._run, name="chat-log-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, record: Dict):
+        # a snapshot: the caller keeps the dict (e.g. as the last turn of the session) and may still change it
+        # while the writer thread serializes the copy, the nested values are not changed after logging
+        try:
+            self.queue.put(dict(record), timeout=self.put_timeout)
+        except queue.Full:
+            self.dropped += 1
+            metrics.CHAT_LOG_DROPPED.inc()
+            logging.error(f"Chat log queue is full, dropped a record of session {record.get('session_id')}")
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join(timeout=10)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                self._maybe_fsync()
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stop = True
+                batch = [record for record in batch if record is not _STOP]
+            try:
+                with metrics.stage("log_batch_write"):
+                    self._write_batch(batch)
+            except Exception as e:
+                logging.error("Could not write the chat log")
+                logging.exception(e)
+        if self.file is not None:
+            self._fsync()
+            self.file.close()
+            self.file = None
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        lines = []
+        for record in batch:
+            if self.mode == "delta":
+                record = self._to_delta(record)
+            lines.append(json.dumps(record) + "\n")
+        if self.file is None:
+            self._open()
+        elif self._should_rotate():
+            self._rotate()
+        self.file.write("".join(lines))
+        self.file.flush()
+        self.written += len(lines)
+        self._maybe_fsync()
+
+    def _to_delta(self, record: Dict) -> Dict:
+        session_id = record.get("session_id")
+        record = delta_record(record, self.logged_messages.get(session_id, 0))
+        self.logged_messages.set(session_id, record["messages_offset"] + len(record["messages"]))
+        return record
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.opened_at = time.time()
+
+    def _should_rotate(self) -> bool:
+        if self.max_bytes is not None and self.file.tell() >= self.max_bytes:
+            return True
+        return self.rotate_interval is not None and time.time() - self.opened_at >= self.rotate_interval
+
+    def _rotate(self):
+        self._fsync()
+        self.file.close()
+        rotated = f"{self.path}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+        os.rename(self.path, rotated)
+        if self.compress:
+            threading.Thread(target=compress_file, args=(rotated,), name="chat-log-compress", daemon=True).start()
+        self._open()
+
+    def _maybe_fsync(self):
+        if self.file is not None and time.monotonic() - self.last_fsync >= self.fsync_interval:
+            self._fsync()
+
+    def _fsync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_fsync = time.monotonic()
+
+
+def compress_file(path: str):
+    try:
+        with open(path, "rb") as source, gzip.open(path + ".gz", "wb") as target:
+            shutil.copyfileobj(source, target)
+        os.remove(path)
+    except Exception as e:
+        logging.error(f"Could not compress the rotated chat log {path}")
+        logging.exception(e)
+
+
+def chat_log_path(logdir: str, process: Optional[str] = None) -> str:
+    """logs/chat_log.text, or logs/chat_log.<process>.text for one of several processes writing the log."""
+    return os.path.join(logdir, f"chat_log.{process}.text" if process else "chat_log.text")
+
+
+def create_chat_log_writer(logdir: str) -> ChatLogWriter:
+    max_bytes = os.getenv("CHAT_LOG_MAX_BYTES")
+    rotate_interval = os.getenv("CHAT_LOG_ROTATE_SECONDS")
+    return ChatLogWriter(
+        # every gunicorn worker writes and rotates its own file, see gunicorn.conf.py
+        chat_log_path(logdir, os.getenv("CHAT_LOG_PROCESS")),
+        mode=os.getenv("CHAT_LOG_MODE", "full"),
+        queue_size=int(os.getenv("CHAT_LOG_QUEUE_SIZE", 10000)),
+        fsync_interval=float(os.getenv("CHAT_LOG_FSYNC_SECONDS", 5)),
+        max_bytes=int(max_bytes) if max_bytes else None,
+        rotate_interval=float(rotate_interval) if rotate_interval else None,
+        compress=int(os.getenv("CHAT_LOG_COMPRESS", 0)) == 1
+    )
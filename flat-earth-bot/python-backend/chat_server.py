@@ -1,43 +1,63 @@
-from flask import Flask, request
-import requests
-import json
+"""
+Flask entry point. `python chat_server.py` runs the single process development server.
+In production gunicorn loads create_app() with the settings in gunicorn.conf.py: the
+read-only tables are preloaded once in the master process and every worker builds its
+own chatbot after the fork.
+"""
+
+import gc
 import logging
-from flask_cors import CORS, cross_origin
-from abc import ABC, abstractmethod
 import os
-from typing import Dict
-from datetime import datetime
+import threading
 
-from chatbot_implementation import ChatbotImplementation
-from chatbot import llm_stream_to_str
+from flask import Flask, current_app, jsonify, request
+from flask_cors import CORS, cross_origin
 
-def init_logging():
-    log_dir = "logs/"
-    if os.getenv("LOG_DIR") is not None:
-        log_dir = os.getenv("LOG_DIR")
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    logfile = os.path.join(log_dir, "technical_log.txt")
-
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(message)s",
-        handlers=[
-            logging.FileHandler(logfile),
-            logging.StreamHandler()
-        ]
-    )
+from chatbot import llm_stream_to_str
+from chatbot_implementation import ChatbotImplementation
+from admission import AdmissionRejected
+from compact_stream import FORMAT_HEADER, CompactStream, requested_flush_seconds
+import metrics
+from log_config import init_logging
+from sentiment import load_sentiment_lexicon
 
 init_logging()
 
-app = Flask(__name__)
-CORS(app)
+_chatbot_lock = threading.Lock()
+
+
+def preload():
+    """
+    Loads the read-only tables the chatbots of this process share (sentiment lexicon, intent
+    classifier, prompt texts) and moves everything allocated so far out of the reach of the
+    garbage collector, so forked workers keep sharing these pages copy-on-write.
+    """
+    load_sentiment_lexicon()
+    if int(os.getenv("EMBEDDED_NLU", 0)) == 1:
+        # numpy is only imported when the classifier is used
+        from intent_classifier import load_intent_classifier
+        load_intent_classifier()
+    gc.freeze()
+
+
+def init_chatbot(app: Flask):
+    """Builds the chatbot of this process. Its threads and sockets do not survive a fork, so gunicorn calls this in every worker."""
+    with _chatbot_lock:
+        if app.extensions.get("chatbot") is None:
+            app.extensions["chatbot"] = ChatbotImplementation()
+        chatbot = app.extensions["chatbot"]
+        if not chatbot.ready:
+            chatbot.warm_up()
+    return chatbot
+
+
+def get_chatbot():
+    return current_app.extensions.get("chatbot") or init_chatbot(current_app)
 
-chatbot = ChatbotImplementation()
 
 def get_generator():
     request_data = request.get_json()
-    generator = chatbot.get_answer(
+    generator = get_chatbot().get_answer(
         request_data["messages"],
         request_data["session_id"],
         request_data["llm_parameters"],
@@ -46,20 +66,56 @@ def get_generator():
     )
     return generator
 
-@app.route("/api/chat", methods=['POST'])
-@cross_origin()
+
 def chat():
+    flush_seconds = requested_flush_seconds(request.args, request.headers)
     generator = get_generator()
-    return app.response_class(generator, mimetype='application/json')
+    if flush_seconds is None:
+        return current_app.response_class(generator, mimetype='application/json')
+    return current_app.response_class(CompactStream(generator, flush_seconds), mimetype='application/json',
+                                      headers={FORMAT_HEADER: "compact"})
+
 
-@app.route("/api/chat_no_stream", methods=['POST'])
-@cross_origin()
 def chat_no_stream():
 
     generator = get_generator()
     response = llm_stream_to_str(generator)
     return response
 
-port = int(os.environ.get('PORT', 5000))
-production = int(os.environ.get('PRODUCTION', 0)) == 1
-app.run(debug=not production, host='0.0.0.0', port=port)
+
+def admission_rejected(e):
+    return e.body(), e.status, e.headers()
+
+
+def prometheus_metrics():
+    return current_app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def ready():
+    # no chatbot yet means the worker has not run init_chatbot, it would build one on the first request
+    chatbot = current_app.extensions.get("chatbot")
+    is_ready = chatbot is not None and chatbot.ready
+    return jsonify({"ready": is_ready}), 200 if is_ready else 503
+
+
+def create_app(chatbot=None) -> Flask:
+    """The Flask app. Without a chatbot, one is built on the first request or by init_chatbot."""
+    preload()
+    app = Flask(__name__)
+    CORS(app)
+    app.extensions["chatbot"] = chatbot
+    app.add_url_rule("/api/chat", view_func=cross_origin()(chat), methods=['POST'])
+    app.add_url_rule("/api/chat_no_stream", view_func=cross_origin()(chat_no_stream), methods=['POST'])
+    app.add_url_rule("/metrics", view_func=prometheus_metrics, methods=['GET'])
+    app.add_url_rule("/ready", view_func=ready, methods=['GET'])
+    app.register_error_handler(AdmissionRejected, admission_rejected)
+    return app
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get('PORT', 5000))
+    production = int(os.environ.get('PRODUCTION', 0)) == 1
+    app = create_app()
+    init_chatbot(app)
+    logging.info(f"Starting the development server on port {port}, use gunicorn -c gunicorn.conf.py in production")
+    app.run(debug=not production, host='0.0.0.0', port=port)
@@ -1,29 +1,84 @@
 import random
-from flask import Flask, request
 import requests
 import json
+import hashlib
 import logging
 from abc import ABC, abstractmethod
 import os
-from typing import Dict, List
-from datetime import datetime
+import time
+from urllib.parse import urljoin
+from typing import Dict, List, Optional
 from itertools import chain
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import metrics
 import prompts
+from admission import AdmittedStream, ThreadAdmissionController
+from dialog_policy import load_dialog_policy
+from hint_classifier import SpeculativeHintClassifier
+from llm_pool import LlmBackend, LlmBackendError, LlmPool, LlmUnavailable
+from nlu_batcher import NluBatcher
+from nlu_cache import NluCache
+from prompt_builder import PromptBuilder
+from response_cache import ResponseCache
+from turn_pipeline import TurnPipeline
+from session_store import compact_logging_info, create_session_store
+from chat_logger import create_chat_log_writer
+from sse import NEWLINE_EVENT, SSEParser, stream_texts, token_text
+
+LLM_UNAVAILABLE_MESSAGE = "Sorry, I can not answer right now. Please try again in a moment."
+
 
 class Chatbot(ABC):
     def __init__(self):
         self.rasa_nlu_url = os.getenv("RASA_NLU_URL", "http://localhost:5005/model/parse")
         self.logdir = os.getenv("LOG_DIR", "logs")
         os.makedirs(self.logdir, exist_ok=True)
-        self.logfile = None
-        self.last_logging_info = None
+        self.chat_log = create_chat_log_writer(self.logdir)
         self.successful_sessions = []
-        self.session_states = {}
-        self.max_prompt_length = 15000
+        self.sessions = create_session_store()
+        # "full" keeps the whole logging info of the last turn in the session (prompt and history), for debugging
+        self.last_turn_mode = os.getenv("SESSION_LAST_TURN", "delta")
+        if self.last_turn_mode not in ("full", "delta"):
+            raise ValueError(f"Unknown SESSION_LAST_TURN {self.last_turn_mode}, use full or delta")
+        self.dialog_policy = load_dialog_policy()
+        self.max_prompt_length = int(os.getenv("MAX_PROMPT_LENGTH", 15000))
+        self.prompt_builder = PromptBuilder(self.max_prompt_length, layout=os.getenv("PROMPT_LAYOUT", "default"))
+        # name of an llm_parameters field that carries a stable per session key, for LLM servers that
+        # use it to route requests to the node holding the prefix cache of the session
+        self.llm_cache_key_param = os.getenv("LLM_CACHE_KEY_PARAM")
         self.llm_url = os.getenv("LLM_URL", "http://mds-gpu-medinym.et.uni-magdeburg.de:9000/generate_stream")
-        self.hinting = 0
-        self.hint_count = 0
-        self.correct_answer = []
+        self.http = self.create_http_session()
+        self.nlu_cache = self.create_nlu_cache()
+        self.rasa_nlu_batch_url = os.getenv("RASA_NLU_BATCH_URL", urljoin(self.rasa_nlu_url, "/webhooks/batch_parse/parse"))
+        self.nlu_batcher = self.create_nlu_batcher()
+        self.intent_classifier = self.create_intent_classifier()
+        self.response_cache = self.create_response_cache()
+        self.embedded_nlu_threshold = float(os.getenv("EMBEDDED_NLU_THRESHOLD", 0.7))
+        self.admission = self.create_admission_controller()
+        self.llm_pool = self.create_llm_pool()
+        self.llm_executor = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_HEDGE_WORKERS", 32)),
+                                               thread_name_prefix="llm-hedge") \
+            if self.llm_pool.hedge_percentile > 0 else None
+        self.llm_keepalive = float(os.getenv("LLM_KEEPALIVE", 5))
+        self.turn_pipeline = TurnPipeline(self) if int(os.getenv("TURN_PIPELINE", 0)) == 1 else None
+        self.speculative_hints = int(os.getenv("SPECULATIVE_HINTS", 0)) == 1
+        self.hint_deadline = float(os.getenv("HINT_DEADLINE_MS", 300)) / 1000
+        self.hint_executor = ThreadPoolExecutor(max_workers=int(os.getenv("HINT_WORKERS", 16)),
+                                                thread_name_prefix="hint-nlu") if self.speculative_hints else None
+        # set by warm_up, the /ready endpoint reports it to the load balancer
+        self.ready = False
+
+    def create_http_session(self) -> requests.Session:
+        # one pooled session for the whole process, so LLM and RASA calls reuse
+        # keep-alive connections instead of doing a new TCP/TLS handshake per turn
+        pool_size = int(os.getenv("HTTP_POOL_SIZE", 32))
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
 
     def build_dialog(self, messages: List[Dict]) -> str:
         dlg = []
@@ -35,69 +90,250 @@ class Chatbot(ABC):
         return "\n".join(dlg)
         
     @abstractmethod
-    def get_prompt(self, messages, intent, session_id):
+    def get_prompt(self, messages, intent, session_id, state, prefetched=None):
         pass
 
     def nlu(self, user_message: str):
+        nlu_response = self.embedded_parse(user_message)
+        if nlu_response is not None:
+            return nlu_response["intent"], nlu_response
+        parse = self.nlu_batcher.parse if self.nlu_batcher is not None else self.rasa_parse
+        if self.nlu_cache is not None:
+            nlu_response = self.nlu_cache.parse(user_message, parse)
+        else:
+            nlu_response = parse(user_message)
+        if nlu_response is not None:
+            return nlu_response["intent"], nlu_response
+
+    def rasa_parse(self, user_message: str):
         try:
-            response = requests.post(self.rasa_nlu_url, json={"text": user_message})
+            response = self.http.post(self.rasa_nlu_url, json={"text": user_message})
             nlu_response = response.json()
-            return nlu_response["intent"], nlu_response
+            if "intent" not in nlu_response:
+                raise ValueError(f"Unexpected NLU response: {nlu_response}")
+            return nlu_response
         except Exception as e:
+            metrics.ERRORS.labels("nlu").inc()
             logging.error("There was a problem connecting to RASA NLU server")
             logging.exception(e)
 
-    def get_answer(self, messages: List[Dict], session_id: str, llm_parameter: Dict, chatbot_id: str, uid: str):
-        if session_id not in self.session_states:
-            self.reset_session()
-
-        intent, nlu_response = self.nlu(messages[-1]["message"])
+    def rasa_parse_batch(self, user_messages: List[str]) -> List:
+        try:
+            response = self.http.post(self.rasa_nlu_batch_url, json={"texts": user_messages})
+            nlu_responses = response.json()["results"]
+            if len(nlu_responses) != len(user_messages) or any("intent" not in r for r in nlu_responses):
+                raise ValueError(f"Unexpected batch parse response for {len(user_messages)} texts")
+            return nlu_responses
+        except Exception as e:
+            # e.g. a RASA server without the batch_parse channel, parse the texts one by one
+            metrics.ERRORS.labels("nlu_batch").inc()
+            logging.error("There was a problem with the batch parse of the RASA NLU server")
+            logging.exception(e)
+            return [self.rasa_parse(user_message) for user_message in user_messages]
+
+    def create_nlu_batcher(self):
+        if int(os.getenv("NLU_BATCH", 0)) != 1:
+            return None
+        return NluBatcher(self.rasa_parse_batch, window=float(os.getenv("NLU_BATCH_WINDOW_MS", 5)) / 1000,
+                          max_batch=int(os.getenv("NLU_BATCH_MAX", 32)))
+
+    def embedded_parse(self, user_message: str):
+        # the in-process classifier answers when it is confident enough, everything else goes to RASA
+        if self.intent_classifier is None:
+            return None
+        nlu_response = self.intent_classifier.parse(user_message)
+        if nlu_response["intent"]["confidence"] >= self.embedded_nlu_threshold:
+            return nlu_response
+
+    def create_intent_classifier(self):
+        if int(os.getenv("EMBEDDED_NLU", 0)) != 1:
+            return None
+        from intent_classifier import load_intent_classifier
+        return load_intent_classifier()
+
+    def prefetch_prompt_inputs(self, messages: List[Dict]) -> Dict:
+        """
+        Computes the prompt inputs that do not depend on the intent, while the NLU request is still running.
+        The result is handed to get_prompt as prefetched.
+        """
+        return {}
+
+    def warm_llm_connection(self):
+        # puts a keep-alive connection to the LLM server into the pool before the prompt is ready
+        backend = self.llm_pool.peek()
+        if backend is None or time.monotonic() - backend.last_used < self.llm_keepalive:
+            return
+        try:
+            self.http.get(backend.health_url, timeout=2)
+            backend.last_used = time.monotonic()
+        except Exception as e:
+            logging.warning(f"Could not warm up the LLM connection: {e}")
+
+    def warm_up(self):
+        """Touches the policy tables and opens the LLM connection once, so the first user does not pay for it."""
+        start = time.perf_counter()
+        self.dialog_policy.current()
+        # an LLM server that is down must not keep the process from taking traffic, the pool fails over
+        self.warm_llm_connection()
+        self.ready = True
+        logging.info(f"Chatbot ready, warm up took {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    def create_llm_pool(self) -> LlmPool:
+        urls = [url.strip() for url in os.getenv("LLM_URLS", "").split(",") if url.strip()]
+        if urls:
+            health_urls = [urljoin(url, "/health") for url in urls]
+        else:
+            urls = [self.llm_url]
+            health_urls = [os.getenv("LLM_HEALTH_URL", urljoin(self.llm_url, "/health"))]
+        pool = LlmPool(urls, health_urls, failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", 3)),
+                       open_seconds=float(os.getenv("LLM_BREAKER_OPEN_SECONDS", 10)),
+                       hedge_percentile=float(os.getenv("LLM_HEDGE_PERCENTILE", 0)),
+                       hedge_min_samples=int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 20)))
+        pool.start_health_probes(lambda url: self.http.get(url, timeout=2), float(os.getenv("LLM_HEALTH_INTERVAL", 5)))
+        return pool
+
+    def create_admission_controller(self):
+        max_streams = int(os.getenv("LLM_MAX_STREAMS", 0))
+        if max_streams <= 0:
+            return None
+        return ThreadAdmissionController(max_streams, max_queue=int(os.getenv("LLM_MAX_QUEUE", 64)),
+                                         queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", 30)),
+                                         session_policy=os.getenv("SESSION_CONCURRENCY", "supersede"))
+
+    def create_response_cache(self):
+        max_entries = int(os.getenv("RESPONSE_CACHE_SIZE", 0))
+        if max_entries <= 0:
+            return None
+        response_cache = ResponseCache(max_entries=max_entries, ttl=float(os.getenv("RESPONSE_CACHE_TTL", 24 * 3600)),
+                                       variants=int(os.getenv("RESPONSE_CACHE_VARIANTS", 3)))
+        metrics.collect_cache_stats("response", response_cache.stats)
+        return response_cache
+
+    def create_nlu_cache(self):
+        max_entries = int(os.getenv("NLU_CACHE_SIZE", 4096))
+        if max_entries <= 0:
+            return None
+        nlu_cache = NluCache(max_entries=max_entries, ttl=float(os.getenv("NLU_CACHE_TTL", 3600)))
+        metrics.collect_cache_stats("nlu", nlu_cache.stats)
+        metrics.collect_counter("nlu_coalesced", metrics.NLU_COALESCED, lambda: nlu_cache.coalesced)
+        return nlu_cache
+
+    def get_answer(self, messages: List[Dict], session_id: str, llm_parameter: Dict, chatbot_id: str, uid: str = None):
+        if self.admission is None:
+            return self.plan_answer(messages, session_id, llm_parameter, chatbot_id, uid)[1]
+        # raises AdmissionRejected before the response starts, so the server can answer with 429/503
+        ticket = self.admission.acquire(session_id)
+        try:
+            turn, answer = self.plan_answer(messages, session_id, llm_parameter, chatbot_id, uid)
+        except BaseException:
+            self.admission.release(ticket)
+            raise
+        return AdmittedStream(answer, ticket, self.admission.release, supersede=lambda: self.supersede_turn(turn))
+
+    def supersede_turn(self, turn: Dict) -> bool:
+        """Marks the turn as superseded by a newer request of its session, unless its answer is already logged."""
+        logging_info = turn["logging_info"]
+        # the answer is logged right after the hint or quiz question entered the session state, the trailer that
+        # shows them has to reach the client then
+        if "llm_response" in logging_info:
+            return False
+        logging_info["superseded"] = True
+        return True
+
+    def plan_answer(self, messages: List[Dict], session_id: str, llm_parameter: Dict, chatbot_id: str, uid: str = None):
+        if self.turn_pipeline is not None:
+            (intent, nlu_response), prefetched, timings = self.turn_pipeline.run(messages)
+            turn = self.plan_turn(messages, session_id, llm_parameter, chatbot_id, uid, intent, nlu_response, prefetched)
+            turn["logging_info"]["pipeline"] = timings
+        else:
+            with metrics.stage("nlu"):
+                intent, nlu_response = self.nlu(messages[-1]["message"])
+            turn = self.plan_turn(messages, session_id, llm_parameter, chatbot_id, uid, intent, nlu_response)
+        answer_generator = self._call_llm_generic(turn["prompt"], llm_parameter, turn["logging_info"], chatbot_id,
+                                                  turn["user_intent"], is_quiz=turn["is_quiz"], state=turn["state"],
+                                                  cacheable=turn["cacheable"])
+        return turn, self.create_generator_chain(turn["header_success"], answer_generator)
+
+    def plan_turn(self, messages: List[Dict], session_id: str, llm_parameter: Dict, chatbot_id: str, uid: str,
+                  intent: Dict, nlu_response: Dict, prefetched: Dict = None) -> Dict:
+        """
+        Decides how to answer the latest user message once its intent is known. The returned turn holds everything
+        needed to call the LLM, so the sync and the async server can share the dialog logic.
+        """
+        state = self.sessions.load(session_id)
         user_intent = intent
 
+        # quiz and closure prompts do not contain the dialog, their answers can be replayed from the response cache
+        cacheable = True
         if self.is_quiz_answer(messages[-1]["message"]):
-            return self.handle_quiz_answer(messages, session_id, llm_parameter, nlu_response, chatbot_id, uid)
-        elif user_intent["name"] == "ask_quiz" or (self.hinting == 2 and self.hint_count < 4):
-            return self.handle_quiz_request(messages, session_id, llm_parameter, nlu_response, chatbot_id, uid)
-        elif self.hint_count == 4:
-            prompt = prompts.closure_template.format(user_message=messages[-1]["message"])
-            success = True
+            kind = "quiz_answer"
+            turn = self.handle_quiz_answer(messages, session_id, llm_parameter, nlu_response, chatbot_id, uid, state)
+        elif (user_intent["name"] == "ask_quiz" or state["hinting"] == 2) and state["hint_count"] < self.dialog_policy.quiz_length():
+            # once every question was asked, a request for a quiz gets the closure
+            kind = "quiz"
+            turn = self.handle_quiz_request(messages, session_id, llm_parameter, nlu_response, chatbot_id, uid, state)
         else:
-            prompt, success = self.get_prompt(messages, intent, session_id)
-
-        return self.generate_response(prompt, success, messages, session_id, llm_parameter, nlu_response, chatbot_id, uid, user_intent)
-
-    def reset_session(self):
-        self.hinting = 0
-        self.hint_count = 0
-        self.correct_answer = []
+            if state["hint_count"] >= self.dialog_policy.quiz_length():
+                kind = "closure"
+                prompt = prompts.closure_template.format(user_message=messages[-1]["message"])
+                success = True
+            else:
+                kind = "dialog"
+                with metrics.stage("get_prompt"):
+                    prompt, success = self.get_prompt(messages, intent, session_id, state, prefetched)
+                cacheable = False
+            turn = self.generate_response(prompt, success, messages, session_id, llm_parameter, nlu_response, chatbot_id, uid, user_intent, state)
+        turn["cacheable"] = cacheable
+        turn["logging_info"]["kind"] = kind
+        metrics.TURNS.labels(kind).inc()
+
+        self.sessions.save(session_id, state)
+        return turn
+
+    def reset_session(self, session_id: str):
+        self.sessions.delete(session_id)
+
+    def get_last_logging_info(self, session_id: str):
+        return self.sessions.load(session_id)["last_logging_info"]
 
     def is_quiz_answer(self, message):
         return message in ["a", "b", "c"]
 
-    def handle_quiz_answer(self, messages, session_id, llm_parameter, nlu_response, chatbot_id, uid):
-        is_correct = self.correct_answer[-1].split(')')[0] == messages[-1]["message"]
-        prompt = self.get_quiz_answer_prompt(is_correct)
-        return self.generate_quiz_response(prompt, messages, session_id, llm_parameter, nlu_response, chatbot_id, uid)
+    def handle_quiz_answer(self, messages, session_id, llm_parameter, nlu_response, chatbot_id, uid, state):
+        is_correct = state["correct_answer"][-1].split(')')[0] == messages[-1]["message"]
+        prompt = self.get_quiz_answer_prompt(is_correct, state)
+        turn = self.generate_quiz_response(prompt, messages, session_id, llm_parameter, nlu_response, chatbot_id, uid, state)
+        turn["logging_info"]["quiz_correct"] = is_correct
+        return turn
 
-    def handle_quiz_request(self, messages, session_id, llm_parameter, nlu_response, chatbot_id, uid):
+    def handle_quiz_request(self, messages, session_id, llm_parameter, nlu_response, chatbot_id, uid, state):
         prompt = "Generate a sentence exactly as the given : 'Hold on a second! Let's spice things up with a quick quiz to test your skills in spotting the argumentation strategies that flat earth believers use. Ready to challenge your understanding? \n\n'"
-        return self.generate_quiz_response(prompt, messages, session_id, llm_parameter, nlu_response, chatbot_id, uid)
+        return self.generate_quiz_response(prompt, messages, session_id, llm_parameter, nlu_response, chatbot_id, uid, state)
 
-    def get_quiz_answer_prompt(self, is_correct):
+    def get_quiz_answer_prompt(self, is_correct, state):
+        correct_answer = state["correct_answer"]
         if is_correct:
-            return f"Generate a sentence exactly as the given and add emojies as required : 'Hurray thats right!!! the correct answer is {self.correct_answer[-1]}  and generate a sentence breifly describing what is {self.correct_answer[-1]}then steer the conversation back to flat earth \n\n' "
+            return f"Generate a sentence exactly as the given and add emojies as required : 'Hurray thats right!!! the correct answer is {correct_answer[-1]}  and generate a sentence breifly describing what is {correct_answer[-1]}then steer the conversation back to flat earth \n\n' "
         else:
-            return f"Generate a sentence exactly as the given and put approprite emojies : 'Sorry Your answer is wrong  Correct answer is {self.correct_answer[-1]} and generate a sentence breifly describing the answer in the context of flat earth, then steer the conversation back to flat earth\n\n'"
+            return f"Generate a sentence exactly as the given and put approprite emojies : 'Sorry Your answer is wrong  Correct answer is {correct_answer[-1]} and generate a sentence breifly describing the answer in the context of flat earth, then steer the conversation back to flat earth\n\n'"
 
-    def generate_response(self, prompt, success, messages, session_id, llm_parameter, nlu_response, chatbot_id, uid, user_intent):
+    def generate_response(self, prompt, success, messages, session_id, llm_parameter, nlu_response, chatbot_id, uid, user_intent, state):
         logging_info = self.create_logging_info(messages, session_id, llm_parameter, nlu_response, prompt, success, uid)
-        answer_generator = self.call_llm(prompt, llm_parameter, logging_info, chatbot_id, user_intent)
-        return self.create_generator_chain(success, answer_generator)
+        return self.create_turn(prompt, success, logging_info, user_intent, False, state)
 
-    def generate_quiz_response(self, prompt, messages, session_id, llm_parameter, nlu_response, chatbot_id, uid):
+    def generate_quiz_response(self, prompt, messages, session_id, llm_parameter, nlu_response, chatbot_id, uid, state):
         logging_info = self.create_logging_info(messages, session_id, llm_parameter, nlu_response, prompt, True, uid)
-        answer_generator = self.call_llm_for_quiz(prompt, llm_parameter, logging_info, chatbot_id, None)
-        return self.create_generator_chain(False, answer_generator)
+        return self.create_turn(prompt, False, logging_info, None, True, state)
+
+    def create_turn(self, prompt, header_success, logging_info, user_intent, is_quiz, state):
+        return {
+            "prompt": prompt,
+            "header_success": header_success,
+            "logging_info": logging_info,
+            "user_intent": user_intent,
+            "is_quiz": is_quiz,
+            "state": state
+        }
 
     def create_logging_info(self, messages, session_id, llm_parameter, nlu_response, prompt, success, uid):
         return {
@@ -111,121 +347,220 @@ class Chatbot(ABC):
             "uid": uid
         }
 
-    def create_generator_chain(self, success, answer_generator):
+    def create_header(self, success) -> bytes:
         header = {"dialog_success": success}
         header = json.dumps(header)
         header = "header: " + header + "\n\n"
-        header = header.encode()
-        header_generator = [x for x in [header]]
-        return chain(header_generator, answer_generator)
+        return header.encode()
 
-    def write_to_logfile(self, log_str: str, chatbot_id: str):
-        if self.logfile is None:
-            self.logfile = open(f"{self.logdir}/chat_log.text", "a")
-        self.logfile.write(log_str)
-        self.logfile.flush()
+    def create_generator_chain(self, success, answer_generator):
+        # a generator instead of itertools.chain: closing the response on a client disconnect closes the answer too
+        yield self.create_header(success)
+        yield from answer_generator
 
-    def call_llm(self, prompt: str, llm_parameter: Dict, logging_info: Dict, chatbot_id: str, user_intent: str):
-        return self._call_llm_generic(prompt, llm_parameter, logging_info, chatbot_id, user_intent, is_quiz=False)
+    def write_to_logfile(self, logging_info: Dict, chatbot_id: str):
+        # serialized and written by the background writer, the response stream does not wait for the disk
+        with metrics.stage("log_write"):
+            self.chat_log.write(logging_info)
 
-    def call_llm_for_quiz(self, prompt: str, llm_parameter: Dict, logging_info: Dict, chatbot_id: str, user_intent: str):
-        return self._call_llm_generic(prompt, llm_parameter, logging_info, chatbot_id, user_intent, is_quiz=True)
+    def call_llm(self, prompt: str, llm_parameter: Dict, logging_info: Dict, chatbot_id: str, user_intent: str, state: Dict):
+        return self._call_llm_generic(prompt, llm_parameter, logging_info, chatbot_id, user_intent, is_quiz=False, state=state)
 
-    def _call_llm_generic(self, prompt: str, llm_parameter: Dict, logging_info: Dict, chatbot_id: str, user_intent: str, is_quiz: bool):
-        data = {
-            "inputs": prompt,
-            "parameters": llm_parameter
-        }
+    def call_llm_for_quiz(self, prompt: str, llm_parameter: Dict, logging_info: Dict, chatbot_id: str, user_intent: str, state: Dict):
+        return self._call_llm_generic(prompt, llm_parameter, logging_info, chatbot_id, user_intent, is_quiz=True, state=state)
+
+    def _call_llm_generic(self, prompt: str, llm_parameter: Dict, logging_info: Dict, chatbot_id: str, user_intent: str, is_quiz: bool,
+                          state: Dict, cacheable: bool = False):
+        data = self.create_llm_request(prompt, llm_parameter, logging_info["session_id"])
+        cache_key = self.response_cache.key(prompt, llm_parameter) \
+            if cacheable and self.response_cache is not None else None
 
         def generate():
+            metrics.STREAMS_IN_FLIGHT.inc()
             try:
-                session = requests.Session()
-                response = session.post(self.llm_url, stream=True, json=data)
-            except Exception as e:
-                logging.error("There was a problem connecting to the LLM server.")
-                logging.exception(e)
+                yield from stream_answer()
+            finally:
+                metrics.STREAMS_IN_FLIGHT.dec()
+
+        def stream_answer():
+            cached = self.response_cache.get(cache_key, llm_parameter) if cache_key is not None else None
+            if cached is not None:
+                chunks, running_text = cached
+                logging_info["response_cache"] = "replay"
+                metrics.RESPONSE_CACHE_REPLAYS.inc()
+                try:
+                    yield from chunks
+                except GeneratorExit:
+                    self.log_aborted_response(logging_info, [running_text], None, chatbot_id, state)
+                    raise
+                intent = self.classify_answer(running_text, is_quiz)
+                trailer_events = self.create_trailer_events(intent, is_quiz, user_intent, state)
+                self.log_response(logging_info, running_text, chatbot_id, state, intent)
+                yield from trailer_events
+                return
+
+            start = time.perf_counter()
+            try:
+                backend, (response, llm_chunks) = self.llm_pool.open_stream(
+                    lambda backend: self.connect_llm(backend, data), self.llm_executor)
+                metrics.observe_stage("llm_connect", time.perf_counter() - start)
+            except LlmUnavailable as e:
+                metrics.ERRORS.labels("llm").inc()
+                logging.error(f"There was a problem connecting to the LLM server. {e}")
+                logging_info["llm_error"] = str(e)
+                yield self.create_error_event(LLM_UNAVAILABLE_MESSAGE)
+                self.log_response(logging_info, "", chatbot_id, state)
+                return
 
             running_text = []
+            chunks = [] if cache_key is not None else None
+            hint_classifier = self.create_hint_classifier(is_quiz)
 
-            for chunk in response.iter_content(chunk_size=None):
-                chunk_utf8 = chunk.decode("utf-8")[5:]
-                for line in chunk_utf8.split("\n"):
-                    if len(line.strip()) == 0:
-                        continue
-                    try:
-                        jsono = json.loads(line)
-                        next_str = jsono["token"]["text"]
-                        running_text.append(next_str)
-                    except Exception as e:
-                        logging.exception(e)
-                        pass
-                yield chunk
+            parser = SSEParser()
 
+            backend_ok = True
+            first_token = None
+            try:
+                for chunk in llm_chunks:
+                    for event in parser.feed(chunk):
+                        next_str = token_text(event)
+                        if next_str is None:
+                            continue
+                        if not running_text:
+                            first_token = time.perf_counter() - start
+                            metrics.observe_stage("llm_first_token", first_token)
+                        running_text.append(next_str)
+                        if hint_classifier is not None:
+                            hint_classifier.feed(next_str, running_text)
+                    if chunks is not None:
+                        chunks.append(chunk)
+                    yield chunk
+            except requests.RequestException as e:
+                # the backend broke off the stream, the turn ends with the partial answer
+                backend_ok = False
+                metrics.ERRORS.labels("llm").inc()
+                logging.error(f"The LLM stream of {backend.url} broke off")
+                logging.exception(e)
+            except GeneratorExit:
+                # the client disconnected: closing the connection stops the generation on the LLM server
+                self.log_aborted_response(logging_info, running_text, llm_parameter, chatbot_id, state, hint_classifier)
+                raise
+            finally:
+                response.close()
+                self.llm_pool.release(backend, backend_ok)
+
+            stream_seconds = time.perf_counter() - start
+            metrics.observe_stage("llm_stream", stream_seconds)
+            metrics.TOKENS_STREAMED.inc(len(running_text))
+            logging_info["latency_ms"] = latency_ms(first_token, stream_seconds)
             running_text = "".join(running_text)
-            intent, _ = self.nlu(running_text)
-            output_string = self.generate_output_string(intent, is_quiz, user_intent)
-
-            json_structure = self.create_json_structure(output_string)
-            json_string = 'data:' + json.dumps(json_structure) + '\n\n'
-            yield 'data:{"index":-1,"token":{"id":-1,"text":"\n","logprob":0.0,"special":false},"generated_text":null,"details":null}\n\n'
-            yield json_string
-
-            logging_info["llm_response"] = running_text
-            logging_info_str = json.dumps(logging_info) + "\n"
-            self.write_to_logfile(logging_info_str, chatbot_id)
-            self.last_logging_info = logging_info
+            if chunks is not None and backend_ok and response.status_code == 200 and running_text:
+                self.response_cache.add(cache_key, llm_parameter, chunks, running_text)
+            with metrics.stage("answer_nlu"):
+                intent = self.classify_answer(running_text, is_quiz, hint_classifier)
+            # logged before the trailer is sent, so a client leaving at the very end does not lose the turn
+            trailer_events = self.create_trailer_events(intent, is_quiz, user_intent, state)
+            self.log_response(logging_info, running_text, chatbot_id, state, intent)
+            yield from trailer_events
 
         return generate()
 
-    def generate_output_string(self, intent, is_quiz, user_intent):
+    def connect_llm(self, backend: LlmBackend, data: Dict):
+        """Sends the generation request to the backend and waits for the first chunk of the stream."""
+        response = self.http.post(backend.url, stream=True, json=data)
+        try:
+            if response.status_code >= 500:
+                raise LlmBackendError(f"{backend.url} answered with status {response.status_code}")
+            llm_chunks = response.iter_content(chunk_size=None)
+            first_chunk = next(llm_chunks, None)
+        except BaseException:
+            response.close()
+            raise
+        return response, chain([first_chunk], llm_chunks) if first_chunk is not None else llm_chunks
+
+    def create_error_event(self, message: str) -> bytes:
+        return ('data:' + json.dumps(self.create_json_structure(message)) + '\n\n').encode()
+
+    def create_hint_classifier(self, is_quiz: bool):
+        if not self.speculative_hints or is_quiz:
+            return None
+        return SpeculativeHintClassifier(self.nlu, self.hint_executor, self.hint_deadline)
+
+    def classify_answer(self, running_text: str, is_quiz: bool, hint_classifier=None):
+        # quiz answers get a quiz question instead of a hint, so they do not need NLU
         if is_quiz:
-            return self.generate_quiz_output()
-        else:
-            return self.generate_hint_output(intent)
-
-    def generate_hint_output(self, intent):
-        hint_messages = {
-            "nefarious_intent": """You can observe nefarious intent in my current response. "Nefarious intent" refers to a malicious or harmful purpose behind someone's actions, often involving deliberate deception or harm.""",
-            "cherry_picking_data": """You can observe cherry-picking data in my current response. "Cherry-picking data" refers to selectively presenting only the evidence that supports a particular viewpoint, while ignoring or downplaying evidence that contradicts it.""",
-            "contradictory_evidence": "You can observe contradictory evidence explanations in my current response. Flat-Earthers often propose alternative explanations for observations that seem to contradict the flat Earth model. These explanations attempt to reconcile their beliefs with established scientific principles.",
-            "overriding_suspicion": "You can observe overriding suspicion tactics in my current response. Flat-Earthers sometimes disregard evidence for a spherical Earth due to skepticism of authority figures, alternative interpretations of history, or a preference for simpler explanations."
+            return None
+        if hint_classifier is not None:
+            return hint_classifier.result(running_text)
+        intent, _ = self.nlu(running_text)
+        return intent
+
+    def create_llm_request(self, prompt: str, llm_parameter: Dict, session_id: str = None) -> Dict:
+        if self.llm_cache_key_param and session_id is not None:
+            cache_key = hashlib.sha1(session_id.encode("utf-8")).hexdigest()[:16]
+            llm_parameter = dict(llm_parameter, **{self.llm_cache_key_param: cache_key})
+        return {
+            "inputs": prompt,
+            "parameters": llm_parameter
         }
-        
-        if intent["name"] in hint_messages:
-            self.hinting += 1
-            return f"""<br/> <span style="color:blue;"><b><i> Hint: </i></b></span> <span style="color:green;"><i>{hint_messages[intent["name"]]}</i></span>"""
-        return ""
 
-    def generate_quiz_output(self):
-        questions = [
-            {
-                "question": "What term describes the strategy of highlighting only the evidence that supports one's argument while dismissing or ignoring any evidence that contradicts it?",
-                "options": ["a) Nefarious Intent", "b) Contradictory Evidence", "c) Cherry Picking"],
-                "answer": "c) Cherry Picking"
-            },
-            {
-                "question": "'Different constellations being visible could be explained by a complex light refraction phenomenon in the flat Earth model.' What type of argumentation strategy is being used here?",
-                "options": ["a) Cherry Picking", "b) Contradictory Evidence", "c) Nefarious Intent"],
-                "answer": "b) Contradictory Evidence"
-            },
-            {
-                "question": "Which argumentation strategy involves having a harmful or deceitful purpose behind one's actions, often involving deliberate misinformation or manipulation?",
-                "options": ["a) Contradictory Evidence", "b) Nefarious Intent", "c) Cherry Picking"],
-                "answer": "b) Nefarious Intent"
-            },
-            {
-                "question": "'Why haven't any photos or videos been captured from space that definitively show the Earth's curvature?' Which argumentation strategy does this question represent?",
-                "options": ["a) Overriding Suspicion", "b) Contradictory Evidence", "c) Cherry Picking"],
-                "answer": "a) Overriding Suspicion"
-            }
-        ]
+    def create_trailer_events(self, intent, is_quiz, user_intent, state) -> List[str]:
+        output_string = self.generate_output_string(intent, is_quiz, user_intent, state)
+        json_structure = self.create_json_structure(output_string)
+        json_string = 'data:' + json.dumps(json_structure) + '\n\n'
+        return [NEWLINE_EVENT, json_string]
+
+    def log_response(self, logging_info: Dict, running_text: str, chatbot_id: str, state: Dict, intent: Dict = None):
+        logging_info["llm_response"] = running_text
+        if intent is not None:
+            # the intent of the answer, which picks the hint
+            logging_info["answer_intent"] = intent["name"]
+        self.write_to_logfile(logging_info, chatbot_id)
+        if self.last_turn_mode == "delta":
+            state["last_logging_info"] = compact_logging_info(logging_info, state["message_count"])
+        else:
+            state["last_logging_info"] = logging_info
+        state["message_count"] = len(logging_info.get("messages") or [])
+        self.sessions.save(logging_info["session_id"], state)
+
+    def log_aborted_response(self, logging_info: Dict, running_text: List[str], llm_parameter: Optional[Dict],
+                             chatbot_id: str, state: Dict, hint_classifier=None):
+        # no answer NLU and no hint or quiz question for an answer nobody reads
+        if hint_classifier is not None:
+            hint_classifier.cancel()
+        tokens_saved = 0
+        if llm_parameter is not None and llm_parameter.get("max_new_tokens"):
+            tokens_saved = max(0, int(llm_parameter["max_new_tokens"]) - len(running_text))
+        logging_info["aborted"] = True
+        metrics.CANCELLED_STREAMS.inc()
+        metrics.TOKENS_SAVED.inc(tokens_saved)
+        logging.info(f"Client of session {logging_info['session_id']} disconnected after {len(running_text)} tokens")
+        self.log_response(logging_info, "".join(running_text), chatbot_id, state)
+
+    def generate_output_string(self, intent, is_quiz, user_intent, state):
+        if is_quiz:
+            return self.generate_quiz_output(state)
+        else:
+            return self.generate_hint_output(intent, state)
 
-        self.hinting = 0
-        selected_question = questions[self.hint_count]
-        self.correct_answer.append(selected_question['answer'])
-        self.hint_count += 1
+    def generate_hint_output(self, intent, state):
+        hint = self.dialog_policy.hint(intent["name"]) if intent is not None else None
+        if hint is not None:
+            state["hinting"] += 1
+            return f"""<br/> <span style="color:blue;"><b><i> Hint: </i></b></span> <span style="color:green;"><i>{hint}</i></span>"""
+        return ""
 
-        return f"<br/><b>{selected_question['question']}</b><br/><i>{'<br/>'.join(selected_question['options'])}</i><br/><b>Provide answer to the quiz by typing options a,b or c. </b><br/>"
+    def generate_quiz_output(self, state):
+        # the questions are rendered once when the dialog policy is loaded
+        policy = self.dialog_policy.current()
+        if state["hint_count"] >= len(policy.quiz_outputs):
+            # the answer to the last question, there is no next one
+            return ""
+        state["hinting"] = 0
+        state["correct_answer"].append(policy.quiz_answers[state["hint_count"]])
+        output = policy.quiz_outputs[state["hint_count"]]
+        state["hint_count"] += 1
+        return output
 
     def create_json_structure(self, output_string):
         return {
@@ -241,16 +576,14 @@ class Chatbot(ABC):
         }
 
     @abstractmethod
-    def get_prompt(self, messages, intent, session_id):
+    def get_prompt(self, messages, intent, session_id, state, prefetched=None):
         pass
 
+def latency_ms(first_token: Optional[float], stream: float) -> Dict:
+    """The LLM timings of a turn for the chat log: time to the first token and to the end of the stream."""
+    return {"first_token": round(first_token * 1000, 1) if first_token is not None else None,
+            "stream": round(stream * 1000, 1)}
+
+
 def llm_stream_to_str(generator):
-    response = []
-    for o in generator:
-        s = o.decode("utf-8")[5:]
-        try:
-            jsono = json.loads(s)
-            response.append(jsono["token"]["text"])
-        except Exception as e:
-            pass
-    return "".join(response)
\ No newline at end of file
+    return "".join(stream_texts(generator))
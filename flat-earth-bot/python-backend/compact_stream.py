@@ -0,0 +1,178 @@
+"""
+Compact format of the /api/chat stream, for clients that only show the answer text.
+
+The default format forwards the generate_stream events of the LLM as they are, with the id,
+logprob and special flag of every token. In the compact format the header stays the same,
+the tokens become text deltas and the events the backend adds (the newline and the hint, or
+an error message) keep their index -1:
+
+    header: {"dialog_success": false}
+
+    data:{"text":"Ah, my friend,"}
+
+    data:{"text":"\\n","index":-1}
+
+A delta holds all the tokens that arrived until flush_ms passed since the previous delta.
+The first delta is sent right away, so the time to the first token does not change. A
+delta is only sent when the next chunk arrives, so if the LLM stalls, the tokens of the
+current delta wait for the stall (at most one flush interval of tokens).
+Events without a token (e.g. an error of the LLM server) are forwarded unchanged.
+
+A client asks for it with ?format=compact (and optionally &flush_ms=...) or with the
+X-Stream-Format: compact (and X-Stream-Flush-Ms) request headers.
+"""
+
+import json
+import logging
+import math
+import os
+import time
+from collections import deque
+from typing import AsyncIterator, Callable, Iterator, List, Mapping, Optional, Union
+
+from sse import NEWLINE_EVENT, NEWLINE_EVENT_BYTES, SSEEvent, SSEParser, token_text
+
+FORMAT_HEADER = "X-Stream-Format"
+FLUSH_HEADER = "X-Stream-Flush-Ms"
+SEPARATORS = (",", ":")
+DEFAULT_FLUSH_MS = 50
+
+
+def requested_flush_seconds(params: Mapping[str, str], headers: Mapping[str, str]) -> Optional[float]:
+    """The flush interval of the compact format if the request asks for it, else None for the default format."""
+    stream_format = params.get("format") or headers.get(FORMAT_HEADER)
+    if stream_format != "compact":
+        return None
+    requested = params.get("flush_ms") or headers.get(FLUSH_HEADER) or os.getenv("COMPACT_STREAM_FLUSH_MS", DEFAULT_FLUSH_MS)
+    try:
+        flush_ms = float(requested)
+    except ValueError:
+        flush_ms = math.nan
+    if not math.isfinite(flush_ms):
+        # a bad value of the client must not fail the turn
+        logging.warning(f"Invalid flush interval {requested!r} of the compact format, using {DEFAULT_FLUSH_MS} ms")
+        flush_ms = DEFAULT_FLUSH_MS
+    return max(0.0, flush_ms / 1000)
+
+
+def added_event(text: str) -> bytes:
+    return b"data:" + json.dumps({"text": text, "index": -1}, separators=SEPARATORS).encode() + b"\n\n"
+
+
+def is_added_event(data: bytes) -> bool:
+    # the events of create_trailer_events and create_error_event
+    return b'"index":-1' in data or b'"index": -1' in data
+
+
+class CompactEncoder:
+    """Turns the chunks of the default format into the chunks of the compact format."""
+
+    def __init__(self, flush_seconds: float, clock: Callable[[], float] = time.monotonic):
+        self.flush_seconds = flush_seconds
+        self.clock = clock
+        self.parser = SSEParser()
+        self.text: List[str] = []
+        self.last_flush = None
+
+    def feed(self, chunk: Union[bytes, str]) -> List[bytes]:
+        """
+        The compact chunks for a chunk of the answer. Buffered tokens are only flushed here,
+        so they wait until the next chunk arrives, also when that is after flush_seconds.
+        """
+        if chunk == NEWLINE_EVENT or chunk == NEWLINE_EVENT_BYTES:
+            # no SSE parser reads this event, it is always a chunk of its own
+            output = self.finish()
+            output.append(added_event("\n"))
+            return output
+        output = []
+        for event in self.parser.feed(chunk):
+            self._event(event, output)
+        if self.text and (self.last_flush is None or self.clock() - self.last_flush >= self.flush_seconds):
+            self._flush(output)
+        return output
+
+    def finish(self) -> List[bytes]:
+        output = []
+        for event in self.parser.flush():
+            self._event(event, output)
+        if self.text:
+            self._flush(output)
+        return output
+
+    def _event(self, event: SSEEvent, output: List[bytes]):
+        text = token_text(event) if event.field == "data" else None
+        if text is None:
+            # the header and everything that is no token keep their order and format
+            if self.text:
+                self._flush(output)
+            output.append(event.field.encode() + b": " + event.data + b"\n\n"
+                          if event.field == "header" else event.field.encode() + b":" + event.data + b"\n\n")
+            return
+        if is_added_event(event.data):
+            if self.text:
+                self._flush(output)
+            output.append(added_event(text))
+            return
+        self.text.append(text)
+
+    def _flush(self, output: List[bytes]):
+        output.append(b"data:" + json.dumps({"text": "".join(self.text)}, separators=SEPARATORS).encode() + b"\n\n")
+        self.text.clear()
+        self.last_flush = self.clock()
+
+
+class CompactStream:
+    """The answer in the compact format. Closing it closes the answer, also if it was never started."""
+
+    def __init__(self, answer: Iterator, flush_seconds: float):
+        self.answer = answer
+        self.encoder = CompactEncoder(flush_seconds)
+        self.pending = deque()
+        self.finished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        while not self.pending:
+            if self.finished:
+                raise StopIteration
+            try:
+                chunk = next(self.answer)
+            except StopIteration:
+                self.finished = True
+                self.pending.extend(self.encoder.finish())
+                continue
+            self.pending.extend(self.encoder.feed(chunk))
+        return self.pending.popleft()
+
+    def close(self):
+        self.answer.close()
+
+
+class AsyncCompactStream:
+
+    def __init__(self, answer: AsyncIterator, flush_seconds: float):
+        self.answer = answer
+        self.encoder = CompactEncoder(flush_seconds)
+        self.pending = deque()
+        self.finished = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        while not self.pending:
+            if self.finished:
+                raise StopAsyncIteration
+            try:
+                chunk = await self.answer.__anext__()
+            except StopAsyncIteration:
+                self.finished = True
+                self.pending.extend(self.encoder.finish())
+                continue
+            self.pending.extend(self.encoder.feed(chunk))
+        return self.pending.popleft()
+
+    async def aclose(self):
+        await self.answer.aclose()
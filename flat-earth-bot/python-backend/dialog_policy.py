@@ -0,0 +1,163 @@
+"""
+Declarative dialog policy: which prompt answers an intent, which session flag an intent sets,
+the hint texts and the quiz questions. They are read from dialog_policy.json into lookup
+tables once and read again when the file changes, so intents and quiz questions can be
+added without a new deployment.
+
+An entry of "intents" can have
+  prompt:            name of the prompt in prompts.py, default_prompt if missing
+  flag:              session flag that is set when the intent is detected
+  flag_requires_any: the flag is only set if one of these flags is set already, otherwise it is cleared
+  confidence_above:  the entry only applies above this NLU confidence
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import prompts
+
+DEFAULT_POLICY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dialog_policy.json")
+
+
+class IntentRule(NamedTuple):
+    prompt: Optional[str]
+    flag: Optional[str]
+    flag_requires_any: Tuple[str, ...]
+    confidence_above: Optional[float]
+
+
+class PolicyTables(NamedTuple):
+    default_prompt: str
+    rules: Dict[str, IntentRule]
+    flags: Tuple[str, ...]
+    hints: Dict[str, str]
+    quiz_answers: List[str]
+    quiz_outputs: List[str]
+
+
+def render_quiz_question(question: Dict) -> str:
+    return f"<br/><b>{question['question']}</b><br/><i>{'<br/>'.join(question['options'])}</i><br/><b>Provide answer to the quiz by typing options a,b or c. </b><br/>"
+
+
+def prompt_text(name: str) -> str:
+    text = getattr(prompts, name, None)
+    if not isinstance(text, str):
+        raise ValueError(f"Unknown prompt {name} in the dialog policy")
+    return text
+
+
+def compile_policy(policy: Dict) -> PolicyTables:
+    rules = {}
+    flags = []
+    for intent, entry in policy.get("intents", {}).items():
+        rule = IntentRule(
+            prompt_text(entry["prompt"]) if "prompt" in entry else None,
+            entry.get("flag"),
+            tuple(entry.get("flag_requires_any", ())),
+            entry.get("confidence_above")
+        )
+        rules[intent] = rule
+        if rule.flag is not None and rule.flag not in flags:
+            flags.append(rule.flag)
+    quiz = policy.get("quiz", [])
+    for question in quiz:
+        if question["answer"] not in question["options"]:
+            raise ValueError(f"The answer of the quiz question {question['question']!r} is not one of its options")
+    return PolicyTables(
+        default_prompt=prompt_text(policy["default_prompt"]),
+        rules=rules,
+        flags=tuple(flags),
+        hints=dict(policy.get("hints", {})),
+        quiz_answers=[question["answer"] for question in quiz],
+        quiz_outputs=[render_quiz_question(question) for question in quiz]
+    )
+
+
+class DialogPolicy:
+
+    def __init__(self, path: str = DEFAULT_POLICY_PATH, reload_interval: float = 2.0,
+                 tables: Optional[PolicyTables] = None):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.mtime = None
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+        if tables is None:
+            self.tables = self.load()
+        else:
+            # compiled ahead of time (warm_state.py) from the current file
+            self.mtime = os.stat(self.path).st_mtime
+            self.tables = tables
+
+    def load(self) -> PolicyTables:
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, encoding="utf-8") as f:
+            tables = compile_policy(json.load(f))
+        self.mtime = mtime
+        return tables
+
+    def current(self) -> PolicyTables:
+        """The tables of the current policy file, read again at most every reload_interval seconds."""
+        now = time.monotonic()
+        if self.reload_interval is None or now - self.checked_at < self.reload_interval:
+            return self.tables
+        with self._lock:
+            if now - self.checked_at < self.reload_interval:
+                return self.tables
+            self.checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+                if mtime != self.mtime:
+                    # a broken file is reported once, not on every check
+                    self.mtime = mtime
+                    self.tables = self.load()
+                    logging.info(f"Reloaded the dialog policy from {self.path}")
+            except Exception as e:
+                # keep answering with the last valid policy
+                logging.error(f"Could not reload the dialog policy from {self.path}")
+                logging.exception(e)
+        return self.tables
+
+    def rule(self, intent: Dict) -> Optional[IntentRule]:
+        rule = self.current().rules.get(intent["name"])
+        if rule is None or (rule.confidence_above is not None and not intent.get("confidence", 0) > rule.confidence_above):
+            return None
+        return rule
+
+    def intent_prompt(self, intent: Dict) -> str:
+        rule = self.rule(intent)
+        if rule is None or rule.prompt is None:
+            return self.current().default_prompt
+        return rule.prompt
+
+    def update_flags(self, intent: Dict, flags: Dict):
+        rule = self.rule(intent)
+        if rule is None or rule.flag is None:
+            return
+        if rule.flag_requires_any:
+            flags[rule.flag] = any(flags.get(flag, False) for flag in rule.flag_requires_any)
+        else:
+            flags[rule.flag] = True
+
+    def hint(self, intent_name: str) -> Optional[str]:
+        return self.current().hints.get(intent_name)
+
+    def intent_prompts(self) -> List[str]:
+        tables = self.current()
+        return list(dict.fromkeys([tables.default_prompt] + [rule.prompt for rule in tables.rules.values() if rule.prompt]))
+
+    def quiz_length(self) -> int:
+        return len(self.current().quiz_answers)
+
+
+def load_dialog_policy() -> DialogPolicy:
+    from warm_state import load_warm_state
+
+    path = os.getenv("DIALOG_POLICY_PATH", DEFAULT_POLICY_PATH)
+    warm_state = load_warm_state()
+    tables = warm_state.policy if warm_state is not None and warm_state.policy_path == os.path.abspath(path) else None
+    return DialogPolicy(path, reload_interval=float(os.getenv("DIALOG_POLICY_RELOAD_SECONDS", 2)), tables=tables)
@@ -0,0 +1,54 @@
+"""
+Production server settings, used with
+
+    gunicorn -c gunicorn.conf.py
+
+The app module and the read-only tables are loaded once in the master process (preload_app),
+then every worker builds its own chatbot after the fork. Streams are long and mostly wait
+for the LLM, so each worker serves WEB_THREADS concurrent requests with the gthread worker.
+"""
+
+import glob
+import logging
+import os
+import tempfile
+
+wsgi_app = "chat_server:create_app()"
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+workers = int(os.getenv("WEB_WORKERS", 2))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", 32))
+preload_app = True
+# a worker that hangs for this long is restarted, streams themselves may run longer
+timeout = int(os.getenv("WEB_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+
+# the workers share their metrics through this directory (prometheus_client multiprocess mode). It has to be
+# set before the app, and with it prometheus_client, is imported
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="chatbot-metrics-"))
+
+
+def on_starting(server):
+    if workers > 1 and os.getenv("SESSION_STORE", "memory") == "memory":
+        logging.warning("Every gunicorn worker has its own in-memory sessions, set SESSION_STORE=sqlite "
+                        "so that the turns of a session can be served by any worker")
+    # the values of an earlier run would be added to this one
+    for path in glob.glob(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")):
+        os.remove(path)
+
+
+def post_fork(server, worker):
+    import chat_server
+    import metrics
+
+    metrics.start_collector_sync(float(os.getenv("METRICS_SYNC_SECONDS", 1)))
+    # the workers must not rotate (and compress) a file another worker still appends to
+    os.environ["CHAT_LOG_PROCESS"] = str(worker.pid)
+    chat_server.init_chatbot(server.app.wsgi())
+
+
+def child_exit(server, worker):
+    import metrics
+
+    metrics.process_exited(worker.pid)
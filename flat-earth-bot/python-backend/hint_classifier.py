@@ -0,0 +1,100 @@
+"""
+Speculative NLU classification of a streaming LLM answer. The partial answer is sent to
+NLU at sentence boundaries while tokens are still arriving, so that the hint can usually
+be chosen as soon as the last token lands. If the classification of the final text is not
+ready within the deadline or fails, the hint is skipped instead of delaying or breaking the
+end of the stream.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import Executor, TimeoutError
+from typing import Callable, Optional
+
+SENTENCE_BOUNDARIES = ".!?\n"
+
+
+def ends_sentence(token_text: str) -> bool:
+    return any(c in SENTENCE_BOUNDARIES for c in token_text)
+
+
+class SpeculativeHintClassifier:
+
+    def __init__(self, nlu: Callable, executor: Executor, deadline: float):
+        self.nlu = nlu
+        self.executor = executor
+        self.deadline = deadline
+        self.submitted_text = None
+        self.future = None
+
+    def feed(self, token_text: str, running_text: list):
+        if not ends_sentence(token_text):
+            return
+        # only one speculative request at a time, so RASA load stays bounded per stream
+        if self.future is not None and not self.future.done():
+            return
+        self.submit("".join(running_text))
+
+    def submit(self, text: str):
+        self.submitted_text = text
+        self.future = self.executor.submit(self.nlu, text)
+
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
+
+    def result(self, final_text: str) -> Optional[dict]:
+        if self.submitted_text != final_text:
+            self.submit(final_text)
+        try:
+            nlu_result = self.future.result(timeout=self.deadline)
+        except TimeoutError:
+            logging.warning(f"NLU classification of the answer took longer than {self.deadline}s, skipping the hint")
+            return None
+        except Exception as e:
+            logging.error("NLU classification of the answer failed, skipping the hint")
+            logging.exception(e)
+            return None
+        if nlu_result is None:
+            return None
+        return nlu_result[0]
+
+
+class AsyncSpeculativeHintClassifier:
+
+    def __init__(self, nlu: Callable, deadline: float):
+        self.nlu = nlu
+        self.deadline = deadline
+        self.submitted_text = None
+        self.task = None
+
+    def feed(self, token_text: str, running_text: list):
+        if not ends_sentence(token_text):
+            return
+        if self.task is not None and not self.task.done():
+            return
+        self.submit("".join(running_text))
+
+    def submit(self, text: str):
+        self.submitted_text = text
+        self.task = asyncio.ensure_future(self.nlu(text))
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def result(self, final_text: str) -> Optional[dict]:
+        if self.submitted_text != final_text:
+            self.submit(final_text)
+        try:
+            nlu_result = await asyncio.wait_for(asyncio.shield(self.task), timeout=self.deadline)
+        except asyncio.TimeoutError:
+            logging.warning(f"NLU classification of the answer took longer than {self.deadline}s, skipping the hint")
+            return None
+        except Exception as e:
+            logging.error("NLU classification of the answer failed, skipping the hint")
+            logging.exception(e)
+            return None
+        if nlu_result is None:
+            return None
+        return nlu_result[0]
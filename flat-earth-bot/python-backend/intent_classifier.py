@@ -0,0 +1,177 @@
+"""
+Embedded intent classifier, an optional fast path in front of the RASA NLU server.
+
+Texts are represented by TF-IDF weighted character n-grams within word boundaries (like the
+char_wb count vectors of the default RASA pipeline) and words, and classified by a multinomial
+logistic regression. The model is trained from rasa-nlu/data/nlu.yml and stored as a NumPy
+.npz artifact, so the backend does not need the RASA project or a training library at runtime.
+
+Build the artifact after nlu.yml changed:
+
+    python intent_classifier.py [--nlu-data ../rasa-nlu/data/nlu.yml] [--output models/intent_classifier.npz]
+"""
+
+import argparse
+import functools
+import hashlib
+import logging
+import math
+import os
+import re
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from nlu_data import DEFAULT_NLU_DATA_PATH, load_nlu_examples
+
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "intent_classifier.npz")
+
+WORD = re.compile(r"\w+|[^\w\s]")
+
+
+def tokenize(text: str) -> List[str]:
+    return WORD.findall(text.lower())
+
+
+def extract_features(text: str, min_n: int = 1, max_n: int = 4) -> Counter:
+    features = Counter()
+    for word in tokenize(text):
+        features["w:" + word] += 1
+        padded = f" {word} "
+        for n in range(min_n, max_n + 1):
+            for i in range(len(padded) - n + 1):
+                features[padded[i:i + n]] += 1
+    return features
+
+
+def file_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class IntentClassifier:
+
+    def __init__(self, vocabulary: List[str], idf: np.ndarray, weights: np.ndarray, bias: np.ndarray,
+                 intents: List[str], data_hash: str = ""):
+        self.vocabulary = {feature: i for i, feature in enumerate(vocabulary)}
+        self.idf = idf
+        self.weights = weights
+        self.bias = bias
+        self.intents = intents
+        self.data_hash = data_hash
+
+    def vectorize(self, text: str):
+        """Returns the indices and the L2 normalized TF-IDF values of the known features of a text."""
+        counts = [(self.vocabulary[f], c) for f, c in extract_features(text).items() if f in self.vocabulary]
+        if not counts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        indices = np.fromiter((i for i, _ in counts), dtype=np.int64, count=len(counts))
+        values = np.fromiter((1 + math.log(c) for _, c in counts), dtype=np.float32, count=len(counts))
+        values *= self.idf[indices]
+        values /= np.linalg.norm(values)
+        return indices, values
+
+    def probabilities(self, text: str) -> np.ndarray:
+        indices, values = self.vectorize(text)
+        scores = values @ self.weights[indices] + self.bias
+        scores = np.exp(scores - scores.max())
+        return scores / scores.sum()
+
+    def parse(self, text: str) -> Dict:
+        """Returns the intent in the format of the RASA /model/parse response."""
+        probabilities = self.probabilities(text)
+        ranking = np.argsort(-probabilities)[:10]
+        return {
+            "text": text,
+            "intent": {"name": self.intents[ranking[0]], "confidence": float(probabilities[ranking[0]])},
+            "entities": [],
+            "intent_ranking": [{"name": self.intents[i], "confidence": float(probabilities[i])} for i in ranking],
+            "source": "embedded"
+        }
+
+    def save(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        vocabulary = sorted(self.vocabulary, key=self.vocabulary.get)
+        np.savez_compressed(path, vocabulary=np.array(vocabulary), idf=self.idf, weights=self.weights,
+                            bias=self.bias, intents=np.array(self.intents), data_hash=np.array(self.data_hash))
+
+    @classmethod
+    def load(cls, path: str) -> "IntentClassifier":
+        with np.load(path) as model:
+            return cls(model["vocabulary"].tolist(), model["idf"], model["weights"], model["bias"],
+                       model["intents"].tolist(), str(model["data_hash"]))
+
+    @classmethod
+    def train(cls, examples: Dict[str, List[str]], l2: float = 1e-4, iterations: int = 300,
+              learning_rate: float = 0.5, data_hash: str = "") -> "IntentClassifier":
+        intents = [intent for intent, texts in examples.items() if texts]
+        texts = [text for intent in intents for text in examples[intent]]
+        labels = np.array([i for i, intent in enumerate(intents) for _ in examples[intent]])
+        features = [extract_features(text) for text in texts]
+
+        document_frequency = Counter(feature for counts in features for feature in counts)
+        vocabulary = sorted(document_frequency)
+        idf = np.array([math.log((1 + len(texts)) / (1 + document_frequency[f])) + 1 for f in vocabulary],
+                       dtype=np.float32)
+        classifier = cls(vocabulary, idf, np.zeros((len(vocabulary), len(intents)), dtype=np.float32),
+                         np.zeros(len(intents), dtype=np.float32), intents, data_hash)
+
+        x = np.zeros((len(texts), len(vocabulary)), dtype=np.float32)
+        for row, text in enumerate(texts):
+            indices, values = classifier.vectorize(text)
+            x[row, indices] = values
+        targets = np.eye(len(intents), dtype=np.float32)[labels]
+
+        # full batch gradient descent with Adam on the softmax cross entropy
+        weights, bias = classifier.weights, classifier.bias
+        moments = [np.zeros_like(weights), np.zeros_like(weights), np.zeros_like(bias), np.zeros_like(bias)]
+        beta1, beta2, epsilon = 0.9, 0.999, 1e-8
+        for step in range(1, iterations + 1):
+            scores = x @ weights + bias
+            scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+            error = scores / scores.sum(axis=1, keepdims=True) - targets
+            gradients = (x.T @ error / len(texts) + l2 * weights, error.mean(axis=0))
+            for parameter, gradient, first, second in zip((weights, bias), gradients, moments[0::2], moments[1::2]):
+                first *= beta1
+                first += (1 - beta1) * gradient
+                second *= beta2
+                second += (1 - beta2) * gradient ** 2
+                correction = math.sqrt(1 - beta2 ** step) / (1 - beta1 ** step)
+                parameter -= learning_rate * correction * first / (np.sqrt(second) + epsilon)
+        return classifier
+
+
+def load_intent_classifier(path: str = None) -> Optional[IntentClassifier]:
+    # the model is read-only, all chatbots of a process (and forked workers) share one copy
+    return read_intent_classifier(path or os.getenv("INTENT_CLASSIFIER_PATH", DEFAULT_MODEL_PATH))
+
+
+@functools.lru_cache(maxsize=None)
+def read_intent_classifier(path: str) -> Optional[IntentClassifier]:
+    try:
+        classifier = IntentClassifier.load(path)
+    except Exception as e:
+        logging.error(f"Could not load the embedded intent classifier from {path}, using RASA only")
+        logging.exception(e)
+        return None
+    nlu_data_path = os.getenv("NLU_DATA_PATH", DEFAULT_NLU_DATA_PATH)
+    if os.path.exists(nlu_data_path) and file_hash(nlu_data_path) != classifier.data_hash:
+        logging.warning(f"The embedded intent classifier was not trained on the current {nlu_data_path}, "
+                        f"rebuild it with python intent_classifier.py")
+    return classifier
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nlu-data", default=os.getenv("NLU_DATA_PATH", DEFAULT_NLU_DATA_PATH))
+    parser.add_argument("--output", default=DEFAULT_MODEL_PATH)
+    parser.add_argument("--iterations", type=int, default=300)
+    args = parser.parse_args()
+    model = IntentClassifier.train(load_nlu_examples(args.nlu_data), iterations=args.iterations,
+                                   data_hash=file_hash(args.nlu_data))
+    model.save(args.output)
+    print(f"Saved {len(model.intents)} intents and {len(model.vocabulary)} features to {args.output} "
+          f"({os.path.getsize(args.output) / 1024:.0f} KiB)")
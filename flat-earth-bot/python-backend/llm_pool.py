@@ -0,0 +1,304 @@
+"""
+Pool of LLM generate_stream endpoints (LLM_URLS). A turn goes to the available backend
+with the fewest outstanding streams. A stream is "open" once its first chunk arrived; if
+that fails the next backend is tried, so one broken node does not break the turn.
+
+Every backend has a circuit breaker: after failure_threshold failures in a row it gets no
+traffic for open_seconds. Then a single trial stream or a successful health probe of
+/health closes it again.
+
+With hedging (hedge_percentile > 0), a stream that has no first chunk after the given
+percentile of the recent times to first chunk is sent to a second backend as well. The
+first one to deliver a chunk is used and the other one is closed.
+
+The pool only keeps the state. The HTTP calls are passed in as `connect`, so the sync and
+the async chatbot share one pool.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, wait
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import metrics
+
+
+class LlmUnavailable(Exception):
+    """No backend could open the stream."""
+
+
+class LlmBackendError(Exception):
+    pass
+
+
+def unavailable(errors: List[Exception]) -> LlmUnavailable:
+    if not errors:
+        return LlmUnavailable("All LLM backends are paused by their circuit breakers")
+    return LlmUnavailable(f"No LLM backend could be reached: {'; '.join(str(e) for e in errors)}")
+
+
+class LlmBackend:
+
+    def __init__(self, url: str, health_url: str):
+        self.url = url
+        self.health_url = health_url
+        self.outstanding = 0
+        self.failures = 0
+        # time the circuit breaker opened, None while it is closed
+        self.opened_at = None
+        # a half open breaker lets a single trial stream through
+        self.trial = False
+        self.last_used = 0.0
+
+    def available(self, now: float, open_seconds: float) -> bool:
+        if self.opened_at is None:
+            return True
+        return not self.trial and now - self.opened_at >= open_seconds
+
+
+class LlmPool:
+
+    def __init__(self, urls: List[str], health_urls: List[str], failure_threshold: int = 3, open_seconds: float = 10.0,
+                 hedge_percentile: float = 0.0, hedge_min_samples: int = 20, window: int = 500):
+        self.backends = [LlmBackend(url, health_url) for url, health_url in zip(urls, health_urls)]
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.first_chunk_seconds = deque(maxlen=window)
+        self.hedges = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _choose(self, exclude) -> Optional[LlmBackend]:
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b not in exclude and b.available(now, self.open_seconds)]
+        if not candidates:
+            return None
+        # round robin among the least loaded, so idle backends share the traffic
+        fewest = min(b.outstanding for b in candidates)
+        candidates = [b for b in candidates if b.outstanding == fewest]
+        self._next += 1
+        return candidates[self._next % len(candidates)]
+
+    def peek(self) -> Optional[LlmBackend]:
+        """The backend the next stream would most likely use, for warming up its connection."""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [b for b in self.backends if b.available(now, self.open_seconds)]
+            return min(candidates, key=lambda b: b.outstanding) if candidates else None
+
+    def acquire(self, exclude=()) -> Optional[LlmBackend]:
+        with self._lock:
+            backend = self._choose(exclude)
+            if backend is None:
+                return None
+            if backend.opened_at is not None:
+                backend.trial = True
+            backend.outstanding += 1
+            metrics.LLM_OUTSTANDING.labels(backend.url).set(backend.outstanding)
+            return backend
+
+    def release(self, backend: LlmBackend, ok: Optional[bool]):
+        """ok is None for streams that were dropped without a verdict, e.g. the loser of a hedge."""
+        with self._lock:
+            backend.outstanding -= 1
+            backend.last_used = time.monotonic()
+            metrics.LLM_OUTSTANDING.labels(backend.url).set(backend.outstanding)
+            if ok is None:
+                backend.trial = False
+            elif ok:
+                self._close_breaker(backend)
+            else:
+                self._record_failure(backend)
+
+    def _close_breaker(self, backend: LlmBackend):
+        if backend.opened_at is not None:
+            logging.info(f"LLM backend {backend.url} is back")
+        backend.failures = 0
+        backend.opened_at = None
+        backend.trial = False
+        metrics.LLM_CIRCUIT_OPEN.labels(backend.url).set(0)
+
+    def _record_failure(self, backend: LlmBackend):
+        backend.failures += 1
+        if backend.trial or backend.failures >= self.failure_threshold:
+            if backend.opened_at is None:
+                logging.error(f"LLM backend {backend.url} failed {backend.failures} times, pausing it")
+            backend.opened_at = time.monotonic()
+            metrics.LLM_CIRCUIT_OPEN.labels(backend.url).set(1)
+        backend.trial = False
+
+    def record_first_chunk(self, seconds: float):
+        with self._lock:
+            self.first_chunk_seconds.append(seconds)
+        metrics.observe_stage("llm_first_chunk", seconds)
+
+    def hedge_delay(self) -> Optional[float]:
+        if self.hedge_percentile <= 0 or len(self.backends) < 2:
+            return None
+        with self._lock:
+            samples = sorted(self.first_chunk_seconds)
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * self.hedge_percentile / 100))]
+
+    def open_stream(self, connect: Callable[[LlmBackend], Tuple], executor: Executor) -> Tuple[LlmBackend, Tuple]:
+        """
+        Runs connect(backend) on a backend until one returns, with hedging if enabled. connect has to raise
+        on failures and return once the first chunk is there. Returns the backend and the result of connect;
+        the caller releases the backend when the stream ends.
+        """
+        tried = []
+        errors = []
+        if self.hedge_delay() is None:
+            # no hedging, the attempts run one after another in the calling thread
+            while True:
+                backend = self.acquire(exclude=tried)
+                if backend is None:
+                    raise unavailable(errors)
+                tried.append(backend)
+                start = time.perf_counter()
+                try:
+                    result = connect(backend)
+                except Exception as e:
+                    self.release(backend, False)
+                    logging.warning(f"LLM backend {backend.url} failed: {e}")
+                    errors.append(e)
+                    continue
+                self.record_first_chunk(time.perf_counter() - start)
+                return backend, result
+
+        pending = {}
+
+        def launch() -> bool:
+            backend = self.acquire(exclude=tried)
+            if backend is None:
+                return False
+            tried.append(backend)
+            pending[executor.submit(connect, backend)] = (backend, time.perf_counter())
+            return True
+
+        launch()
+        hedged = False
+        while pending:
+            delay = self.hedge_delay() if not hedged else None
+            done, _ = wait(list(pending), timeout=delay, return_when=FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                if launch():
+                    self.hedges += 1
+                    metrics.LLM_HEDGES.inc()
+                continue
+            for future in done:
+                backend, start = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    self.release(backend, False)
+                    logging.warning(f"LLM backend {backend.url} failed: {e}")
+                    errors.append(e)
+                    if not pending:
+                        launch()
+                    continue
+                self.record_first_chunk(time.perf_counter() - start)
+                for other_future, (other, _) in pending.items():
+                    other_future.add_done_callback(lambda f, other=other: self._drop(other, f))
+                return backend, result
+        raise unavailable(errors)
+
+    def _drop(self, backend: LlmBackend, future):
+        # the hedge that lost: close its stream, which stops the generation on that backend
+        if future.exception() is not None:
+            self.release(backend, False)
+            return
+        response = future.result()[0]
+        response.close()
+        self.release(backend, None)
+
+    async def aopen_stream(self, connect: Callable[[LlmBackend], Awaitable[Tuple]]) -> Tuple[LlmBackend, Tuple]:
+        """open_stream for the event loop. connect has to close its response when it is cancelled."""
+        tried = []
+        errors = []
+        pending: Dict[asyncio.Task, Tuple[LlmBackend, float]] = {}
+
+        def launch() -> bool:
+            backend = self.acquire(exclude=tried)
+            if backend is None:
+                return False
+            tried.append(backend)
+            pending[asyncio.ensure_future(connect(backend))] = (backend, time.perf_counter())
+            return True
+
+        launch()
+        hedged = False
+        try:
+            while pending:
+                delay = self.hedge_delay() if not hedged else None
+                done, _ = await asyncio.wait(list(pending), timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    if launch():
+                        self.hedges += 1
+                        metrics.LLM_HEDGES.inc()
+                    continue
+                for task in done:
+                    backend, start = pending.pop(task)
+                    if task.exception() is not None:
+                        self.release(backend, False)
+                        logging.warning(f"LLM backend {backend.url} failed: {task.exception()}")
+                        errors.append(task.exception())
+                        if not pending:
+                            launch()
+                        continue
+                    self.record_first_chunk(time.perf_counter() - start)
+                    return backend, task.result()
+            raise unavailable(errors)
+        finally:
+            # the losing hedge, or all attempts if the client went away
+            for task, (backend, _) in pending.items():
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is not None:
+                    # failed in the same round as the winner, the breaker has to see it
+                    self.release(backend, False)
+                    logging.warning(f"LLM backend {backend.url} failed: {task.exception()}")
+                    continue
+                elif not task.cancelled():
+                    asyncio.ensure_future(task.result()[0].aclose())
+                self.release(backend, None)
+
+    def probe(self, get: Callable[[str], object]):
+        """Closes the breakers of paused backends whose health check succeeds."""
+        for backend in self.backends:
+            if backend.opened_at is None:
+                continue
+            try:
+                response = get(backend.health_url)
+                ok = response.status_code < 500
+            except Exception:
+                ok = False
+            if ok:
+                with self._lock:
+                    self._close_breaker(backend)
+
+    def start_health_probes(self, get: Callable[[str], object], interval: float):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.probe(get)
+                except Exception as e:
+                    logging.exception(e)
+        threading.Thread(target=run, name="llm-health", daemon=True).start()
+
+    def stats(self) -> Dict:
+        return {
+            "hedges": self.hedges,
+            "hedge_delay": self.hedge_delay(),
+            "backends": [{"url": b.url, "outstanding": b.outstanding, "failures": b.failures,
+                          "open": b.opened_at is not None} for b in self.backends]
+        }
@@ -0,0 +1,20 @@
+import logging
+import os
+
+
+def init_logging():
+    log_dir = "logs/"
+    if os.getenv("LOG_DIR") is not None:
+        log_dir = os.getenv("LOG_DIR")
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    logfile = os.path.join(log_dir, "technical_log.txt")
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[
+            logging.FileHandler(logfile),
+            logging.StreamHandler()
+        ]
+    )
@@ -0,0 +1,138 @@
+"""
+Prometheus metrics of the backend, served in the text format at /metrics. They are
+prometheus_client metrics; an observation costs about a microsecond, so the instrumentation
+stays on in production.
+
+Under gunicorn the workers run prometheus_client in its multiprocess mode: every worker
+writes its values to memory-mapped files in PROMETHEUS_MULTIPROC_DIR (set in
+gunicorn.conf.py before this module is imported), and /metrics adds up the files of all
+workers. Counters and histograms of exited workers are kept, their gauges are dropped
+(see process_exited).
+
+Some counts are kept by the objects themselves (e.g. the hits of a cache). They are copied
+into metrics by the collectors registered with collect_counter and collect_gauge, on every
+scrape and, under gunicorn, every METRICS_SYNC_SECONDS in every worker.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, \
+    disable_created_metrics, generate_latest, multiprocess
+
+# the *_created series double the output and are not written in the multiprocess mode anyway
+disable_created_metrics()
+
+# seconds, from fast in-process stages up to long LLM streams
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+STAGE_SECONDS = Histogram("chatbot_stage_seconds", "Duration of the stages of a turn", ["stage"],
+                          buckets=DEFAULT_BUCKETS)
+TURNS = Counter("chatbot_turns_total", "Planned turns by kind", ["kind"])
+STREAMS_IN_FLIGHT = Gauge("chatbot_streams_in_flight", "LLM streams that are currently forwarded to clients",
+                          multiprocess_mode="livesum")
+TOKENS_STREAMED = Counter("chatbot_tokens_streamed_total", "LLM tokens forwarded to clients")
+ERRORS = Counter("chatbot_errors_total", "Errors by component", ["component"])
+RESPONSE_CACHE_REPLAYS = Counter("chatbot_response_cache_replays_total", "Turns answered from the response cache")
+CANCELLED_STREAMS = Counter("chatbot_cancelled_streams_total", "Answers aborted because the client disconnected")
+TOKENS_SAVED = Counter("chatbot_cancelled_tokens_saved_total",
+                       "LLM tokens not generated because the client disconnected (max_new_tokens minus generated tokens)")
+LLM_OUTSTANDING = Gauge("chatbot_llm_outstanding", "Open streams per LLM backend", ["backend"],
+                        multiprocess_mode="livesum")
+LLM_CIRCUIT_OPEN = Gauge("chatbot_llm_circuit_open", "1 while the circuit breaker of an LLM backend is open", ["backend"],
+                         multiprocess_mode="livemax")
+LLM_HEDGES = Counter("chatbot_llm_hedges_total", "Streams that were sent to a second LLM backend because the first was slow")
+ADMISSION_WAITING = Gauge("chatbot_admission_waiting", "Turns waiting for an LLM slot", multiprocess_mode="livesum")
+ADMISSION_REJECTED = Counter("chatbot_admission_rejected_total", "Turns rejected by the admission control", ["reason"])
+CHAT_LOG_DROPPED = Counter("chatbot_chat_log_dropped_total", "Chat log records dropped because the queue was full")
+# the caches count their lookups themselves, the values are copied by collect_cache_stats
+CACHE_HITS = Counter("chatbot_cache_hits_total", "Lookups answered by an in-process cache", ["cache"])
+CACHE_MISSES = Counter("chatbot_cache_misses_total", "Lookups an in-process cache could not answer", ["cache"])
+CACHE_EVICTIONS = Counter("chatbot_cache_evictions_total", "Entries dropped from an in-process cache", ["cache"])
+CACHE_ENTRIES = Gauge("chatbot_cache_entries", "Entries in an in-process cache", ["cache"], multiprocess_mode="livesum")
+NLU_COALESCED = Counter("chatbot_nlu_cache_coalesced_total",
+                        "NLU parses that waited for an identical parse in flight instead of calling RASA")
+
+# name -> function that copies a count kept elsewhere into its metric
+_collectors: Dict[str, Callable[[], None]] = {}
+_collectors_lock = threading.Lock()
+
+
+def stage(name: str):
+    """Context manager that observes the duration of a stage of a turn."""
+    return STAGE_SECONDS.labels(name).time()
+
+
+def observe_stage(name: str, seconds: float):
+    STAGE_SECONDS.labels(name).observe(seconds)
+
+
+def collect_counter(name: str, counter, read: Callable[[], float]):
+    """Keeps counter (a metric or one of its labels) at the count read() returns, which only grows."""
+    last = 0
+
+    def collect():
+        nonlocal last
+        value = read()
+        if value > last:
+            counter.inc(value - last)
+        # a smaller value is a new count (e.g. of a rebuilt cache), it continues from there
+        last = value
+
+    with _collectors_lock:
+        _collectors[name] = collect
+
+
+def collect_gauge(name: str, gauge, read: Callable[[], float]):
+    with _collectors_lock:
+        _collectors[name] = lambda: gauge.set(read())
+
+
+def collect_cache_stats(cache: str, stats: Callable[[], Dict]):
+    """Exports the hit, miss and eviction counters and the size of a cache from its stats()."""
+    for metric, key in ((CACHE_HITS, "hits"), (CACHE_MISSES, "misses"), (CACHE_EVICTIONS, "evictions")):
+        collect_counter(f"cache_{key}:{cache}", metric.labels(cache), lambda key=key: stats()[key])
+    collect_gauge(f"cache_entries:{cache}", CACHE_ENTRIES.labels(cache), lambda: stats()["entries"])
+
+
+def sync_collected():
+    with _collectors_lock:
+        for name, collect in _collectors.items():
+            try:
+                collect()
+            except Exception as e:
+                logging.warning(f"Could not collect the metric {name} ({e})")
+
+
+def start_collector_sync(interval: float = 1.0):
+    """Copies the collected counts every interval seconds, so that a scrape served by another worker sees them."""
+
+    def run():
+        while True:
+            time.sleep(interval)
+            sync_collected()
+
+    threading.Thread(target=run, name="metrics-sync", daemon=True).start()
+
+
+def multiprocess_directory():
+    return os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+
+def process_exited(pid: int):
+    """Drops the gauges of an exited worker, its counters and histograms stay in the sums."""
+    if multiprocess_directory():
+        multiprocess.mark_process_dead(pid)
+
+
+def render() -> bytes:
+    sync_collected()
+    if not multiprocess_directory():
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
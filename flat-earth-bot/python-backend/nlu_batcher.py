@@ -0,0 +1,117 @@
+"""
+Micro-batching of NLU parse requests. Texts that arrive within a short window (or until
+max_batch texts are waiting) are sent to RASA in one batch request, so the NLU server
+handles one request per batch instead of one per turn. This coalesces requests only: RASA
+still classifies the texts of a batch one by one.
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional
+
+
+class NluBatcher:
+
+    def __init__(self, parse_batch: Callable[[List[str]], List[Optional[Dict]]], window: float = 0.005,
+                 max_batch: int = 32, max_workers: int = 4):
+        self.parse_batch = parse_batch
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.texts = 0
+        self.queue = queue.Queue()
+        # batches are sent from a pool, so a slow batch does not hold back the collection of the next one
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="nlu-batch")
+        threading.Thread(target=self._collect, name="nlu-batcher", daemon=True).start()
+
+    def parse(self, text: str) -> Optional[Dict]:
+        future = Future()
+        self.queue.put((text, future))
+        return future.result()
+
+    def _collect(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.executor.submit(self._run, batch)
+
+    def _run(self, batch):
+        self.batches += 1
+        self.texts += len(batch)
+        try:
+            results = self.parse_batch([text for text, _ in batch])
+        except Exception as e:
+            logging.error("NLU batch failed")
+            logging.exception(e)
+            results = [None] * len(batch)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def stats(self) -> Dict:
+        return {"batches": self.batches, "texts": self.texts,
+                "mean_batch_size": round(self.texts / self.batches, 2) if self.batches else 0.0}
+
+
+class AsyncNluBatcher:
+
+    def __init__(self, parse_batch: Callable[[List[str]], Awaitable[List[Optional[Dict]]]], window: float = 0.005,
+                 max_batch: int = 32):
+        self.parse_batch = parse_batch
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.texts = 0
+        self.pending = []
+        self.timer = None
+        # the event loop only keeps weak references to tasks, a batch in flight must not be collected
+        self.tasks = set()
+
+    async def parse(self, text: str) -> Optional[Dict]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((text, future))
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, batch):
+        self.batches += 1
+        self.texts += len(batch)
+        try:
+            results = await self.parse_batch([text for text, _ in batch])
+        except Exception as e:
+            logging.error("NLU batch failed")
+            logging.exception(e)
+            results = [None] * len(batch)
+        for (_, future), result in zip(batch, results):
+            # the turn waiting for it may have been cancelled in the meantime
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> Dict:
+        return {"batches": self.batches, "texts": self.texts,
+                "mean_batch_size": round(self.texts / self.batches, 2) if self.batches else 0.0}
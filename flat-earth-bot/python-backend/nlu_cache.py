@@ -0,0 +1,105 @@
+"""
+Bounded LRU + TTL cache for RASA NLU parse results. Texts are normalized before the
+lookup, and concurrent parses of the same text are coalesced into one upstream call.
+"""
+
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, Optional
+
+from caching import TTLCache
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class _InFlight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class NluCache:
+
+    def __init__(self, max_entries: int = 4096, ttl: float = 3600):
+        self.cache = TTLCache(max_entries=max_entries, ttl=ttl)
+        self.coalesced = 0
+        self._in_flight = {}
+        self._async_in_flight = {}
+        self._lock = threading.Lock()
+
+    def parse(self, text: str, parse_fn: Callable[[str], Optional[Dict]]) -> Optional[Dict]:
+        key = normalize_text(text)
+        result = self.cache.get(key)
+        if result is not None:
+            return self._with_text(result, text)
+
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _InFlight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            return self._with_text(call.result, text)
+
+        try:
+            call.result = parse_fn(text)
+            if call.result is not None:
+                self.cache.set(key, call.result)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.event.set()
+        return call.result
+
+    async def aparse(self, text: str, parse_fn: Callable[[str], Awaitable[Optional[Dict]]]) -> Optional[Dict]:
+        key = normalize_text(text)
+        result = self.cache.get(key)
+        if result is not None:
+            return self._with_text(result, text)
+
+        future = self._async_in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        while future is not None:
+            try:
+                return self._with_text(await asyncio.shield(future), text)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+            # the leader was cancelled (e.g. its client went away), a follower parses the text instead
+            future = self._async_in_flight.get(key)
+
+        future = self._async_in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await parse_fn(text)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # the followers raise it too, asyncio must not report it as never retrieved without followers
+            future.exception()
+            raise
+        finally:
+            del self._async_in_flight[key]
+        if result is not None:
+            self.cache.set(key, result)
+        future.set_result(result)
+        return result
+
+    def stats(self) -> Dict:
+        stats = self.cache.stats()
+        stats["coalesced"] = self.coalesced
+        return stats
+
+    def _with_text(self, result: Optional[Dict], text: str) -> Optional[Dict]:
+        # the cached response may belong to a differently cased or spaced text
+        if result is None or result.get("text") == text:
+            return result
+        return dict(result, text=text)
@@ -0,0 +1,39 @@
+"""
+Reads the NLU training examples of the RASA project (rasa-nlu/data/nlu.yml), for tools
+that need the same intents as the RASA model without running RASA.
+"""
+
+import os
+import re
+from typing import Dict, List
+
+DEFAULT_NLU_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rasa-nlu", "data", "nlu.yml")
+
+# [text](entity) or [text]{"entity": ...} annotations are reduced to their text
+ENTITY_ANNOTATION = re.compile(r"\[([^\]]+)\](\([^)]*\)|\{[^}]*\})")
+
+
+def load_nlu_examples(path: str = None) -> Dict[str, List[str]]:
+    """Returns the example texts per intent, in the order of the file."""
+    path = path or os.getenv("NLU_DATA_PATH", DEFAULT_NLU_DATA_PATH)
+    examples = {}
+    intent = None
+    in_examples = False
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            stripped = line.strip()
+            if stripped.startswith("- intent:"):
+                intent = stripped[len("- intent:"):].strip()
+                examples.setdefault(intent, [])
+                in_examples = False
+            elif stripped.startswith("examples:"):
+                in_examples = intent is not None
+            elif stripped.startswith("- ") and in_examples and line.startswith("    "):
+                text = ENTITY_ANNOTATION.sub(r"\1", stripped[2:].strip())
+                if text:
+                    examples[intent].append(text)
+            elif stripped and not line.startswith("    "):
+                # a new top level block such as "- synonym:" or "- regex:"
+                in_examples = False
+                intent = None
+    return examples
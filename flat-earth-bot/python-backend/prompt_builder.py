@@ -0,0 +1,107 @@
+"""
+Assembles prompts from static prompt fragments and the dialog, within a length budget.
+
+The combinations of static fragments (persona, sentiment and intent prompt) are joined
+once at startup. The rendered dialog is cached per session, so a turn only renders the
+messages that were added since the last turn. When the prompt would exceed the budget,
+the oldest messages are dropped; the cache keeps the whole dialog, so a turn with a larger
+budget gets them back.
+
+The "prefix_cache" layout puts the stable part of the prompt first (persona and dialog
+history) and the instructions that change every turn last, so an LLM server with a
+prefix (KV) cache can reuse the whole conversation of the previous turn.
+"""
+
+import bisect
+import itertools
+import logging
+from collections import namedtuple
+from typing import Dict, Iterable, List
+
+from caching import TTLCache
+
+# messages: the messages rendered so far (to detect a different history), text: their rendered lines, each
+# followed by "\n", offsets: the position of every line in text and its length at the end, start: the first
+# line of the prompt in the prefix_cache layout, which only moves forward
+RenderedDialog = namedtuple("RenderedDialog", ["messages", "text", "offsets", "start"])
+# rough size of a message dict kept for the comparison with the next history
+MESSAGE_BYTES = 200
+
+
+def render_message(message: Dict) -> str:
+    return f"{message['sender']}: {message['message'].strip()}"
+
+
+def dialog_size(dialog: RenderedDialog) -> int:
+    return 2 * len(dialog.text) + MESSAGE_BYTES * len(dialog.messages)
+
+
+class PromptBuilder:
+
+    def __init__(self, max_length: int = 15000, cache_max_bytes: int = 64 * 1024 * 1024, cache_ttl: float = 6 * 3600,
+                 layout: str = "default", trim_ratio: float = 0.75):
+        if layout not in ("default", "prefix_cache"):
+            raise ValueError(f"Unknown prompt layout {layout}, use default or prefix_cache")
+        self.max_length = max_length
+        self.layout = layout
+        # in the prefix_cache layout the dialog is trimmed to trim_ratio of its budget at once, so that the
+        # prompt prefix stays the same for several turns instead of changing with every turn
+        self.trim_ratio = trim_ratio if layout == "prefix_cache" else 1.0
+        self.prefixes = {}
+        self.dialogs = TTLCache(max_entries=100000, ttl=cache_ttl, max_bytes=cache_max_bytes, sizeof=dialog_size)
+
+    def precompute(self, *segment_choices: Iterable[str]):
+        """Joins every combination of the given static segments, one choice per segment."""
+        for parts in itertools.product(*segment_choices):
+            self.prefixes[parts] = "".join(parts)
+        logging.info(f"Precomputed {len(self.prefixes)} prompt prefixes")
+
+    def prefix(self, *parts: str) -> str:
+        prefix = self.prefixes.get(parts)
+        if prefix is None:
+            prefix = "".join(parts)
+        return prefix
+
+    def build(self, session_id: str, messages: List[Dict], persona: str, *instructions: str) -> str:
+        if self.layout == "prefix_cache":
+            return self.build_prefix_cached(session_id, messages, persona, *instructions)
+        prefix = self.prefix(persona, *instructions)
+        return prefix + self.render_dialog(session_id, messages, self.max_length - len(prefix))
+
+    def build_prefix_cached(self, session_id: str, messages: List[Dict], persona: str, *instructions: str) -> str:
+        instruction_text = self.prefix(*instructions)
+        cue = f"{messages[0]['sender']}: "
+        budget = self.max_length - len(persona) - len(instruction_text) - len(cue)
+        return persona + self.render_history(session_id, messages, budget) + "\n" + instruction_text + cue
+
+    def render_dialog(self, session_id: str, messages: List[Dict], budget: int) -> str:
+        """Renders the dialog like Chatbot.build_dialog, dropping the oldest messages that do not fit into budget."""
+        cue = f"{messages[0]['sender']}: "
+        return self.render_history(session_id, messages, budget - len(cue)) + "\n" + cue
+
+    def render_history(self, session_id: str, messages: List[Dict], budget: int) -> str:
+        dialog = self.dialogs.get(session_id) if session_id is not None else None
+        count = len(dialog.messages) if dialog is not None else 0
+        if 0 < count <= len(messages) and messages[:count] == dialog.messages:
+            new_lines = [render_message(message) for message in messages[count:]]
+            text = dialog.text + "".join(line + "\n" for line in new_lines)
+            offsets = dialog.offsets + list(itertools.accumulate((len(line) + 1 for line in new_lines),
+                                                                 initial=dialog.offsets[-1]))[1:]
+            start = dialog.start
+        else:
+            lines = [render_message(message) for message in messages]
+            text = "".join(line + "\n" for line in lines)
+            offsets = list(itertools.accumulate((len(line) + 1 for line in lines), initial=0))
+            start = 0
+
+        # always keep the latest message, even if it alone exceeds the budget
+        length = offsets[-1]
+        if length - offsets[start] > budget:
+            target = budget * self.trim_ratio
+            start = max(start, min(bisect.bisect_left(offsets, length - target), len(messages) - 1))
+
+        if session_id is not None:
+            # only the prefix_cache layout keeps its start, the default layout trims every turn to its budget
+            self.dialogs.set(session_id, RenderedDialog(list(messages), text, offsets,
+                                                        start if self.layout == "prefix_cache" else 0))
+        return text[offsets[start]:length - 1]
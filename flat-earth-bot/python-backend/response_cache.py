@@ -0,0 +1,53 @@
+"""
+Cache of generated LLM streams for turns with a constant prompt (quiz prompts, quiz answers,
+closure). A turn is keyed by a hash of its prompt and llm_parameters. Each key keeps up to
+`variants` generations; until they are collected the LLM is still called, then a
+random one is replayed, so sampled answers do not become a single fixed sentence. Greedy
+decoding (no do_sample) needs one variant only.
+"""
+
+import hashlib
+import json
+import random
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from caching import TTLCache
+
+
+class ResponseCache:
+
+    def __init__(self, max_entries: int = 256, ttl: float = 24 * 3600, variants: int = 3):
+        self.cache = TTLCache(max_entries=max_entries, ttl=ttl)
+        self.variants = variants
+        self.replays = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(prompt: str, llm_parameter: Dict) -> str:
+        payload = json.dumps([prompt, llm_parameter], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def variants_needed(self, llm_parameter: Dict) -> int:
+        return self.variants if llm_parameter.get("do_sample") else 1
+
+    def get(self, key: str, llm_parameter: Dict) -> Optional[Tuple[List[bytes], str]]:
+        """Returns (stream chunks, generated text) of a cached generation, or None if the LLM has to be called."""
+        variants = self.cache.get(key)
+        if variants is None or len(variants) < self.variants_needed(llm_parameter):
+            return None
+        self.replays += 1
+        return random.choice(variants)
+
+    def add(self, key: str, llm_parameter: Dict, chunks: List[bytes], text: str):
+        with self._lock:
+            variants = list(self.cache.get(key) or [])
+            if len(variants) >= self.variants_needed(llm_parameter):
+                return
+            variants.append((chunks, text))
+            self.cache.set(key, variants)
+
+    def stats(self) -> Dict:
+        stats = self.cache.stats()
+        stats["replays"] = self.replays
+        return stats
@@ -4,12 +4,15 @@ to test and develop it without the api.
 """
 
 import json
+import os
 
 from chatbot import llm_stream_to_str
 from chatbot_implementation import ChatbotImplementation
 
 if __name__ == "__main__":
 
+    # print the whole logging info of the turn, with the prompt
+    os.environ.setdefault("SESSION_LAST_TURN", "full")
     chatbot = ChatbotImplementation()
 
     input_data = json.load(open("examples/request.json"))
@@ -24,5 +27,5 @@ if __name__ == "__main__":
     answer = llm_stream_to_str(answer)
 
     print(answer)
-    print(json.dumps(chatbot.last_logging_info, indent=4))
+    print(json.dumps(chatbot.get_last_logging_info(input_data["session_id"]), indent=4))
     
\ No newline at end of file
@@ -0,0 +1,238 @@
+"""
+Fast sentiment polarity with the results of TextBlob(text).sentiment.polarity.
+
+TextBlob loads the pattern lexicon (en-sentiment.xml) lazily on the first call and goes
+through several layers of lazy dictionaries for every word. This module stores the same
+lexicon, tokenizer rules and emoticons as arrays in models/sentiment_lexicon.npz and scores
+a text with the pattern algorithm (modifiers, negations, exclamation marks, emoticons) on
+plain dictionaries. Polarities of repeated texts are kept in an LRU cache.
+
+Build the lexicon file from the installed TextBlob (only needed after a TextBlob update):
+
+    python sentiment.py [--output models/sentiment_lexicon.npz]
+"""
+
+import argparse
+import functools
+import logging
+import os
+import re
+from typing import TYPE_CHECKING, Dict, List
+
+from caching import TTLCache
+
+if TYPE_CHECKING:
+    # numpy is only imported to read or write the .npz file, the workers load the lexicon from the warm state
+    import numpy as np
+
+DEFAULT_LEXICON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "sentiment_lexicon.npz")
+
+NEGATIONS = ("no", "not", "n't", "never")
+# the quote characters the TextBlob tokenizer separates from the words
+QUOTES = ("“", "”", "‘", "’", "'", '"')
+LINEBREAKS = re.compile(r"\n{2,}")
+
+
+class SentimentLexicon:
+
+    def __init__(self, words: List[str], polarity: "np.ndarray", subjectivity: "np.ndarray", intensity: "np.ndarray",
+                 modifier: "np.ndarray", emoticons: Dict[str, float], abbreviations: List[str],
+                 replacements: List[List[str]], patterns: Dict[str, str], punctuation: str):
+        # word -> (polarity, subjectivity, intensity, is_modifier), scalar access on python floats is faster than on arrays
+        self.words = dict(zip(words, zip(polarity.tolist(), subjectivity.tolist(), intensity.tolist(),
+                                         modifier.tolist())))
+        self.emoticons = emoticons
+        self.abbreviations = frozenset(abbreviations)
+        self.replacements = [tuple(pair) for pair in replacements]
+        self.patterns = patterns
+        self.punctuation = punctuation
+        self.leading_punctuation = tuple(punctuation.replace(".", ""))
+        self.trailing_punctuation = self.leading_punctuation + (".",)
+        self.abbreviation_patterns = [re.compile(patterns[name]) for name in ("abbr1", "abbr2", "abbr3")]
+        self.sarcasm = re.compile(patterns["sarcasm"])
+        self.emoticon_pattern = re.compile(patterns["emoticons"])
+
+    def tokenize(self, text: str) -> List[str]:
+        """The lower cased tokens of the TextBlob tokenizer (textblob._text.find_tokens)."""
+        for old, new in self.replacements:
+            if old in text:
+                text = text.replace(old, new)
+        for quote in QUOTES:
+            if quote in text:
+                text = text.replace(quote, f" {quote} ")
+        text = LINEBREAKS.sub(" ", text.replace("\r\n", "\n"))
+        tokens = []
+        for t in text.split():
+            tail = []
+            while t.startswith(self.leading_punctuation):
+                tokens.append(t[0])
+                t = t[1:]
+            while t.endswith(self.trailing_punctuation):
+                if t.endswith(self.leading_punctuation):
+                    tail.append(t[-1])
+                    t = t[:-1]
+                if t.endswith("..."):
+                    tail.append("...")
+                    t = t[:-3].rstrip(".")
+                if t.endswith("."):
+                    if t in self.abbreviations or any(p.match(t) for p in self.abbreviation_patterns):
+                        break
+                    tail.append(t[-1])
+                    t = t[:-1]
+            if t:
+                tokens.append(t)
+            tokens.extend(reversed(tail))
+        joined = " ".join(tokens)
+        if "!" in joined:
+            joined = self.sarcasm.sub("(!)", joined)
+        joined = self.emoticon_pattern.sub(lambda m: m.group(1).replace(" ", "") + m.group(2), joined)
+        return joined.lower().split()
+
+    def polarity(self, text: str) -> float:
+        """The polarity of pattern.en.sentiment, see textblob._text.Sentiment.assessments."""
+        assessments = []  # [polarity, intensity, negated]
+        modifier = None
+        negation = None
+        for w in self.tokenize(text):
+            entry = self.words.get(w)
+            if entry is not None:
+                p, _, i, is_modifier = entry
+                if modifier is None:
+                    assessments.append([p, i, False])
+                else:
+                    # "really good"
+                    last = assessments[-1]
+                    last[0] = max(-1.0, min(p * last[1], 1.0))
+                    last[1] = i
+                if negation is not None:
+                    # "not good"
+                    assessments[-1][1] = 1.0 / assessments[-1][1]
+                    assessments[-1][2] = True
+                modifier = w if is_modifier else None
+                negation = w if w in NEGATIONS else None
+            else:
+                if w in NEGATIONS:
+                    negation = w
+                elif negation and len(w.strip("'")) > 1:
+                    negation = None
+                if negation is not None and modifier is not None and modifier.endswith("ly"):
+                    # "really not good"
+                    assessments[-1][2] = True
+                    negation = None
+                elif modifier and len(w) > 2:
+                    modifier = None
+                if w == "!" and assessments:
+                    assessments[-1][0] = max(-1.0, min(assessments[-1][0] * 1.25, 1.0))
+                if w == "(!)":
+                    assessments.append([0.0, 1.0, False])
+                if not w.isalpha() and len(w) <= 5 and w not in self.punctuation:
+                    emoticon = self.emoticons.get(w)
+                    if emoticon is not None:
+                        assessments.append([emoticon, 1.0, False])
+        if not assessments:
+            return 0.0
+        return sum(p * -0.5 if negated else p for p, _, negated in assessments) / len(assessments)
+
+    def save(self, path: str):
+        import numpy as np
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        words = list(self.words)
+        columns = list(zip(*self.words.values()))
+        np.savez_compressed(
+            path, words=np.array(words), polarity=np.array(columns[0]), subjectivity=np.array(columns[1]),
+            intensity=np.array(columns[2]), modifier=np.array(columns[3], dtype=bool),
+            emoticons=np.array(list(self.emoticons)), emoticon_polarity=np.array(list(self.emoticons.values())),
+            abbreviations=np.array(sorted(self.abbreviations)), replacements=np.array(self.replacements),
+            pattern_names=np.array(list(self.patterns)), pattern_values=np.array(list(self.patterns.values())),
+            punctuation=np.array(self.punctuation))
+
+    @classmethod
+    def load(cls, path: str) -> "SentimentLexicon":
+        import numpy as np
+
+        with np.load(path) as lexicon:
+            return cls(lexicon["words"].tolist(), lexicon["polarity"], lexicon["subjectivity"], lexicon["intensity"],
+                       lexicon["modifier"], dict(zip(lexicon["emoticons"].tolist(),
+                                                     lexicon["emoticon_polarity"].tolist())),
+                       lexicon["abbreviations"].tolist(), lexicon["replacements"].tolist(),
+                       dict(zip(lexicon["pattern_names"].tolist(), lexicon["pattern_values"].tolist())),
+                       str(lexicon["punctuation"]))
+
+    @classmethod
+    def from_textblob(cls) -> "SentimentLexicon":
+        import numpy as np
+        from textblob import _text
+        from textblob.en import sentiment
+
+        sentiment.load()
+        entries = dict.items(sentiment)
+        words = [w for w, _ in entries]
+        scores = np.array([pos[None] for _, pos in entries], dtype=np.float64)
+        modifier = np.array(["RB" in pos for _, pos in entries], dtype=bool)
+        emoticons = {}
+        for (_, polarity), faces in _text.EMOTICONS.items():
+            for face in faces:
+                emoticons.setdefault(face.lower(), polarity)
+        patterns = {"abbr1": _text.RE_ABBR1.pattern, "abbr2": _text.RE_ABBR2.pattern, "abbr3": _text.RE_ABBR3.pattern,
+                    "sarcasm": _text.RE_SARCASM.pattern, "emoticons": _text.RE_EMOTICONS.pattern}
+        return cls(words, scores[:, 0], scores[:, 1], scores[:, 2], modifier, emoticons, sorted(_text.ABBREVIATIONS),
+                   [list(pair) for pair in _text.replacements.items()], patterns, _text.PUNCTUATION)
+
+
+class SentimentAnalyzer:
+
+    def __init__(self, lexicon: SentimentLexicon, cache_size: int = 4096):
+        self.lexicon = lexicon
+        self.cache = TTLCache(max_entries=cache_size) if cache_size > 0 else None
+
+    def polarity(self, text: str) -> float:
+        if self.cache is None:
+            return self.lexicon.polarity(text)
+        polarity = self.cache.get(text)
+        if polarity is None:
+            polarity = self.lexicon.polarity(text)
+            self.cache.set(text, polarity)
+        return polarity
+
+    def warm_up(self):
+        # touches the tokenizer and the scoring once, so the first user does not pay for it
+        self.lexicon.polarity("This is a really good warm up, not a bad one! :)")
+
+
+@functools.lru_cache(maxsize=None)
+def read_sentiment_lexicon(path: str) -> SentimentLexicon:
+    try:
+        return SentimentLexicon.load(path)
+    except Exception as e:
+        logging.warning(f"Could not load the sentiment lexicon from {path} ({e}), reading it from TextBlob")
+        return SentimentLexicon.from_textblob()
+
+
+def load_sentiment_lexicon(path: str = None) -> SentimentLexicon:
+    """The lexicon is read-only, all analyzers of a process (and forked workers) share one copy."""
+    from warm_state import load_warm_state
+
+    path = path or os.getenv("SENTIMENT_LEXICON_PATH", DEFAULT_LEXICON_PATH)
+    warm_state = load_warm_state()
+    if warm_state is not None and warm_state.lexicon_path == os.path.abspath(path):
+        return warm_state.lexicon
+    return read_sentiment_lexicon(path)
+
+
+def load_sentiment_analyzer(path: str = None) -> SentimentAnalyzer:
+    lexicon = load_sentiment_lexicon(path)
+    analyzer = SentimentAnalyzer(lexicon, cache_size=int(os.getenv("SENTIMENT_CACHE_SIZE", 4096)))
+    analyzer.warm_up()
+    return analyzer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=DEFAULT_LEXICON_PATH)
+    args = parser.parse_args()
+    built = SentimentLexicon.from_textblob()
+    built.save(args.output)
+    print(f"Saved {len(built.words)} words to {args.output} ({os.path.getsize(args.output) / 1024:.0f} KiB)")
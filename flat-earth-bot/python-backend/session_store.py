@@ -0,0 +1,275 @@
+"""
+Per session dialog state (quiz progress, hints, detected intents), keyed by session_id.
+
+The in-process MemorySessionStore is the default. SqliteSessionStore keeps the state in a
+SQLite file that several worker processes can share, so requests of one session can be
+served by any worker behind nginx.
+
+A state is a SessionState with __slots__ that reads and writes like the dict it used to be
+(state["hint_count"] += 1). The intent flags are the bits of one int, their names are shared
+by all sessions. The logging info of the last turn is kept like a record of the delta chat
+log: only the messages of that turn, with the number of messages before them, and a hash of
+the prompt; the full history arrives with every request anyway.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections.abc import MutableMapping
+from typing import Dict, Tuple
+
+from caching import TTLCache
+from chat_logger import delta_record
+
+# one tuple of flag names per dialog policy, shared by the sessions
+_flag_names: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+
+
+def shared_flag_names(names: Tuple[str, ...]) -> Tuple[str, ...]:
+    return _flag_names.setdefault(names, names)
+
+
+class IntentFlags(MutableMapping):
+    """The boolean intent flags of a session, as a mapping over the bits of one int."""
+
+    __slots__ = ("names", "bits")
+
+    def __init__(self, names: Tuple[str, ...], bits: int = 0):
+        self.names = shared_flag_names(tuple(names))
+        self.bits = bits
+
+    @classmethod
+    def from_dict(cls, flags: Dict[str, bool]) -> "IntentFlags":
+        names = tuple(flags)
+        return cls(names, sum(1 << i for i, name in enumerate(names) if flags[name]))
+
+    def _bit(self, name: str) -> int:
+        try:
+            return 1 << self.names.index(name)
+        except ValueError:
+            raise KeyError(name) from None
+
+    def __getitem__(self, name: str) -> bool:
+        return self.bits & self._bit(name) != 0
+
+    def __setitem__(self, name: str, value: bool):
+        if name not in self.names:
+            # a flag the dialog policy got after the session started
+            self.names = shared_flag_names(self.names + (name,))
+        bit = self._bit(name)
+        self.bits = self.bits | bit if value else self.bits & ~bit
+
+    def __delitem__(self, name: str):
+        raise TypeError("Intent flags can not be removed, set them to False")
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __repr__(self) -> str:
+        return f"IntentFlags({dict(self)})"
+
+
+class SessionState(MutableMapping):
+    """
+    hinting:           hints given since the last quiz question
+    hint_count:        quiz questions asked so far
+    correct_answer:    the answers of the asked quiz questions
+    intent_flags:      IntentFlags, None until the chatbot initializes the session
+    last_logging_info: the logging info of the last turn (see compact_logging_info)
+    message_count:     number of messages of the last turn, the offset of the next delta
+    """
+
+    __slots__ = ("hinting", "hint_count", "correct_answer", "intent_flags", "last_logging_info", "message_count")
+
+    def __init__(self, hinting: int = 0, hint_count: int = 0, correct_answer=None, intent_flags=None,
+                 last_logging_info: Dict = None, message_count: int = 0):
+        self.hinting = hinting
+        self.hint_count = hint_count
+        self.correct_answer = correct_answer if correct_answer is not None else []
+        self.intent_flags = intent_flags
+        self.last_logging_info = last_logging_info
+        self.message_count = message_count
+
+    @classmethod
+    def from_dict(cls, state: Dict) -> "SessionState":
+        flags = state.get("intent_flags")
+        return cls(state.get("hinting", 0), state.get("hint_count", 0), state.get("correct_answer"),
+                   IntentFlags.from_dict(flags) if flags is not None else None, state.get("last_logging_info"),
+                   state.get("message_count", 0))
+
+    def to_dict(self) -> Dict:
+        state = dict(self)
+        if self.intent_flags is not None:
+            state["intent_flags"] = dict(self.intent_flags)
+        return state
+
+    def __getitem__(self, key: str):
+        if key not in self.__slots__ or (key == "intent_flags" and self.intent_flags is None):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value):
+        if key not in self.__slots__:
+            raise KeyError(f"{key} is not a field of the session state")
+        if key == "intent_flags" and value is not None and not isinstance(value, IntentFlags):
+            value = IntentFlags.from_dict(value)
+        setattr(self, key, value)
+
+    def __delitem__(self, key: str):
+        if key != "intent_flags":
+            raise TypeError(f"{key} can not be removed from the session state")
+        self.intent_flags = None
+
+    def __iter__(self):
+        return (key for key in self.__slots__ if key != "intent_flags" or self.intent_flags is not None)
+
+    def __len__(self) -> int:
+        return len(self.__slots__) - (self.intent_flags is None)
+
+    def __repr__(self) -> str:
+        return f"SessionState({dict(self)})"
+
+
+def new_session_state() -> SessionState:
+    return SessionState()
+
+
+def compact_logging_info(logging_info: Dict, offset: int) -> Dict:
+    """
+    The logging info of a turn as the session keeps it: only the messages after offset, with
+    interned sender names, and a hash instead of the prompt (the same form as the delta chat log).
+    """
+    record = delta_record(logging_info, offset)
+    record["messages"] = [dict(message, sender=sys.intern(message["sender"])) for message in record["messages"]]
+    return record
+
+
+def state_size(state: SessionState) -> int:
+    return len(json.dumps(state.to_dict()))
+
+
+class SessionStore(ABC):
+
+    @abstractmethod
+    def load(self, session_id: str) -> SessionState:
+        """Returns the state of the session, or a fresh state if the session is unknown or expired."""
+        pass
+
+    @abstractmethod
+    def save(self, session_id: str, state: SessionState):
+        pass
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemorySessionStore(SessionStore):
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 6 * 3600, max_bytes: int = None):
+        self.cache = TTLCache(max_entries=max_entries, ttl=ttl, max_bytes=max_bytes,
+                              sizeof=state_size if max_bytes is not None else None)
+
+    def load(self, session_id: str) -> SessionState:
+        state = self.cache.get(session_id)
+        if state is None:
+            state = new_session_state()
+        return state
+
+    def save(self, session_id: str, state: SessionState):
+        self.cache.set(session_id, state)
+
+    def delete(self, session_id: str):
+        self.cache.pop(session_id)
+
+
+class SqliteSessionStore(SessionStore):
+
+    def __init__(self, path: str, max_entries: int = 100000, ttl: float = 6 * 3600, cleanup_interval: int = 500):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self._saves = 0
+        self._saves_lock = threading.Lock()
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections must not be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def load(self, session_id: str) -> SessionState:
+        row = self._connection().execute(
+            "SELECT state FROM sessions WHERE session_id = ? AND updated_at > ?",
+            (session_id, time.time() - self.ttl)
+        ).fetchone()
+        if row is None:
+            return new_session_state()
+        return SessionState.from_dict(json.loads(row[0]))
+
+    def save(self, session_id: str, state: SessionState):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO sessions (session_id, state, updated_at) VALUES (?, ?, ?)",
+            (session_id, json.dumps(state.to_dict()), time.time())
+        )
+        with self._saves_lock:
+            self._saves += 1
+            cleanup = self._saves % self.cleanup_interval == 0
+        if cleanup:
+            self.evict()
+
+    def delete(self, session_id: str):
+        self._connection().execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def evict(self):
+        connection = self._connection()
+        connection.execute("DELETE FROM sessions WHERE updated_at <= ?", (time.time() - self.ttl,))
+        # least recently updated sessions go first once the store is full
+        connection.execute(
+            "DELETE FROM sessions WHERE session_id IN "
+            "(SELECT session_id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+def create_session_store() -> SessionStore:
+    backend = os.getenv("SESSION_STORE", "memory")
+    ttl = float(os.getenv("SESSION_TTL", 6 * 3600))
+    max_entries = int(os.getenv("SESSION_MAX_ENTRIES", 10000))
+    if backend not in ("memory", "sqlite"):
+        raise ValueError(f"Unknown SESSION_STORE {backend}, use memory or sqlite")
+    if backend == "sqlite":
+        path = os.getenv("SESSION_DB_PATH", os.path.join(os.getenv("LOG_DIR", "logs"), "sessions.sqlite"))
+        logging.info(f"Using sqlite session store at {path}")
+        return SqliteSessionStore(path, max_entries=max_entries, ttl=ttl)
+    max_bytes = os.getenv("SESSION_MAX_BYTES")
+    return MemorySessionStore(max_entries=max_entries, ttl=ttl,
+                              max_bytes=int(max_bytes) if max_bytes is not None else None)
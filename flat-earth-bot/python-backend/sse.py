@@ -0,0 +1,141 @@
+"""
+Incremental parser for server sent event streams such as the one of the LLM
+generate_stream endpoint. It works on the raw bytes of the network chunks and
+keeps incomplete events in a buffer, so events split across reads (or several
+events in one read) are handled correctly.
+"""
+
+import json
+import logging
+from collections import namedtuple
+from json.decoder import scanstring
+from typing import Iterable, List, Optional, Union
+
+SSEEvent = namedtuple("SSEEvent", ["field", "data"])
+
+# the line break the backend sends before the hint. The JSON string holds a raw line break, clients match the
+# event as it is. No SSE parser reads it (the line break splits the data line), so SSEParser recognizes the chunk
+NEWLINE_EVENT = 'data:{"index":-1,"token":{"id":-1,"text":"\n","logprob":0.0,"special":false},"generated_text":null,"details":null}\n\n'
+NEWLINE_EVENT_BYTES = NEWLINE_EVENT.encode("utf-8")
+NEWLINE_SSE_EVENT = SSEEvent("data", NEWLINE_EVENT_BYTES[len(b"data:"):-2].replace(b"\n", b"\\n"))
+
+
+def parse_event(block: bytes) -> Optional[SSEEvent]:
+    if b"\n" not in block:
+        # fast path for the usual single line event
+        if not block or block[:1] == b":":
+            return None
+        name, _, value = block.partition(b":")
+        if value[:1] == b" ":
+            value = value[1:]
+        return SSEEvent(name.decode("utf-8"), value)
+    field = None
+    values = []
+    for line in block.split(b"\n"):
+        if not line or line.startswith(b":"):
+            continue
+        name, _, value = line.partition(b":")
+        if value.startswith(b" "):
+            value = value[1:]
+        if field is None:
+            field = name
+        if name == field:
+            values.append(value)
+    if field is None:
+        return None
+    return SSEEvent(field.decode("utf-8"), b"\n".join(values))
+
+
+class SSEParser:
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self._scan_from = 0
+
+    def feed(self, chunk: Union[bytes, str]) -> List[SSEEvent]:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        if chunk == NEWLINE_EVENT_BYTES:
+            # always a chunk of its own, after the tokens of the LLM
+            return self.flush() + [NEWLINE_SSE_EVENT]
+        if b"\r" in chunk:
+            chunk = chunk.replace(b"\r\n", b"\n")
+        if not self.buffer and chunk.endswith(b"\n\n"):
+            # fast path: the chunk holds only complete events, no need to copy it into the buffer
+            events = []
+            for block in chunk[:-2].split(b"\n\n"):
+                event = parse_event(block)
+                if event is not None:
+                    events.append(event)
+            return events
+        self.buffer += chunk
+
+        events = []
+        start = 0
+        while True:
+            end = self.buffer.find(b"\n\n", max(start, self._scan_from))
+            if end < 0:
+                break
+            event = parse_event(bytes(self.buffer[start:end]))
+            if event is not None:
+                events.append(event)
+            start = end + 2
+            self._scan_from = start
+
+        if start:
+            del self.buffer[:start]
+        # the separator might start with the last byte of the buffer
+        self._scan_from = max(0, len(self.buffer) - 1)
+        return events
+
+    def flush(self) -> List[SSEEvent]:
+        """Returns the last event if the stream ended without a blank line."""
+        event = parse_event(bytes(self.buffer)) if self.buffer.strip() else None
+        self.buffer.clear()
+        self._scan_from = 0
+        return [event] if event is not None else []
+
+
+def token_text(event: SSEEvent) -> Optional[str]:
+    """Returns the generated text of an LLM token event, or None for other events."""
+    if event.field != "data":
+        return None
+    data = event.data
+    # fast path: read the token text without decoding the whole event. A quote inside a JSON string is
+    # escaped, so the first '"text":' is the key of the token object ("generated_text" comes after it)
+    position = data.find(b'"text":')
+    if position >= 0:
+        position += 7
+        if data[position:position + 1] == b" ":
+            position += 1
+        if data[position:position + 1] == b'"':
+            try:
+                return scanstring(data[position:].decode("utf-8"), 1)[0]
+            except ValueError:
+                pass
+    try:
+        payload = json.loads(data)
+    except ValueError:
+        logging.debug(f"Skipped a malformed SSE event: {data[:200]!r}")
+        return None
+    token = payload.get("token") if isinstance(payload, dict) else None
+    if token is None:
+        if isinstance(payload, dict) and "error" in payload:
+            logging.error(f"The LLM server sent an error: {payload['error']}")
+        return None
+    return token["text"]
+
+
+def stream_texts(chunks: Iterable[Union[bytes, str]]) -> List[str]:
+    parser = SSEParser()
+    texts = []
+    for chunk in chunks:
+        for event in parser.feed(chunk):
+            text = token_text(event)
+            if text is not None:
+                texts.append(text)
+    for event in parser.flush():
+        text = token_text(event)
+        if text is not None:
+            texts.append(text)
+    return texts
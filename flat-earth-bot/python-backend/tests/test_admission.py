@@ -0,0 +1,177 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from flask import Flask
+
+from admission import (AdmissionRejected, AdmittedStream, AsyncAdmissionController, ThreadAdmissionController)
+from chat_server import admission_rejected
+
+
+def acquire_in_thread(controller, session_id):
+    """Starts controller.acquire in a thread, the result is a ticket or an AdmissionRejected."""
+    result = {}
+
+    def run():
+        try:
+            result["value"] = controller.acquire(session_id)
+        except AdmissionRejected as e:
+            result["value"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, result
+
+
+def chunks(*items):
+    yield from items
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_queue_waits_for_a_free_slot():
+    controller = ThreadAdmissionController(max_streams=1)
+    first = controller.acquire("a")
+    thread, result = acquire_in_thread(controller, "b")
+    wait_until(lambda: len(controller.waiting) == 1)
+    assert "value" not in result
+    controller.release(first)
+    thread.join(1)
+    assert result["value"].granted_at is not None
+    assert controller.stats()["running"] == 1
+
+
+def test_session_waits_behind_its_running_turn():
+    controller = ThreadAdmissionController(max_streams=2, session_policy="queue")
+    first = controller.acquire("a")
+    thread, result = acquire_in_thread(controller, "a")
+    wait_until(lambda: len(controller.waiting) == 1)
+    # a free slot is not enough, the session still has a running turn
+    assert controller.acquire("b").granted_at is not None
+    assert "value" not in result
+    controller.release(first)
+    thread.join(1)
+    assert result["value"].granted_at is not None
+
+
+def test_queue_policy_rejects_a_third_request_with_429():
+    controller = ThreadAdmissionController(max_streams=1, session_policy="queue")
+    controller.acquire("a")
+    acquire_in_thread(controller, "a")
+    wait_until(lambda: len(controller.waiting) == 1)
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("a")
+    assert rejected.value.status == 429
+    assert "Retry-After" in rejected.value.headers()
+
+
+def test_supersede_marks_the_running_turn_and_rejects_the_waiting_one():
+    controller = ThreadAdmissionController(max_streams=1)
+    first = controller.acquire("a")
+    thread, result = acquire_in_thread(controller, "a")
+    wait_until(lambda: len(controller.waiting) == 1)
+    assert first.superseded
+    third, third_result = acquire_in_thread(controller, "a")
+    thread.join(1)
+    assert result["value"].status == 409
+    assert result["value"].headers() == {}
+    controller.release(first)
+    third.join(1)
+    assert third_result["value"].granted_at is not None
+
+
+def test_superseded_stream_stops_and_releases_its_slot():
+    controller = ThreadAdmissionController(max_streams=1)
+    ticket = controller.acquire("a")
+    stream = AdmittedStream(chunks(b"1", b"2", b"3"), ticket, controller.release, supersede=lambda: True)
+    assert next(stream) == b"1"
+    ticket.superseded = True
+    with pytest.raises(StopIteration):
+        next(stream)
+    assert controller.stats()["running"] == 0
+
+
+def test_logged_turn_is_not_stopped():
+    controller = ThreadAdmissionController(max_streams=1)
+    ticket = controller.acquire("a")
+    stream = AdmittedStream(chunks(b"1", b"2"), ticket, controller.release, supersede=lambda: False)
+    ticket.superseded = True
+    assert list(stream) == [b"1", b"2"]
+    assert controller.stats()["running"] == 0
+
+
+def test_full_queue_is_rejected_with_503():
+    controller = ThreadAdmissionController(max_streams=1, max_queue=1)
+    controller.acquire("a")
+    acquire_in_thread(controller, "b")
+    wait_until(lambda: len(controller.waiting) == 1)
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("c")
+    assert (rejected.value.status, rejected.value.reason) == (503, "queue_full")
+    assert int(rejected.value.headers()["Retry-After"]) >= 1
+
+
+def test_queue_timeout_is_rejected_with_503():
+    controller = ThreadAdmissionController(max_streams=1, queue_timeout=0.05)
+    controller.acquire("a")
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("b")
+    assert (rejected.value.status, rejected.value.reason) == (503, "queue_timeout")
+    assert not controller.waiting
+
+
+def test_async_controller_queue_and_timeout():
+    async def run():
+        controller = AsyncAdmissionController(max_streams=1, queue_timeout=0.05)
+        first = await controller.acquire("a")
+        waiting = asyncio.ensure_future(controller.acquire("b"))
+        await asyncio.sleep(0.01)
+        controller.release(first)
+        second = await waiting
+        assert second.granted_at is not None
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire("c")
+        assert rejected.value.reason == "queue_timeout"
+
+    asyncio.run(run())
+
+
+def test_async_controller_supersede():
+    async def run():
+        controller = AsyncAdmissionController(max_streams=1)
+        first = await controller.acquire("a")
+        waiting = asyncio.ensure_future(controller.acquire("a"))
+        await asyncio.sleep(0.01)
+        assert first.superseded
+        third = asyncio.ensure_future(controller.acquire("a"))
+        await asyncio.sleep(0.01)
+        with pytest.raises(AdmissionRejected) as rejected:
+            await waiting
+        assert rejected.value.status == 409
+        controller.release(first)
+        assert (await third).granted_at is not None
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("status,reason,retry_after", [(409, "superseded", None), (429, "session_busy", 3),
+                                                       (503, "queue_full", 7)])
+def test_rejections_are_answered_with_status_and_retry_after(status, reason, retry_after):
+    app = Flask(__name__)
+    app.register_error_handler(AdmissionRejected, admission_rejected)
+
+    @app.route("/api/chat", methods=["POST"])
+    def chat():
+        raise AdmissionRejected(status, reason, retry_after)
+
+    with app.test_request_context("/api/chat", method="POST", json={}):
+        response = app.full_dispatch_request()
+    assert response.status_code == status
+    assert response.get_json() == {"error": reason}
+    assert response.headers.get("Retry-After") == (str(retry_after) if retry_after is not None else None)
@@ -0,0 +1,63 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from chat_log_analytics import ChatLogStore, build_store
+from chat_logger import ChatLogWriter, delta_record, prompt_hash
+
+
+def turns():
+    """The logged turns of two interleaved sessions, the second one starts a new conversation."""
+    start = datetime(2024, 3, 1, 12, 0, 0)
+    histories = {"a": [{"sender": "Flat Earth Believer", "message": "I believe in flat earth"}],
+                 "b": [{"sender": "Flat Earth Believer", "message": "The earth is flat"}]}
+    records = []
+    for i in range(8):
+        session_id = "a" if i % 2 == 0 else "b"
+        if i == 5:
+            histories["b"] = [{"sender": "Flat Earth Believer", "message": "Welcome back"}]
+        history = histories[session_id]
+        history.append({"sender": "User", "message": f"message {i}"})
+        records.append({"time": (start + timedelta(seconds=i)).isoformat(), "session_id": session_id,
+                        "messages": list(history), "prompt": f"prompt {i}", "llm_response": f"answer {i}"})
+        history.append({"sender": "Flat Earth Believer", "message": f"answer {i}"})
+    return records
+
+
+def write_log(path, mode, records):
+    writer = ChatLogWriter(str(path), mode=mode, flush_interval=0.01)
+    for record in records:
+        writer.write(record)
+    writer.close()
+
+
+def test_delta_record():
+    record = {"session_id": "a", "messages": [1, 2, 3], "prompt": "the prompt"}
+    assert delta_record(record, 2) == {"session_id": "a", "messages": [3], "messages_offset": 2,
+                                       "prompt_sha256": prompt_hash("the prompt")}
+    # a shorter history than logged before is a new conversation
+    assert delta_record(record, 5)["messages_offset"] == 0
+    assert record["prompt"] == "the prompt"
+
+
+def test_delta_log_holds_only_the_new_messages(tmp_path):
+    write_log(tmp_path / "chat_log.text", "delta", turns())
+    with open(tmp_path / "chat_log.text") as f:
+        lines = [json.loads(line) for line in f]
+    assert [line["messages_offset"] for line in lines] == [0, 0, 2, 2, 4, 0, 6, 2]
+    # the answer of the previous turn and the new user message
+    assert all(len(line["messages"]) == 2 and "prompt" not in line for line in lines)
+
+
+@pytest.mark.parametrize("mode", ["full", "delta"])
+def test_histories_are_rebuilt_from_the_log(tmp_path, mode):
+    records = turns()
+    write_log(tmp_path / "chat_log.text", mode, records)
+    build_store(str(tmp_path / "chat_log.text"), str(tmp_path / "store"))
+    store = ChatLogStore(str(tmp_path / "store"))
+    for session_id in ("a", "b"):
+        expected = [record for record in records if record["session_id"] == session_id]
+        rows = store.session_rows(session_id)
+        assert [store.history(row) for row in rows] == [record["messages"] for record in expected]
+        assert [store.response(row) for row in rows] == [record["llm_response"] for record in expected]
@@ -0,0 +1,32 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from hint_classifier import AsyncSpeculativeHintClassifier, SpeculativeHintClassifier
+
+
+def failing_nlu(text):
+    raise ConnectionError("RASA is down")
+
+
+def test_classification_of_the_final_text():
+    with ThreadPoolExecutor(1) as executor:
+        classifier = SpeculativeHintClassifier(lambda text: ("greeting", {"text": text}), executor, deadline=1)
+        classifier.feed("Hi.", ["Hi."])
+        assert classifier.result("Hi. How are you?") == "greeting"
+        assert classifier.submitted_text == "Hi. How are you?"
+
+
+def test_failed_classification_skips_the_hint():
+    with ThreadPoolExecutor(1) as executor:
+        classifier = SpeculativeHintClassifier(failing_nlu, executor, deadline=1)
+        assert classifier.result("Hi.") is None
+
+
+def test_async_failed_classification_skips_the_hint():
+    async def nlu(text):
+        failing_nlu(text)
+
+    async def classify():
+        return await AsyncSpeculativeHintClassifier(nlu, deadline=1).result("Hi.")
+
+    assert asyncio.run(classify()) is None
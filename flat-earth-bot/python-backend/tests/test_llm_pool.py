@@ -0,0 +1,114 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from llm_pool import LlmPool
+
+
+def create_pool(urls=("http://a", "http://b"), **kwargs) -> LlmPool:
+    return LlmPool(list(urls), [url + "/health" for url in urls], **kwargs)
+
+
+def fail(pool: LlmPool, backend, times: int):
+    for _ in range(times):
+        assert pool.acquire(exclude=[b for b in pool.backends if b is not backend]) is backend
+        pool.release(backend, False)
+
+
+def test_breaker_opens_after_failures_in_a_row():
+    pool = create_pool(failure_threshold=3, open_seconds=60)
+    a, b = pool.backends
+    fail(pool, a, 2)
+    assert a.opened_at is None
+    fail(pool, a, 1)
+    assert a.opened_at is not None
+    assert [pool.acquire() for _ in range(3)] == [b, b, b]
+
+
+def test_success_resets_the_failures():
+    pool = create_pool(urls=["http://a"], failure_threshold=2)
+    backend = pool.backends[0]
+    fail(pool, backend, 1)
+    pool.release(pool.acquire(), True)
+    fail(pool, backend, 1)
+    assert backend.opened_at is None
+
+
+def test_half_open_breaker_lets_a_single_trial_through():
+    pool = create_pool(urls=["http://a"], failure_threshold=1, open_seconds=0.05)
+    backend = pool.backends[0]
+    fail(pool, backend, 1)
+    assert pool.acquire() is None
+    time.sleep(0.06)
+    assert pool.acquire() is backend
+    assert backend.trial
+    # the trial is still running, nothing else goes to the backend
+    assert pool.acquire() is None
+    pool.release(backend, True)
+    assert backend.opened_at is None and not backend.trial
+    assert pool.acquire() is backend
+
+
+def test_failed_trial_opens_the_breaker_again():
+    pool = create_pool(urls=["http://a"], failure_threshold=3, open_seconds=0.05)
+    backend = pool.backends[0]
+    fail(pool, backend, 3)
+    time.sleep(0.06)
+    trial = pool.acquire()
+    opened_at = backend.opened_at
+    pool.release(trial, False)
+    assert backend.opened_at > opened_at
+    assert pool.acquire() is None
+
+
+def test_dropped_trial_does_not_decide():
+    pool = create_pool(urls=["http://a"], failure_threshold=1, open_seconds=0.05)
+    backend = pool.backends[0]
+    fail(pool, backend, 1)
+    time.sleep(0.06)
+    pool.release(pool.acquire(), None)
+    assert backend.opened_at is not None
+    assert pool.acquire() is backend
+
+
+def test_health_probe_closes_the_breaker():
+    pool = create_pool(failure_threshold=1, open_seconds=60)
+    a, b = pool.backends
+    fail(pool, a, 1)
+    fail(pool, b, 1)
+    pool.probe(lambda url: SimpleNamespace(status_code=200 if url == "http://a/health" else 503))
+    assert a.opened_at is None
+    assert b.opened_at is not None
+
+
+def test_least_loaded_backend_is_chosen():
+    pool = create_pool()
+    first = pool.acquire()
+    second = pool.acquire()
+    assert {first, second} == set(pool.backends)
+    pool.release(first, True)
+    assert pool.acquire() is first
+
+
+
+def test_failure_that_was_not_consumed_counts_for_the_breaker():
+    async def run():
+        pool = create_pool(urls=["http://a"], failure_threshold=1)
+
+        async def connect(backend):
+            raise ConnectionError("reset by peer")
+
+        opened = asyncio.ensure_future(pool.aopen_stream(connect))
+        # the attempt fails, then the client goes away before aopen_stream sees the failure
+        while not pool.backends[0].outstanding:
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        opened.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await opened
+        assert pool.backends[0].opened_at is not None
+        assert pool.backends[0].outstanding == 0
+
+    asyncio.run(run())
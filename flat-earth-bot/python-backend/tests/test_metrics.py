@@ -0,0 +1,44 @@
+from prometheus_client import REGISTRY
+
+import metrics
+from caching import TTLCache
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_cache_stats_are_copied_on_every_scrape():
+    cache = TTLCache()
+    metrics.collect_cache_stats("test", cache.stats)
+    cache.get("a")
+    cache.set("a", 1)
+    cache.get("a")
+    text = metrics.render().decode()
+    assert 'chatbot_cache_hits_total{cache="test"} 1.0' in text
+    assert 'chatbot_cache_misses_total{cache="test"} 1.0' in text
+    assert 'chatbot_cache_entries{cache="test"} 1.0' in text
+    cache.get("a")
+    metrics.sync_collected()
+    assert sample("chatbot_cache_hits_total", cache="test") == 2
+
+
+def test_collected_counter_continues_after_a_reset():
+    count = {"value": 5}
+    metrics.collect_counter("test_reset", metrics.NLU_COALESCED, lambda: count["value"])
+    before = sample("chatbot_nlu_cache_coalesced_total")
+    metrics.sync_collected()
+    count["value"] = 2
+    metrics.sync_collected()
+    count["value"] = 4
+    metrics.sync_collected()
+    assert sample("chatbot_nlu_cache_coalesced_total") - before == 7
+
+
+def test_stage_timer_observes_the_duration():
+    before = sample("chatbot_stage_seconds_count", stage="test")
+    with metrics.stage("test"):
+        pass
+    metrics.observe_stage("test", 0.002)
+    assert sample("chatbot_stage_seconds_count", stage="test") - before == 2
+    assert sample("chatbot_stage_seconds_bucket", stage="test", le="0.0025") - before == 2
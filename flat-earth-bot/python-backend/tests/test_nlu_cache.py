@@ -0,0 +1,119 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from nlu_cache import NluCache
+
+
+def nlu_response(text):
+    return {"text": text, "intent": {"name": "greeting", "confidence": 0.9}}
+
+
+def test_normalized_texts_share_an_entry():
+    cache = NluCache()
+    calls = []
+
+    def parse(text):
+        calls.append(text)
+        return nlu_response(text)
+
+    assert cache.parse("Hello  there", parse)["text"] == "Hello  there"
+    assert cache.parse("hello there", parse) == nlu_response("hello there")
+    assert calls == ["Hello  there"]
+
+
+def test_concurrent_parses_are_coalesced():
+    cache = NluCache()
+    started, release = threading.Event(), threading.Event()
+
+    def parse(text):
+        started.set()
+        release.wait(1)
+        return nlu_response(text)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.parse("hi", parse))) for _ in range(4)]
+    threads[0].start()
+    started.wait(1)
+    [thread.start() for thread in threads[1:]]
+    while cache.coalesced < 3:
+        time.sleep(0.001)
+    release.set()
+    [thread.join(1) for thread in threads]
+    assert results == [nlu_response("hi")] * 4
+
+
+def test_async_followers_get_the_result_of_the_leader():
+    async def run():
+        cache = NluCache()
+        calls = []
+
+        async def parse(text):
+            calls.append(text)
+            await asyncio.sleep(0.01)
+            return nlu_response(text)
+
+        results = await asyncio.gather(*(cache.aparse("hi", parse) for _ in range(3)))
+        assert results == [nlu_response("hi")] * 3
+        assert calls == ["hi"] and cache.coalesced == 2
+
+    asyncio.run(run())
+
+
+def test_async_follower_takes_over_from_a_cancelled_leader():
+    async def run():
+        cache = NluCache()
+        calls = []
+
+        async def parse(text):
+            calls.append(text)
+            await asyncio.sleep(0.02)
+            return nlu_response(text)
+
+        leader = asyncio.ensure_future(cache.aparse("hi", parse))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(cache.aparse("hi", parse))
+        await asyncio.sleep(0.005)
+        leader.cancel()
+        assert await follower == nlu_response("hi")
+        assert leader.cancelled()
+        assert len(calls) == 2
+
+    asyncio.run(run())
+
+
+def test_async_followers_raise_the_error_of_the_leader():
+    async def run():
+        cache = NluCache()
+
+        async def parse(text):
+            await asyncio.sleep(0.01)
+            raise ValueError("RASA is down")
+
+        results = await asyncio.gather(*(cache.aparse("hi", parse) for _ in range(2)), return_exceptions=True)
+        assert [type(result) for result in results] == [ValueError, ValueError]
+        assert not cache._async_in_flight
+
+    asyncio.run(run())
+
+
+def test_cancelled_follower_does_not_cancel_the_leader():
+    async def run():
+        cache = NluCache()
+
+        async def parse(text):
+            await asyncio.sleep(0.02)
+            return nlu_response(text)
+
+        leader = asyncio.ensure_future(cache.aparse("hi", parse))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(cache.aparse("hi", parse))
+        await asyncio.sleep(0.005)
+        follower.cancel()
+        assert await leader == nlu_response("hi")
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+
+    asyncio.run(run())
@@ -0,0 +1,81 @@
+import random
+
+import pytest
+
+from prompt_builder import PromptBuilder
+
+
+def build_dialog(messages):
+    # Chatbot.build_dialog before the PromptBuilder
+    dlg = []
+    for message in messages:
+        msg = f"{message['sender']}: {message['message'].strip()}"
+        dlg.append(msg)
+    dlg.append(f"{messages[0]['sender']}: ")
+    return "\n".join(dlg)
+
+
+def trimmed_dialog(messages, budget):
+    """build_dialog of the latest messages that fit into budget, at least the last one."""
+    cue = f"{messages[0]['sender']}: "
+    for start in range(len(messages)):
+        dialog = build_dialog(messages[start:])
+        dialog = dialog[:len(dialog) - len(f"{messages[start]['sender']}: ")] + cue
+        if len(dialog) <= budget:
+            return dialog
+    return dialog
+
+
+def conversation(length, seed=0):
+    rng = random.Random(seed)
+    messages = [{"sender": "Flat Earth Believer", "message": "I believe in flat earth"}]
+    for i in range(length):
+        sender = "User" if i % 2 == 0 else "Flat Earth Believer"
+        messages.append({"sender": sender, "message": " ".join(["word"] * rng.randint(1, 40)) + f" {i} "})
+    return messages
+
+
+def test_without_trimming_the_dialog_is_the_baseline():
+    messages = conversation(10)
+    assert PromptBuilder().render_dialog("s", messages, 10 ** 6) == build_dialog(messages)
+
+
+@pytest.mark.parametrize("budget", [1, 50, 200, 500, 1000, 5000])
+def test_budget_drops_the_oldest_messages(budget):
+    messages = conversation(30)
+    assert PromptBuilder().render_dialog(None, messages, budget) == trimmed_dialog(messages, budget)
+
+
+def test_cached_session_matches_the_baseline_every_turn():
+    builder = PromptBuilder()
+    messages = conversation(40, seed=1)
+    rng = random.Random(2)
+    for end in range(1, len(messages) + 1):
+        budget = rng.choice([100, 300, 800, 10 ** 6])
+        assert builder.render_dialog("s", messages[:end], budget) == trimmed_dialog(messages[:end], budget)
+
+
+def test_changed_history_is_rendered_again():
+    builder = PromptBuilder()
+    messages = conversation(6)
+    builder.render_dialog("s", messages, 10 ** 6)
+    edited = [dict(message) for message in messages]
+    edited[2]["message"] = "an edited message"
+    assert builder.render_dialog("s", edited, 10 ** 6) == build_dialog(edited)
+    assert builder.render_dialog("s", messages[:3], 10 ** 6) == build_dialog(messages[:3])
+
+
+def test_prefix_cache_layout_keeps_its_start_and_budget():
+    builder = PromptBuilder(max_length=600, layout="prefix_cache", trim_ratio=0.5)
+    messages = conversation(40, seed=3)
+    starts = []
+    for end in range(2, len(messages) + 1):
+        prompt = builder.build("s", messages[:end], "PERSONA\n", "INSTRUCTION\n")
+        assert len(prompt) <= 600
+        assert prompt.startswith("PERSONA\n") and prompt.endswith("INSTRUCTION\nFlat Earth Believer: ")
+        starts.append(builder.dialogs.get("s").start)
+        history = prompt[len("PERSONA\n"):-len("\nINSTRUCTION\nFlat Earth Believer: ")]
+        # whole messages from the start on, up to the latest one
+        assert history == build_dialog(messages[starts[-1]:end]).rsplit("\n", 1)[0]
+    assert starts == sorted(starts)
+    assert starts[-1] > 0
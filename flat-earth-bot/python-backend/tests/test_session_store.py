@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+from session_store import MemorySessionStore, SessionState, SqliteSessionStore, compact_logging_info
+
+
+def session_state() -> SessionState:
+    state = SessionState()
+    state["hinting"] = 1
+    state["hint_count"] = 2
+    state["correct_answer"] = ["a", "c"]
+    state["intent_flags"] = {"ask_quiz": True, "nefarious_intent": False}
+    state["intent_flags"]["greeting"] = True
+    messages = [{"sender": "Flat Earth Believer", "message": "hi"}, {"sender": "User", "message": "hello"}]
+    state["last_logging_info"] = compact_logging_info({"session_id": "s", "messages": messages, "prompt": "p"}, 1)
+    state["message_count"] = 2
+    return state
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def create_store(request, tmp_path):
+    stores = []
+
+    def create(**kwargs):
+        if request.param == "memory":
+            store = MemorySessionStore(**kwargs)
+        else:
+            store = SqliteSessionStore(str(tmp_path / "sessions.sqlite"), **kwargs)
+        stores.append(store)
+        return store
+
+    yield create
+    for store in stores:
+        store.close()
+
+
+def test_round_trip(create_store):
+    store = create_store()
+    state = session_state()
+    store.save("s", state)
+    loaded = store.load("s")
+    assert loaded.to_dict() == state.to_dict()
+    assert dict(loaded["intent_flags"]) == {"ask_quiz": True, "nefarious_intent": False, "greeting": True}
+    assert loaded["last_logging_info"]["messages_offset"] == 1
+
+
+def test_unknown_and_deleted_sessions_start_fresh(create_store):
+    store = create_store()
+    assert store.load("unknown").to_dict() == SessionState().to_dict()
+    store.save("s", session_state())
+    store.delete("s")
+    assert store.load("s")["hint_count"] == 0
+
+
+def test_expired_session_starts_fresh(create_store):
+    store = create_store(ttl=0.05)
+    store.save("s", session_state())
+    assert store.load("s")["hint_count"] == 2
+    time.sleep(0.06)
+    assert store.load("s")["hint_count"] == 0
+
+
+def test_least_recently_used_session_is_evicted(tmp_path):
+    store = MemorySessionStore(max_entries=2)
+    for session_id in ("a", "b"):
+        store.save(session_id, session_state())
+    store.load("a")
+    store.save("c", session_state())
+    assert [store.load(session_id)["hint_count"] for session_id in ("a", "b", "c")] == [2, 0, 2]
+
+
+def test_sqlite_evicts_the_least_recently_saved_sessions(tmp_path):
+    store = SqliteSessionStore(str(tmp_path / "sessions.sqlite"), max_entries=2, cleanup_interval=3)
+    for session_id in ("a", "b", "c"):
+        store.save(session_id, session_state())
+    assert [store.load(session_id)["hint_count"] for session_id in ("a", "b", "c")] == [0, 2, 2]
+    store.close()
+
+
+def test_sqlite_sessions_are_shared_between_stores_and_threads(tmp_path):
+    path = str(tmp_path / "sessions.sqlite")
+    writer, reader = SqliteSessionStore(path), SqliteSessionStore(path)
+    threads = [threading.Thread(target=writer.save, args=(f"s{i}", session_state())) for i in range(8)]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+    assert all(reader.load(f"s{i}")["correct_answer"] == ["a", "c"] for i in range(8))
+    assert writer._saves == 8
+    writer.close()
+    reader.close()
@@ -0,0 +1,48 @@
+import json
+import logging
+
+from sse import NEWLINE_EVENT, SSEParser, stream_texts, token_text
+
+
+def token_event(text: str, index: int = 0) -> bytes:
+    return b"data:" + json.dumps({"index": index, "token": {"id": 1, "text": text, "logprob": -0.1, "special": False},
+                                  "generated_text": None, "details": None}).encode() + b"\n\n"
+
+
+def test_newline_event_is_a_line_break():
+    events = SSEParser().feed(NEWLINE_EVENT.encode())
+    assert len(events) == 1
+    assert token_text(events[0]) == "\n"
+
+
+def test_newline_event_is_not_logged(caplog):
+    with caplog.at_level(logging.DEBUG):
+        assert stream_texts([token_event("Hi"), NEWLINE_EVENT, token_event("hint", -1)]) == ["Hi", "\n", "hint"]
+    assert not caplog.records
+
+
+def test_events_split_across_chunks():
+    stream = b"".join(token_event(text, i) for i, text in enumerate(["The", " earth", " is", " \"flat\""]))
+    for size in (1, 2, 3, 7, 50):
+        chunks = [stream[i:i + size] for i in range(0, len(stream), size)]
+        assert stream_texts(chunks) == ["The", " earth", " is", " \"flat\""]
+
+
+def test_several_events_in_one_chunk():
+    chunk = b'header: {"dialog_success": true}\n\n' + token_event("a") + token_event("b", 1) + b": comment\n\n"
+    events = SSEParser().feed(chunk)
+    assert [event.field for event in events] == ["header", "data", "data"]
+    assert [token_text(event) for event in events] == [None, "a", "b"]
+
+
+def test_carriage_returns_and_missing_last_separator():
+    parser = SSEParser()
+    assert parser.feed(token_event("a").replace(b"\n", b"\r\n")) and parser.feed(b'data:{"token":{"text":"b"}}') == []
+    assert [token_text(event) for event in parser.flush()] == ["b"]
+
+
+def test_malformed_event_is_skipped_at_debug_level(caplog):
+    with caplog.at_level(logging.DEBUG):
+        assert stream_texts([b"data:{not json\n\n", token_event("a")]) == ["a"]
+    assert [record.levelno for record in caplog.records] == [logging.DEBUG]
+    assert caplog.records[0].exc_info is None
@@ -0,0 +1,101 @@
+"""
+The read-only tables a worker needs before it can answer, in one file: the sentiment lexicon
+and the compiled dialog policy. Loading them from models/warm_state.pickle is a single
+pickle.load; it does not import numpy (for the .npz lexicon) and does not parse and compile
+the policy. The prompt prefixes are not part of it, joining them takes microseconds.
+
+The file records a hash of every source it was built from (lexicon, policy, prompts and the
+modules of the pickled classes). If one of them changed, the file is ignored and the tables
+are built from the sources as before. The Docker image builds it:
+
+    python warm_state.py [--output models/warm_state.pickle]
+"""
+
+import argparse
+import functools
+import hashlib
+import logging
+import os
+import pickle
+import time
+from typing import Dict, NamedTuple, Optional
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_WARM_STATE_PATH = os.path.join(BACKEND_DIR, "models", "warm_state.pickle")
+WARM_STATE_VERSION = 1
+SOURCE_MODULES = ("sentiment.py", "dialog_policy.py", "prompts.py")
+
+
+class WarmState(NamedTuple):
+    lexicon_path: str
+    lexicon: object
+    policy_path: str
+    policy: object
+
+
+def source_hashes(paths) -> Dict[str, str]:
+    hashes = {}
+    for path in paths:
+        with open(path, "rb") as f:
+            hashes[os.path.abspath(path)] = hashlib.sha256(f.read()).hexdigest()
+    return hashes
+
+
+def sources(lexicon_path: str, policy_path: str):
+    return [lexicon_path, policy_path] + [os.path.join(BACKEND_DIR, module) for module in SOURCE_MODULES]
+
+
+def build_warm_state(path: str = DEFAULT_WARM_STATE_PATH):
+    import dialog_policy
+    import sentiment
+
+    lexicon_path = os.getenv("SENTIMENT_LEXICON_PATH", sentiment.DEFAULT_LEXICON_PATH)
+    policy_path = os.getenv("DIALOG_POLICY_PATH", dialog_policy.DEFAULT_POLICY_PATH)
+    state = WarmState(
+        lexicon_path=os.path.abspath(lexicon_path),
+        lexicon=sentiment.read_sentiment_lexicon(lexicon_path),
+        policy_path=os.path.abspath(policy_path),
+        policy=dialog_policy.DialogPolicy(policy_path, reload_interval=None).tables
+    )
+    with open(path, "wb") as f:
+        pickle.dump({"version": WARM_STATE_VERSION, "sources": source_hashes(sources(lexicon_path, policy_path)),
+                     "state": state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return state
+
+
+@functools.lru_cache(maxsize=None)
+def read_warm_state(path: str) -> Optional[WarmState]:
+    if not os.path.exists(path):
+        return None
+    start = time.perf_counter()
+    try:
+        with open(path, "rb") as f:
+            content = pickle.load(f)
+        if content["version"] != WARM_STATE_VERSION:
+            logging.info(f"Ignoring the warm state {path} of version {content['version']}")
+            return None
+        recorded = content["sources"]
+        if source_hashes(recorded) != recorded:
+            logging.info(f"Ignoring the warm state {path}, its sources changed since it was built")
+            return None
+    except Exception as e:
+        logging.warning(f"Could not load the warm state from {path} ({e})")
+        return None
+    logging.info(f"Loaded the warm state from {path} in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return content["state"]
+
+
+def load_warm_state() -> Optional[WarmState]:
+    """The tables of models/warm_state.pickle (or WARM_STATE_PATH), None if it is missing or stale."""
+    return read_warm_state(os.getenv("WARM_STATE_PATH", DEFAULT_WARM_STATE_PATH))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=os.getenv("WARM_STATE_PATH", DEFAULT_WARM_STATE_PATH))
+    args = parser.parse_args()
+    # through the module, so the pickle refers to warm_state.WarmState and not to __main__.WarmState
+    import warm_state
+    built = warm_state.build_warm_state(args.output)
+    print(f"Saved the warm state to {args.output} ({os.path.getsize(args.output) / 1024:.0f} KiB, "
+          f"{len(built.lexicon.words)} words)")
@@ -0,0 +1,79 @@
+"""
+Batch parse endpoint for the Python backend. It is registered as an input channel in
+credentials.yml and answers
+
+    POST /webhooks/batch_parse/parse  {"texts": ["hello", "the earth is round"]}
+
+with {"results": [...]}, one /model/parse response per text in the same order.
+
+The NLU graph of the model runs once for the whole batch: the tokenizer, featurizers and
+classifier get the list of all messages, as they do in training, instead of one graph run
+per text. Note that the components of the default pipeline (e.g. DIETClassifier) still loop
+over the messages inside their process(), so the classification work grows with the number
+of texts. What a batch saves are the HTTP requests and the per-run overhead of the graph.
+Texts with an intent shortcut ("/greet") and models with an HTTP interpreter are parsed
+one by one through agent.parse_message.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Text
+
+from rasa.core.channels.channel import InputChannel, UserMessage
+from rasa.core.processor import MessageProcessor
+from rasa.engine.constants import PLACEHOLDER_MESSAGE
+from rasa.shared.constants import INTENT_MESSAGE_PREFIX
+from rasa.shared.nlu.constants import ENTITIES, INTENT, INTENT_NAME_KEY, PREDICTED_CONFIDENCE_KEY, TEXT
+from sanic import Blueprint, response
+from sanic.request import Request
+from sanic.response import HTTPResponse
+
+
+def parse_batch(processor: MessageProcessor, texts: List[Text]) -> List[Dict[Text, Any]]:
+    """One run of the NLU graph for all texts, the parse data is built like MessageProcessor.parse_message does."""
+    target = processor.model_metadata.nlu_target
+    results = processor.graph_runner.run(inputs={PLACEHOLDER_MESSAGE: [UserMessage(text) for text in texts]},
+                                         targets=[target])
+    parsed = []
+    for message in results[target]:
+        parse_data = {TEXT: "", INTENT: {INTENT_NAME_KEY: None, PREDICTED_CONFIDENCE_KEY: 0.0}, ENTITIES: []}
+        parse_data.update(message.as_dict(only_output_properties=True))
+        processor._update_full_retrieval_intent(parse_data)
+        parsed.append(parse_data)
+    return parsed
+
+
+def needs_single_parse(processor: MessageProcessor, texts: List[Text]) -> bool:
+    return getattr(processor, "http_interpreter", None) is not None or \
+        any(text.startswith(INTENT_MESSAGE_PREFIX) for text in texts)
+
+
+class BatchParseInput(InputChannel):
+
+    @classmethod
+    def name(cls) -> Text:
+        return "batch_parse"
+
+    def blueprint(self, on_new_message: Callable[[UserMessage], Awaitable[Any]]) -> Blueprint:
+        batch_parse = Blueprint("batch_parse", __name__)
+
+        @batch_parse.route("/", methods=["GET"])
+        async def health(request: Request) -> HTTPResponse:
+            return response.json({"status": "ok"})
+
+        @batch_parse.route("/parse", methods=["POST"])
+        async def parse(request: Request) -> HTTPResponse:
+            texts = (request.json or {}).get("texts")
+            if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                return response.json({"error": "expected {\"texts\": [...]}"}, status=400)
+            agent = request.app.ctx.agent
+            if agent is None or not agent.is_ready():
+                return response.json({"error": "no model loaded"}, status=409)
+            if not texts:
+                return response.json({"results": []})
+            if needs_single_parse(agent.processor, texts):
+                results = await asyncio.gather(*(agent.parse_message(text) for text in texts))
+            else:
+                results = parse_batch(agent.processor, texts)
+            return response.json({"results": results})
+
+        return batch_parse